@@ -0,0 +1,203 @@
+import os
+import time
+import uuid
+import shutil
+import asyncio
+import tempfile
+import traceback
+
+# Asynchronous analysis jobs.
+#
+# POST /jobs puts a job on a bounded asyncio queue and returns its id at once;
+# JOB_RUNNERS runner tasks take jobs off the queue and await the actual work
+# (R pool / Python engine), so long analyses never hold an HTTP connection.
+# Jobs report progress, can be cancelled while queued or running, and finished
+# jobs are forgotten after JOB_TTL seconds, the oldest ones sooner when more
+# than JOB_MAX_FINISHED are kept. JOB_QUEUE_SIZE bounds the jobs still waiting
+# (cancelled ones do not count). Files produced by jobs (exports) are kept on
+# disk, not in memory, and deleted together with their job.
+
+JOB_RUNNERS = int(os.environ.get("JOB_RUNNERS", "4"))
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", "100"))
+JOB_TTL = float(os.environ.get("JOB_TTL", "3600"))
+JOB_MAX_FINISHED = int(os.environ.get("JOB_MAX_FINISHED", "500"))
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, kind: str, work, total: int = 1, on_finish=None):
+        self.id = str(uuid.uuid4())
+        self.kind = kind
+        self.work = work  # async callable(job) -> result
+        self.status = QUEUED
+        self.done = 0
+        self.total = total
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.task = None
+        self.attachment = None  # (path, headers) of a produced file, e.g. an export
+        self.on_finish = on_finish  # called once when the job ends, however it ends
+
+    def finish(self):
+        self.finished_at = time.time()
+        on_finish, self.on_finish = self.on_finish, None
+        if on_finish is not None:
+            on_finish()
+
+    def advance(self, n: int = 1):
+        self.done = min(self.total, self.done + n)
+
+    def to_dict(self, with_result: bool = True) -> dict:
+        out = {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": {"done": self.done, "total": self.total},
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if self.error is not None:
+            out["error"] = self.error
+        if with_result and self.status == DONE:
+            out["result"] = self.result
+        return out
+
+
+class JobManager:
+    def __init__(self, runners=JOB_RUNNERS, queue_size=JOB_QUEUE_SIZE, ttl=JOB_TTL, max_finished=JOB_MAX_FINISHED):
+        self.runners = runners
+        self.queue_size = queue_size
+        self.ttl = ttl
+        self.max_finished = max_finished
+        self._queue = None
+        self._queued = 0  # jobs in the queue that are still QUEUED
+        self._runner_tasks = []
+        self._jobs = {}
+        self._files_dir = None
+
+    async def start(self):
+        if self._queue is not None:
+            return
+        # unbounded: capacity is checked against the live queued jobs, cancelled ones are skipped when dequeued
+        self._queue = asyncio.Queue()
+        self._queued = 0
+        self._runner_tasks = [asyncio.ensure_future(self._runner(i)) for i in range(self.runners)]
+
+    async def shutdown(self):
+        for t in self._runner_tasks:
+            t.cancel()
+        for job in self._jobs.values():
+            if job.task is not None:
+                job.task.cancel()
+        self._runner_tasks = []
+        self._queue = None
+        if self._files_dir is not None:
+            shutil.rmtree(self._files_dir, ignore_errors=True)
+            self._files_dir = None
+
+    def _forget(self, job: Job):
+        del self._jobs[job.id]
+        if job.attachment is not None:
+            try:
+                os.remove(job.attachment[0])
+            except OSError:
+                pass
+            job.attachment = None
+
+    def _expire(self):
+        finished = sorted((j for j in self._jobs.values() if j.status in FINISHED), key=lambda j: j.finished_at)
+        now = time.time()
+        extra = len(finished) - self.max_finished if self.max_finished > 0 else 0
+        for i, job in enumerate(finished):
+            if i < extra or (self.ttl > 0 and now - job.finished_at > self.ttl):
+                self._forget(job)
+
+    def save_attachment(self, job: Job, data: bytes, headers: dict):
+        """Keep a file produced by the job on disk until the job is forgotten (blocking, use a worker thread)."""
+        if self._files_dir is None:
+            self._files_dir = tempfile.mkdtemp(prefix="jobs_")
+        path = os.path.join(self._files_dir, f"{job.id}.bin")
+        with open(path, "wb") as f:
+            f.write(data)
+        job.attachment = (path, headers)
+
+    async def submit(self, kind: str, work, total: int = 1, on_finish=None) -> Job:
+        if self._queue is None:
+            await self.start()
+        self._expire()
+        if self.queue_size > 0 and self._queued >= self.queue_size:
+            raise QueueFull()
+        job = Job(kind, work, total, on_finish)
+        self._queue.put_nowait(job)
+        self._queued += 1
+        self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str):
+        self._expire()
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        if job.status == QUEUED:
+            # the runner skips it when it comes off the queue; its place is free right away
+            job.status = CANCELLED
+            self._queued -= 1
+            job.finish()
+        elif job.status == RUNNING and job.task is not None:
+            job.task.cancel()
+        return job
+
+    async def _runner(self, n: int):
+        while True:
+            job = await self._queue.get()
+            if job.status != QUEUED:
+                continue
+            self._queued -= 1
+            job.status = RUNNING
+            job.started_at = time.time()
+            job.task = asyncio.ensure_future(job.work(job))
+            try:
+                job.result = await job.task
+                job.done = job.total
+                job.status = DONE
+            except asyncio.CancelledError:
+                if job.task.cancelled():
+                    job.status = CANCELLED
+                else:
+                    # the runner itself is being shut down
+                    job.task.cancel()
+                    raise
+            except Exception as e:
+                job.status = FAILED
+                job.error = {"error": str(e), "traceback": getattr(e, "remote_traceback", "") or traceback.format_exc()}
+                print(f"[job_queue] job {job.id} ({job.kind}) failed: {e}")
+            finally:
+                job.finish()
+                job.task = None
+
+    def stats(self) -> dict:
+        counts = {}
+        for j in self._jobs.values():
+            counts[j.status] = counts.get(j.status, 0) + 1
+        return {
+            "runners": self.runners,
+            "queue_size": self.queue_size,
+            "queued": self._queued,
+            "jobs": counts,
+        }
+
+
+jobs = JobManager()
@@ -0,0 +1,37 @@
+import importlib
+import threading
+
+# Deferred imports for the heavy modules (pandas, SciPy, openpyxl behind the
+# services): the server process starts listening without them and the startup
+# warm-up (or the first request) imports them. Attribute access goes to the
+# real module once it is loaded.
+
+
+class LazyModule:
+    def __init__(self, name: str, package: str = None):
+        self._name = name
+        self._package = package
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name, self._package)
+        return self._module
+
+    @property
+    def loaded(self) -> bool:
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+def lazy_import(name: str, package: str = None) -> LazyModule:
+    return LazyModule(name, package)
@@ -1,26 +1,92 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-import pandas as pd
+from fastapi.responses import StreamingResponse, FileResponse, Response, PlainTextResponse, JSONResponse
+from starlette.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager, contextmanager
 import os
+import asyncio
 import uuid
-import unicodedata
 from urllib.parse import quote
-from . import r_interface
-from .services import report_service
+from .r_pool import pool as r_pool
+from .result_cache import cache as result_cache, make_key as make_cache_key
+from .job_queue import jobs, QueueFull, DONE
+from .plot_store import PlotStore
+from .upload_store import UploadStore
+from .metrics import metrics, ServerTimingMiddleware
+from .lazy import lazy_import
 import json
-import chardet
-import csv
 import base64
+import hashlib
+import shutil
+import tempfile
 import time
 
+# pandas, SciPy and openpyxl come in through these; they are imported by the
+# startup warm-up (or the first request that needs them), not when the worker boots
+pd = lazy_import("pandas")
+r_interface = lazy_import(".r_interface", __package__)
+py_engine = lazy_import(".py_engine", __package__)
+report_service = lazy_import(".services.report_service", __package__)
+dataset_service = lazy_import(".services.dataset_service", __package__)
+profile_service = lazy_import(".services.profile_service", __package__)
+batch_service = lazy_import(".services.batch_service", __package__)
+encoding_service = lazy_import(".services.encoding_service", __package__)
+streaming_service = lazy_import(".services.streaming_service", __package__)
+resampling_service = lazy_import(".services.resampling_service", __package__)
+matrix_service = lazy_import(".services.matrix_service", __package__)
+_LAZY_MODULES = (pd, r_interface, py_engine, report_service, dataset_service, profile_service, batch_service,
+                 encoding_service, streaming_service, resampling_service, matrix_service)
+
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
 PLOTS_DIR = os.path.join(BASE_DIR, "plots")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(PLOTS_DIR, exist_ok=True)
+plot_store = PlotStore(PLOTS_DIR)
+upload_store = UploadStore(UPLOAD_DIR)
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+SNIFF_BYTES = 200000
+
+# Statistics engine: "r" (rpy2 + stat_tests.R) or "python" (NumPy/SciPy port).
+# Can be overridden per request with {"engine": "..."} in the payload.
+ANALYSIS_ENGINE = os.environ.get("ANALYSIS_ENGINE", "r").lower()
+ENGINES = ("r", "python")
+# seconds between checks of stat_tests.R for changes (0 = off); a changed script is re-sourced on every R worker
+R_SCRIPT_WATCH_INTERVAL = float(os.environ.get("R_SCRIPT_WATCH_INTERVAL", "5"))
+# how the R engine gets its data: "memory" hands the two snapshot columns over as
+# vectors (no file I/O), "csv" writes a projection CSV that R parses
+R_INPUT = os.environ.get("R_INPUT", "memory").lower()
+
+# warm-up state reported by GET /ready
+_readiness = {"status": "starting", "steps": {}, "error": None, "seconds": None, "script_version": None}
+
 
-app = FastAPI(title="Dependency Analysis API")
+@asynccontextmanager
+async def _lifespan(app):
+    await jobs.start()
+    plot_store.start_sweeper()
+    upload_store.start_sweeper()
+    result_cache.start_sweeper()
+    # warm-up runs in the background: the server answers (GET /ready -> 503) while it loads
+    tasks = [asyncio.ensure_future(_warm_up())]
+    if ANALYSIS_ENGINE == "r" and R_SCRIPT_WATCH_INTERVAL > 0:
+        tasks.append(asyncio.ensure_future(_watch_r_script()))
+    try:
+        yield
+    finally:
+        for t in tasks:
+            t.cancel()
+        await jobs.shutdown()
+        plot_store.stop_sweeper()
+        upload_store.stop_sweeper()
+        result_cache.stop_sweeper()
+        await r_pool.shutdown()
+        if batch_service.loaded:
+            batch_service.shutdown()
+
+
+app = FastAPI(title="Dependency Analysis API", lifespan=_lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -28,59 +94,97 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
+# outermost, so the request duration covers CORS handling and the whole streamed body
+app.add_middleware(ServerTimingMiddleware)
+
+
+def _warm_python():
+    for module in _LAZY_MODULES:
+        module.load()
+    # first calls into SciPy / pandas load more of them lazily
+    py_engine.run_analysis([1.5, 2.0, 3.5, 4.0, 5.5, 6.0, 7.5, 8.0], ["A", "B"] * 4)
+
+
+async def _warm_up():
+    """Import the heavy modules, run a tiny Python analysis, start the R workers and run one analysis on each."""
+    started = time.perf_counter()
+    _readiness["status"] = "warming"
+    try:
+        step = time.perf_counter()
+        with metrics.timed("warm_up_python"):
+            await run_in_threadpool(_warm_python)
+        _readiness["steps"]["python"] = round(time.perf_counter() - step, 3)
+        if ANALYSIS_ENGINE == "r":
+            step = time.perf_counter()
+            with metrics.timed("warm_up_r"):
+                workers = await r_pool.warm_up()
+            _readiness["steps"]["r"] = round(time.perf_counter() - step, 3)
+            _readiness["steps"]["r_workers"] = workers
+            _readiness["script_version"] = workers[0]["script_version"] if workers else None
+        _readiness["status"] = "ready"
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        _readiness["status"] = "failed"
+        _readiness["error"] = str(e)
+        print(f"[main._warm_up] warm-up failed: {e}")
+    _readiness["seconds"] = round(time.perf_counter() - started, 3)
+    print(f"[main._warm_up] {_readiness['status']} in {_readiness['seconds']}s: {_readiness['steps']}")
+
+
+async def _watch_r_script():
+    """Re-source stat_tests.R on every R worker as soon as the file changes, not on the next analysis."""
+    while True:
+        await asyncio.sleep(R_SCRIPT_WATCH_INTERVAL)
+        if _readiness["status"] != "ready":
+            continue
+        version = r_interface.script_version()
+        if version == _readiness["script_version"]:
+            continue
+        print("[main._watch_r_script] stat_tests.R changed, re-sourcing on the R workers")
+        _readiness["script_version"] = version
+        try:
+            with metrics.timed("warm_up_r"):
+                await r_pool.warm_up()
+        except Exception as e:
+            # keep serving; the workers try to source the script again on their next analysis
+            print(f"[main._watch_r_script] re-source failed: {e}")
+
 
 def _safe_name(s: str) -> str:
-    nk = unicodedata.normalize("NFKD", s)
-    return nk.encode("ASCII", "ignore").decode("ASCII")
+    return dataset_service.ascii_fold(s)
 
 
-def _normalize_encoding(enc: str):
-    if not enc:
-        return enc
-    e = enc.lower()
-    if e.startswith("windows-"):
-        e = e.replace("windows-", "cp")
-    if e in ("iso-8859-1", "latin1"):
-        return "latin1"
-    if e.startswith("utf-8"):
-        return "utf-8"
-    return e
+def _columns_from_sample(df):
+    cols = []
+    for c in df.columns.tolist():
+        is_num = pd.api.types.is_numeric_dtype(df[c])
+        typ = "mierzalne" if is_num else "niemierzalne"
+        cols.append({
+            "name": c,
+            "display": c,
+            "safe_name": _safe_name(c),
+            "type": typ,
+            "is_numeric": bool(is_num),
+            "n_unique": int(df[c].nunique()) if df.shape[0] > 0 else 0
+        })
+    return cols
 
 
-def _guess_delimiter_from_text(text: str):
-    try:
-        sniffer = csv.Sniffer()
-        dialect = sniffer.sniff(text, delimiters=[',', ';', '\t', '|'])
-        return dialect.delimiter
-    except Exception:
-        pass
-    lines = text.splitlines()
-    if not lines:
-        return ","
-    header = lines[0]
-    candidates = [',', ';', '\t', '|']
-    counts = {c: header.count(c) for c in candidates}
-    best = max(counts.items(), key=lambda kv: kv[1])
-    return best[0] if best[1] > 0 else ','
-
-
-def _detect_encoding_and_columns(path: str):
-    with open(path, "rb") as f:
-        sample_bytes = f.read(200000)
-    det = chardet.detect(sample_bytes)
-    enc = _normalize_encoding(det.get("encoding") or "")
-    try:
-        decoded = sample_bytes.decode(enc, errors='replace') if enc else sample_bytes.decode('utf-8', errors='replace')
-    except Exception:
-        decoded = sample_bytes.decode('utf-8', errors='replace')
-    delimiter = _guess_delimiter_from_text(decoded)
+def _detect_encoding_and_columns(path: str, sample_bytes: bytes = None):
+    if sample_bytes is None:
+        with open(path, "rb") as f:
+            sample_bytes = f.read(SNIFF_BYTES)
+    detected = encoding_service.detect(sample_bytes, truncated=len(sample_bytes) >= SNIFF_BYTES)
+    enc, delimiter = detected["encoding"], detected["delimiter"]
+    print(f"[main._detect_encoding_and_columns] encoding={enc} ({detected['encoding_source']}), delimiter={delimiter!r}")
 
+    # the detected encoding almost always parses; the rest are fallbacks for files
+    # whose first SNIFF_BYTES are not representative
     tried = []
-    enc_candidates = []
-    if enc:
-        enc_candidates.append(enc)
-    enc_candidates += ["utf-8", "cp1250", "latin1", "iso-8859-2", "utf-16"]
+    enc_candidates = [enc, "utf-8", "cp1250", "latin1", "iso-8859-2", "utf-16"]
 
     last_exception = None
     for e in enc_candidates:
@@ -88,43 +192,64 @@ def _detect_encoding_and_columns(path: str):
             continue
         tried.append(e)
         try:
-            df = pd.read_csv(path, nrows=1000, encoding=e, sep=delimiter, engine="python")
-            cols = []
-            for c in df.columns.tolist():
-                is_num = pd.api.types.is_numeric_dtype(df[c])
-                typ = "mierzalne" if is_num else "niemierzalne"
-                cols.append({
-                    "name": c,
-                    "display": c,
-                    "safe_name": _safe_name(c),
-                    "type": typ,
-                    "is_numeric": bool(is_num),
-                    "n_unique": int(df[c].nunique()) if df.shape[0] > 0 else 0
-                })
-            return e, delimiter, cols
+            df = pd.read_csv(path, nrows=1000, encoding=e, sep=delimiter)
+            return e, delimiter, _columns_from_sample(df)
         except Exception as ex:
             last_exception = ex
             continue
 
     try:
         df = pd.read_csv(path, nrows=1000, engine="python", sep=None)
-        cols = []
-        for c in df.columns.tolist():
-            is_num = pd.api.types.is_numeric_dtype(df[c])
-            typ = "mierzalne" if is_num else "niemierzalne"
-            cols.append({
-                "name": c,
-                "display": c,
-                "safe_name": _safe_name(c),
-                "type": typ,
-                "is_numeric": bool(is_num),
-                "n_unique": int(df[c].nunique()) if df.shape[0] > 0 else 0
-            })
-        return "unknown", ",", cols
+        return "unknown", ",", _columns_from_sample(df)
     except Exception as ex:
         raise HTTPException(status_code=400, detail=f"Failed to read CSV header: {last_exception or ex}")
 
 
+async def _stream_upload_to_disk(file: UploadFile, path: str):
+    """Copy the upload to disk chunk by chunk, hashing and counting lines on the way.
+
+    Returns (content_hash, rows, sample_bytes); memory use does not depend on the file size.
+    """
+    h = hashlib.sha256()
+    newlines = 0
+    size = 0
+    last_byte = b""
+    sample = bytearray()
+    part_path = path + ".part"
+    with open(part_path, "wb") as f:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+            newlines += chunk.count(b"\n")
+            size += len(chunk)
+            last_byte = chunk[-1:]
+            if len(sample) < SNIFF_BYTES:
+                sample += chunk[:SNIFF_BYTES - len(sample)]
+            await run_in_threadpool(f.write, chunk)
+    os.replace(part_path, path)
+    lines = newlines + (1 if size and last_byte != b"\n" else 0)
+    return h.hexdigest(), max(0, lines - 1), bytes(sample)
+
+
+def _columns_from_profile(profile):
+    """Column list for the upload response, typed from the full-dataset profile."""
+    cols = []
+    for c in profile_service.public_profile(profile)["columns"]:
+        col = {
+            "name": c["name"],
+            "display": c["name"],
+            "safe_name": _safe_name(c["name"]),
+            "type": c["type"],
+            "is_numeric": bool(c["is_numeric"]),
+            "n_unique": int(c["distinct"]),
+        }
+        col.update({k: v for k, v in c.items() if k not in col})
+        cols.append(col)
+    return cols
+
+
 # small transparent 1x1 PNG used as fallback placeholder (base64)
 TRANSPARENT_PNG_BASE64 = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR4nGNgYAAAAAMAASsJTYQAAAAASUVORK5CYII="
 
@@ -134,317 +259,1062 @@ async def upload_csv(file: UploadFile = File(...)):
     if not file.filename.lower().endswith(".csv"):
         raise HTTPException(status_code=400, detail="Tylko pliki CSV są wspierane")
     file_id = str(uuid.uuid4())
-    path = os.path.join(UPLOAD_DIR, f"{file_id}.csv")
-    content = await file.read()
-    with open(path, "wb") as f:
-        f.write(content)
-    encoding, delimiter, cols = _detect_encoding_and_columns(path)
-    meta = {"file_id": file_id, "filename": file.filename, "encoding": encoding, "delimiter": delimiter}
+    # leased while it is written and built: the sweeper leaves its .part and .snapshot.tmp alone
+    with upload_store.lease(file_id):
+        path = os.path.join(UPLOAD_DIR, f"{file_id}.csv")
+        with metrics.timed("upload_write"):
+            content_hash, streamed_rows, sample = await _stream_upload_to_disk(file, path)
+
+        existing_id = await run_in_threadpool(upload_store.find, content_hash)
+        if existing_id is not None:
+            # same bytes uploaded before: reuse that dataset (snapshot, profile, cached results)
+            os.remove(path)
+            meta = _read_meta(existing_id)
+            cols = meta.get("columns")
+            if cols is None:
+                _, _, cols = await run_in_threadpool(_detect_encoding_and_columns, upload_store.csv_path(existing_id))
+            print(f"[main.upload] {file.filename} matches dataset {existing_id}, reusing it")
+            return {"file_id": existing_id, "columns": cols, "rows": meta.get("rows"), "encoding": meta.get("encoding"),
+                    "delimiter": meta.get("delimiter"), "deduplicated": True}
+
+        _refuse_oversized(file_id, os.path.getsize(path))
+        with metrics.timed("encoding_detection"):
+            encoding, delimiter, cols = await run_in_threadpool(_detect_encoding_and_columns, path, sample)
+        snapshot_dir = dataset_service.snapshot_dir_for(UPLOAD_DIR, file_id)
+        try:
+            with metrics.timed("snapshot_build"):
+                manifest = await run_in_threadpool(dataset_service.build_snapshot, path, snapshot_dir, encoding=encoding, delimiter=delimiter)
+            rows = int(manifest["rows"])
+        except Exception as e:
+            print(f"[main.upload] snapshot build failed: {e}")
+            manifest = None
+            rows = streamed_rows
+        if manifest is not None:
+            try:
+                with metrics.timed("profile_build"):
+                    profile = await run_in_threadpool(profile_service.build_profile, snapshot_dir, manifest)
+                cols = _columns_from_profile(profile)
+            except Exception as e:
+                # keep the sample-based column types from detection
+                print(f"[main.upload] profile build failed: {e}")
+        _refuse_oversized(file_id, await run_in_threadpool(upload_store.dataset_size, file_id))
+        meta = {"file_id": file_id, "filename": file.filename, "encoding": encoding, "delimiter": delimiter,
+                "snapshot": os.path.basename(snapshot_dir), "content_hash": content_hash, "rows": rows,
+                "columns": cols}
+        _write_meta(file_id, meta)
+        upload_store.register(file_id, content_hash)
+        return {"file_id": file_id, "columns": cols, "rows": rows, "encoding": encoding, "delimiter": delimiter,
+                "deduplicated": False}
+
+
+def _refuse_oversized(file_id: str, size: int):
+    """413 (and the upload's files removed) for a dataset that alone would exceed the upload store quota."""
+    if upload_store.fits(size):
+        return
+    upload_store.remove(file_id)
+    raise HTTPException(status_code=413, detail=f"Zestaw danych ({size} B) przekracza limit magazynu ({upload_store.max_bytes} B)")
+
+
+def _read_meta(file_id: str):
+    meta_path = os.path.join(UPLOAD_DIR, f"{file_id}.meta.json")
+    if os.path.exists(meta_path):
+        try:
+            with open(meta_path, "r", encoding="utf-8") as mf:
+                return json.load(mf)
+        except Exception:
+            pass
+    return {}
+
+
+def _write_meta(file_id: str, meta: dict):
     meta_path = os.path.join(UPLOAD_DIR, f"{file_id}.meta.json")
-    with open(meta_path, "w", encoding="utf-8") as mf:
+    tmp_path = meta_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as mf:
         json.dump(meta, mf, ensure_ascii=False)
-    try:
-        rows = int(pd.read_csv(path, encoding=encoding, sep=delimiter, engine="python").shape[0])
-    except Exception:
-        rows = -1
-    return {"file_id": file_id, "columns": cols, "rows": rows, "encoding": encoding, "delimiter": delimiter}
+    os.replace(tmp_path, meta_path)
 
 
-@app.post("/analyze")
-async def analyze(payload: dict):
+def _content_hash(file_id: str, csv_path: str, meta: dict) -> str:
+    """sha256 of the uploaded file; computed once and kept in meta for datasets uploaded without it."""
+    if meta.get("content_hash"):
+        return meta["content_hash"]
+    h = hashlib.sha256()
+    with open(csv_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    meta["content_hash"] = h.hexdigest()
     try:
-        print(f"[main.analyze] payload: {payload}")
+        _write_meta(file_id, meta)
     except Exception:
         pass
+    return meta["content_hash"]
+
+
+def _load_snapshot(file_id: str, csv_path: str, meta: dict):
+    """Return (snapshot_dir, manifest); builds the snapshot for datasets uploaded before snapshots existed."""
+    snapshot_dir = dataset_service.snapshot_dir_for(UPLOAD_DIR, file_id)
+    manifest = dataset_service.load_manifest(snapshot_dir)
+    if manifest is None:
+        try:
+            manifest = dataset_service.build_snapshot(csv_path, snapshot_dir, encoding=meta.get("encoding"), delimiter=meta.get("delimiter"))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Błąd odczytu pliku CSV: {e}")
+    return snapshot_dir, manifest
+
+
+@app.get("/datasets/{file_id}/profile")
+async def dataset_profile(file_id: str):
+    with upload_store.lease(file_id):
+        csv_path = os.path.join(UPLOAD_DIR, f"{file_id}.csv")
+        if not upload_store.available(file_id):
+            raise HTTPException(status_code=404, detail="Zestaw danych nie znaleziony")
+        upload_store.touch(file_id)
+        meta = _read_meta(file_id)
+        snapshot_dir, manifest = await run_in_threadpool(_load_snapshot, file_id, csv_path, meta)
+        profile = profile_service.load_profile(snapshot_dir)
+        if profile is None:
+            # datasets uploaded before profiles existed
+            profile = await run_in_threadpool(profile_service.build_profile, snapshot_dir, manifest)
+    return {"file_id": file_id, **profile_service.public_profile(profile)}
+
+
+# one append at a time per dataset; an entry lives while a request holds or waits for it.
+# asyncio locks only order the appends of this process: run one server process per
+# upload dir (the upload store's leases assume the same).
+_append_locks = {}
+
+
+@asynccontextmanager
+async def _append_lock(file_id: str):
+    entry = _append_locks.setdefault(file_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _append_locks[file_id]
+
+
+def _truncate(path: str, size: int):
+    try:
+        os.truncate(path, size)
+    except OSError as e:
+        print(f"[main.append] could not cut {path} back to {size} bytes: {e}")
+
+
+def _append_rows(file_id: str, meta: dict, rows_path: str, upload_hash: str, encoding: str, delimiter: str):
+    """Append the rows of rows_path to the dataset: raw CSV, snapshot, profile, meta (runs in a worker thread).
+
+    The raw CSV grows first and is cut back to its old size if anything fails
+    before the new manifest is published, so the snapshot never holds rows
+    the CSV lacks. Returns (rows_added, changed columns, rebuilt). Columns the
+    new rows leave unchanged keep their data version, so cached results of
+    pairs of such columns stay valid.
+    """
+    csv_path = upload_store.csv_path(file_id)
+    snapshot_dir, manifest = _load_snapshot(file_id, csv_path, meta)
+    old_hash = _content_hash(file_id, csv_path, meta)
+    old_rows = int(manifest["rows"])
+    encoded_path = rows_path + ".enc.tmp"
+    try:
+        # re-encoded first: a character the dataset's encoding lacks fails before anything changes
+        dataset_service.encode_appended_rows(rows_path, encoding, csv_path, meta.get("encoding"), encoded_path)
+        with metrics.timed("append_snapshot"):
+            new_manifest = dataset_service.append_snapshot(rows_path, snapshot_dir, manifest, encoding=encoding, delimiter=delimiter)
+        if new_manifest is not None and int(new_manifest["rows"]) == old_rows:
+            return 0, [], False
+        new_hash = hashlib.sha256(f"{old_hash}:{upload_hash}".encode("ascii")).hexdigest()
+        headers = dataset_service.snapshot_headers(manifest)
+
+        old_size = os.path.getsize(csv_path)
+        try:
+            with open(csv_path, "ab") as out, open(encoded_path, "rb") as src:
+                shutil.copyfileobj(src, out)
+            if new_manifest is None:
+                # a column changes kind: rebuild everything from the grown CSV
+                with metrics.timed("snapshot_build"):
+                    new_manifest = dataset_service.build_snapshot(csv_path, snapshot_dir, encoding=meta.get("encoding"), delimiter=meta.get("delimiter"))
+                update, changed, rebuilt = None, headers, True
+            else:
+                with metrics.timed("append_profile"):
+                    update = profile_service.append_profile(snapshot_dir, new_manifest, old_rows)
+                changed = update[2] if update is not None else headers
+                changed_set = set(changed)
+                for col in new_manifest["columns"]:
+                    col["version"] = new_hash if col["name"] in changed_set else (col.get("version") or old_hash)
+                dataset_service.write_manifest(snapshot_dir, new_manifest)
+                rebuilt = False
+        except BaseException:
+            # nothing is published yet: the appended snapshot rows stay invisible past the old manifest
+            _truncate(csv_path, old_size)
+            raise
+    finally:
+        try:
+            os.remove(encoded_path)
+        except OSError:
+            pass
+
+    # the new rows are published; a profile that cannot be saved is dropped and rebuilt on demand
+    profile = update[0] if update is not None else None
+    try:
+        if update is not None:
+            profile_service.save_profile(snapshot_dir, update[0], update[1])
+        else:
+            with metrics.timed("profile_build"):
+                profile = profile_service.build_profile(snapshot_dir, new_manifest)
+    except Exception as e:
+        print(f"[main.append] profile of {file_id} not saved, dropping it: {e}")
+        profile_service.drop_profile(snapshot_dir)
 
+    rows = int(new_manifest["rows"])
+    meta.update(rows=rows, content_hash=new_hash, appends=int(meta.get("appends", 0)) + 1)
+    if profile is not None:
+        meta["columns"] = _columns_from_profile(profile)
+    _write_meta(file_id, meta)
+    # the stored bytes changed: the old hash must not deduplicate uploads to this dataset any more
+    upload_store.unregister(file_id, old_hash)
+    upload_store.register(file_id, new_hash)
+    return rows - old_rows, changed, rebuilt
+
+
+@app.post("/datasets/{file_id}/append")
+async def append_dataset(file_id: str, file: UploadFile = File(...)):
+    """
+    Dopisuje wiersze (np. kolejnej fali badania) do istniejącego zestawu danych.
+    Nagłówek pliku musi być taki sam jak w zestawie. Migawka i profil kolumn są
+    aktualizowane tylko o nowe wiersze; wyniki w cache tracą ważność tylko dla par
+    z kolumnami, które dostały nowe wartości (changed_columns).
+    """
+    if not file.filename.lower().endswith(".csv"):
+        raise HTTPException(status_code=400, detail="Tylko pliki CSV są wspierane")
+    with upload_store.lease(file_id):
+        if not upload_store.available(file_id):
+            raise HTTPException(status_code=404, detail="Zestaw danych nie znaleziony")
+        rows_path = os.path.join(UPLOAD_DIR, f"{file_id}.append.{uuid.uuid4()}.tmp")
+        async with _append_lock(file_id):
+            try:
+                with metrics.timed("upload_write"):
+                    upload_hash, _, sample = await _stream_upload_to_disk(file, rows_path)
+                meta = _read_meta(file_id)
+                detected = encoding_service.detect(sample, truncated=len(sample) >= SNIFF_BYTES)
+                delimiter = meta.get("delimiter") or detected["delimiter"]
+                if detected["delimiter"] != delimiter:
+                    raise HTTPException(status_code=400, detail=f"Separator pliku ({detected['delimiter']!r}) jest inny niż w zestawie danych ({delimiter!r})")
+                try:
+                    rows_added, changed, rebuilt = await run_in_threadpool(_append_rows, file_id, meta, rows_path, upload_hash,
+                                                                           detected["encoding"], delimiter)
+                except ValueError as e:
+                    raise HTTPException(status_code=400, detail=str(e))
+            finally:
+                try:
+                    os.remove(rows_path)
+                except OSError:
+                    pass
+    upload_store.touch(file_id)
+    print(f"[main.append] {file_id}: +{rows_added} rows, {len(changed)} changed columns{' (rebuilt)' if rebuilt else ''}")
+    return {"file_id": file_id, "rows": meta.get("rows"), "rows_added": rows_added, "changed_columns": changed,
+            "rebuilt": rebuilt, "columns": meta.get("columns")}
+
+
+def _prepare_dataset(file_id: str, payload: dict):
+    """Engine choice + snapshot of an uploaded dataset, shared by single and batch analyses."""
+    engine = str(payload.get("engine") or ANALYSIS_ENGINE).lower()
+    if engine not in ENGINES:
+        raise HTTPException(status_code=400, detail=f"Nieznany silnik analizy: {engine}. Dostępne: {list(ENGINES)}")
+    # held until the analysis is over so the sweeper leaves the dataset alone; released
+    # here on a refused request, by the endpoint (or job) once the analysis ends otherwise
+    lease = upload_store.lease(file_id)
+    try:
+        csv_path = os.path.join(UPLOAD_DIR, f"{file_id}.csv")
+        if not upload_store.available(file_id):
+            raise HTTPException(status_code=404, detail="Zestaw danych nie znaleziony")
+        try:
+            resampling = resampling_service.options(payload.get("resampling"))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        upload_store.touch(file_id)
+        meta = _read_meta(file_id)
+        snapshot_dir, manifest = _load_snapshot(file_id, csv_path, meta)
+        streaming = bool(payload["streaming"]) if payload.get("streaming") is not None else streaming_service.use_streaming(manifest)
+        if resampling and streaming:
+            raise HTTPException(status_code=400, detail="Resampling nie jest dostępny w trybie strumieniowym")
+    except BaseException:
+        lease.release()
+        raise
+    return {
+        "lease": lease,
+        "file_id": file_id,
+        "engine": engine,
+        "content_hash": _content_hash(file_id, csv_path, meta),
+        "meta": meta,
+        "snapshot_dir": snapshot_dir,
+        "manifest": manifest,
+        "headers": dataset_service.snapshot_headers(manifest),
+        # backward compatibility: plot as base64 in the JSON instead of only a /plots reference
+        "inline_plot": bool(payload.get("inline_plot", False)),
+        # out-of-core computation (no plot) for datasets too large to load; {"streaming": true/false} overrides
+        "streaming": streaming,
+        # permutation p-value + bootstrap CI on request: {"resampling": true | {"resamples", "seed", "confidence"}}
+        "resampling": resampling,
+    }
+
+
+@contextmanager
+def _release_on_error(dataset: dict):
+    """Give the dataset lease back if the request is refused after _prepare_dataset."""
+    try:
+        yield
+    except BaseException:
+        dataset["lease"].release()
+        raise
+
+
+def _resolve_col(dataset: dict, sent):
+    return dataset_service.resolve_column(dataset["manifest"], sent)
+
+
+def _pair_ctx(dataset: dict, actual_x: str, actual_y: str):
+    positions = dataset_service.column_index(dataset["manifest"])["exact"]
+    return dict(dataset, actual_x=actual_x, actual_y=actual_y,
+                actual_x_index=positions[actual_x] + 1, actual_y_index=positions[actual_y] + 1)
+
+
+def _prepare_analysis(payload: dict):
     file_id = payload.get("file_id")
     x = payload.get("x")
     y = payload.get("y")
     if not file_id or (x is None) or (y is None):
         raise HTTPException(status_code=400, detail="file_id, x i y są wymagane")
-    csv_path = os.path.join(UPLOAD_DIR, f"{file_id}.csv")
-    meta_path = os.path.join(UPLOAD_DIR, f"{file_id}.meta.json")
-    if not os.path.exists(csv_path):
-        raise HTTPException(status_code=404, detail="Zestaw danych nie znaleziony")
-    encoding = None
-    delimiter = None
-    if os.path.exists(meta_path):
+    dataset = _prepare_dataset(file_id, payload)
+
+    with _release_on_error(dataset):
+        headers = dataset["headers"]
+        actual_x = _resolve_col(dataset, x)
+        actual_y = _resolve_col(dataset, y)
+        if actual_x is None or actual_y is None:
+            raise HTTPException(status_code=400, detail=f"Nie można znaleźć kolumn: {x}, {y}. Dostępne kolumny: {headers}")
+        return _pair_ctx(dataset, actual_x, actual_y)
+
+
+async def _run_r_on_snapshot(ctx: dict):
+    """Run the R analysis (on a pool worker) on the two snapshot columns, in memory or via a projection CSV."""
+    if R_INPUT != "csv":
+        res = await r_pool.run("run_analysis_columns", ctx["snapshot_dir"], ctx["actual_x"], ctx["actual_y"],
+                               plots_dir=plot_store.incoming_dir)
+        return _record_r_stats(res)
+    projection = ctx.get("projection")
+    if projection is not None:
+        # batch: one projection with every requested column, written once
+        path, names = projection
+        return await _run_r(path, names.index(ctx["actual_x"]) + 1, names.index(ctx["actual_y"]) + 1)
+    fd, tmp_path = tempfile.mkstemp(prefix="proj_", suffix=".csv")
+    os.close(fd)
+    try:
+        with metrics.timed("projection_write"):
+            await run_in_threadpool(dataset_service.write_projected_csv, ctx["snapshot_dir"], ctx["manifest"], [ctx["actual_x"], ctx["actual_y"]], tmp_path)
+        return await _run_r(tmp_path, 1, 2)
+    finally:
         try:
-            with open(meta_path, "r", encoding="utf-8") as mf:
-                meta = json.load(mf)
-                encoding = meta.get("encoding")
-                delimiter = meta.get("delimiter")
-        except Exception:
-            encoding = None
-            delimiter = None
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+async def _run_r(path: str, x_index: int, y_index: int):
+    res = await r_pool.run("run_analysis", path, x_index, y_index, plots_dir=plot_store.incoming_dir, encoding="utf-8", delimiter=",")
+    return _record_r_stats(res)
+
+
+def _record_r_stats(res: dict):
+    # stages measured inside the worker process (conversion, R call, R's own read/tests/plot)
+    metrics.record_timings(res.pop("timings", None))
+    retries = res.pop("encoding_retries", 0)
+    if retries:
+        metrics.inc("r_encoding_retries", retries, "R calls repeated with the next candidate encoding")
+    return res
+
 
-    # find headers (try a few encodings)
+def _run_python_on_snapshot(ctx: dict):
+    x_values = dataset_service.load_analysis_column(ctx["snapshot_dir"], ctx["manifest"], ctx["actual_x"])
+    y_values = dataset_service.load_analysis_column(ctx["snapshot_dir"], ctx["manifest"], ctx["actual_y"])
+    return py_engine.run_analysis(x_values, y_values)
+
+
+async def _run_engine(ctx: dict):
+    if ctx.get("streaming"):
+        return await run_in_threadpool(streaming_service.run_analysis, ctx["snapshot_dir"], ctx["manifest"], ctx["actual_x"], ctx["actual_y"])
+    if ctx["engine"] == "python":
+        if ctx.get("parallel"):
+            args = (ctx["snapshot_dir"], ctx["content_hash"], ctx["actual_x"], ctx["actual_y"])
+            if batch_service.PY_POOL_SIZE <= 1:
+                # one core: a process pool only adds IPC, keep the column cache in this process
+                return await run_in_threadpool(batch_service.run_python_pair, *args)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(batch_service.executor(), batch_service.run_python_pair, *args)
+        return await run_in_threadpool(_run_python_on_snapshot, ctx)
+    return await _run_r_on_snapshot(ctx)
+
+
+def _engine_version(engine: str) -> str:
+    # both engines read the normality settings from the environment
+    if engine in ("python", "streaming"):
+        return f"{py_engine.ENGINE_VERSION}:{py_engine.assumption_settings()}"
+    return f"{r_interface.script_version()}:{py_engine.assumption_settings()}"
+
+
+def _take_plot_bytes(res: dict):
+    """Read the PNG an engine wrote into the incoming dir and drop the file; the plot store keeps its own copy."""
+    if not res.get("plot_path"):
+        return None
+    path = os.path.join(plot_store.incoming_dir, os.path.basename(res["plot_path"]))
     try:
-        headers = None
-        enc_to_try = []
-        if encoding:
-            enc_to_try.append(encoding)
-        enc_to_try += ["utf-8", "cp1250", "latin1", "iso-8859-2", "utf-16"]
-
-        used_enc_for_header = None
-        for e in enc_to_try:
-            try:
-                df_header = pd.read_csv(csv_path, nrows=0, encoding=e, sep=delimiter or None, engine="python")
-                headers = list(df_header.columns)
-                used_enc_for_header = e
-                break
-            except Exception:
-                continue
+        with open(path, "rb") as pf:
+            data = pf.read()
+    except Exception:
+        return None
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    return data
+
+
+def _data_version(ctx: dict) -> str:
+    """Cache key part for the pair's data; equals the content hash until an append changes one of the columns."""
+    vx = dataset_service.column_version(ctx["manifest"], ctx["actual_x"], ctx["content_hash"])
+    vy = dataset_service.column_version(ctx["manifest"], ctx["actual_y"], ctx["content_hash"])
+    return vx if vx == vy else f"{vx}:{vy}"
+
+
+async def _analyze_cached(ctx: dict):
+    """Return (result, plot_bytes, cached) for the resolved pair, running the engine only on a cache miss.
+
+    result["plot_id"] references the plot in the plot store (None without a plot).
+    """
+    engine = "streaming" if ctx.get("streaming") else ctx["engine"]
+    key = make_cache_key(_data_version(ctx), ctx["actual_x"], ctx["actual_y"], engine, _engine_version(engine))
+    hit = await result_cache.get_async(key)
+    if hit is not None:
+        res, plot_bytes = hit
+        cached = True
+    else:
+        with metrics.timed(f"engine_{engine}"):
+            res = await _run_engine(ctx)
+        plot_bytes = await run_in_threadpool(_take_plot_bytes, res)
+        res = {"recommended_test": res.get("recommended_test"), "stats": res.get("stats"), "assumptions": res.get("assumptions")}
+        await result_cache.put_async(key, res, plot_bytes)
+        cached = False
+    metrics.inc("analyses", 1, "Analysed pairs by engine and result cache outcome", engine=engine, cached=str(cached).lower())
+    if ctx.get("resampling"):
+        res = dict(res, resampling=await _resampling_cached(ctx, res.get("recommended_test")))
+    plot_id = None
+    if plot_bytes:
+        with metrics.timed("plot_store_put"):
+            plot_id = await run_in_threadpool(plot_store.put, plot_bytes)
+    return dict(res, plot_id=plot_id), plot_bytes, cached
+
 
-        if headers is None:
-            # fallback: read first line as bytes
-            with open(csv_path, "rb") as f:
-                sample = f.read(2000)
-            det = chardet.detect(sample) if chardet else {"encoding": None}
-            enc_try = det.get("encoding") or "utf-8"
-            text = sample.decode(enc_try, errors="replace")
-            if delimiter:
-                hdr_line = text.splitlines()[0]
-                headers = hdr_line.split(delimiter)
+async def _resampling_cached(ctx: dict, recommended_test: str):
+    """Permutation/bootstrap results for the pair, cached next to the analysis result."""
+    opts = ctx["resampling"]
+    # resamples are drawn over all rows, so appended rows count even where the pair has none
+    key = make_cache_key(f"{_data_version(ctx)}:{ctx['manifest']['rows']}", ctx["actual_x"], ctx["actual_y"], "resampling",
+                         resampling_service.cache_version(opts, recommended_test))
+    hit = await result_cache.get_async(key)
+    if hit is not None:
+        return dict(hit[0], cached=True)
+    args = (ctx["snapshot_dir"], ctx["content_hash"], ctx["actual_x"], ctx["actual_y"], recommended_test, opts)
+    try:
+        with metrics.timed("resampling"):
+            if batch_service.PY_POOL_SIZE <= 1:
+                out = await run_in_threadpool(resampling_service.resample, *args)
             else:
-                guessed = None
-                for d in [",", ";", "\t", "|"]:
-                    if d in text.splitlines()[0]:
-                        guessed = d
-                        break
-                hdr_line = text.splitlines()[0]
-                headers = hdr_line.split(guessed or ",")
-
-        def _safe_name_local(s: str) -> str:
-            nk = unicodedata.normalize("NFKD", s)
-            return nk.encode("ASCII", "ignore").decode("ASCII")
-
-        def resolve_col(sent):
-            for h in headers:
-                if h == sent:
-                    return h
-            for h in headers:
-                if _safe_name_local(h) == str(sent):
-                    return h
-            for h in headers:
-                if h.lower() == str(sent).lower():
-                    return h
-            return None
-
-        actual_x = resolve_col(x)
-        actual_y = resolve_col(y)
-        if actual_x is None or actual_y is None:
-            raise HTTPException(status_code=400, detail=f"Nie można znaleźć kolumn: {x}, {y}. Dostępne kolumny: {headers}")
+                out = await run_in_threadpool(resampling_service.resample, *args,
+                                              executor=batch_service.executor(), workers=batch_service.PY_POOL_SIZE)
+    except ValueError as e:
+        # no resampling scheme for this test (e.g. a one-row contingency table)
+        return {"error": str(e)}
+    await result_cache.put_async(key, out, None)
+    return dict(out, cached=False)
 
-        try:
-            actual_x_index = headers.index(actual_x) + 1
-            actual_y_index = headers.index(actual_y) + 1
-        except Exception:
-            actual_x_index = None
-            actual_y_index = None
 
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Błąd odczytu nagłówka CSV: {e}")
+def _plot_refs(ctx: dict, res: dict, plot_bytes) -> dict:
+    """Plot reference (served by GET /plots/{plot_id}); inline base64 only when the request asks for it."""
+    plot_id = res.get("plot_id")
+    out = {"plot_id": plot_id, "plot_url": f"/plots/{plot_id}" if plot_id else None}
+    if ctx.get("inline_plot"):
+        out["plot_base64"] = _plot_base64(plot_bytes)
+    return out
+
+
+def _plot_base64(plot_bytes) -> str:
+    # Always return a base64 image: real plot if available, else transparent placeholder
+    if plot_bytes:
+        with metrics.timed("plot_base64"):
+            return base64.b64encode(plot_bytes).decode("ascii")
+    return TRANSPARENT_PNG_BASE64
+
+
+@app.get("/upload-store/stats")
+async def upload_store_stats():
+    return upload_store.stats()
+
+
+@app.get("/plot-store/stats")
+async def plot_store_stats():
+    return plot_store.stats()
+
+
+@app.get("/plots/{plot_id}")
+async def get_plot(plot_id: str, request: Request):
+    plot_id = plot_id[:-4] if plot_id.endswith(".png") else plot_id
+    path = plot_store.get_path(plot_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Wykres nie znaleziony")
+    # content-addressed: the id is the ETag and the resource never changes
+    headers = {"ETag": f'"{plot_id}"', "Cache-Control": "public, max-age=31536000, immutable"}
+    inm = request.headers.get("if-none-match", "")
+    if inm.strip() == "*" or f'"{plot_id}"' in [t.strip().removeprefix("W/") for t in inm.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type="image/png", headers=headers)
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return result_cache.stats()
+
+
+def _collect_metrics():
+    """Scrape-time samples from the stats() of the caches, stores, job queue and R pool."""
+    cache, plots, uploads = result_cache.stats(), plot_store.stats(), upload_store.stats()
+    queue, pool = jobs.stats(), r_pool.stats()
+    return [
+        ("result_cache_lookups_total", "counter", "Result cache lookups",
+         [({"result": "hit"}, cache["hits"]), ({"result": "disk_hit"}, cache["disk_hits"]),
+          ({"result": "miss"}, cache["misses"])]),
+        ("result_cache_entries", "gauge", "Results held in memory", cache["entries"]),
+        ("result_cache_bytes", "gauge", "Bytes of results held in memory", cache["bytes"]),
+        ("result_cache_disk_bytes", "gauge", "Bytes of the result cache disk tier (last sweep)", cache["disk_bytes"]),
+        ("plot_store_lookups_total", "counter", "Plot store lookups",
+         [({"result": "hit"}, plots["hits"]), ({"result": "miss"}, plots["misses"])]),
+        ("plot_store_bytes", "gauge", "Bytes of stored plots", plots["bytes"]),
+        ("upload_store_bytes", "gauge", "Bytes of stored uploads (last sweep)", uploads["bytes"]),
+        ("upload_dedup_hits_total", "counter", "Uploads answered with an existing dataset", uploads["dedup_hits"]),
+        ("job_queue_depth", "gauge", "Jobs waiting for a runner", queue["queued"]),
+        ("jobs", "gauge", "Jobs by status", [({"status": k}, v) for k, v in sorted(queue["jobs"].items())]),
+        ("r_pool_idle_workers", "gauge", "Idle R workers", pool["idle"]),
+        ("r_pool_waiting", "gauge", "Analyses waiting for an R worker", pool["waiting"]),
+        ("r_pool_recycled_total", "counter", "R workers replaced", pool["recycled"]),
+    ]
+
+
+metrics.add_collector(_collect_metrics)
+
+
+@app.get("/ready")
+async def ready():
+    """
+    Gotowość do pracy: 200 dopiero po rozgrzaniu (importy, R załadowany w każdym procesie puli,
+    próbna analiza), wcześniej lub po błędzie 503 ze stanem.
+    """
+    body = dict(_readiness, ready=_readiness["status"] == "ready")
+    if not body["ready"]:
+        return JSONResponse(status_code=503, content=body)
+    return body
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Metryki w formacie tekstowym Prometheusa: czasy etapów, trafienia cache, kolejki.
+    """
+    return PlainTextResponse(metrics.exposition(), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/analyze")
+async def analyze(payload: dict):
+    try:
+        print(f"[main.analyze] payload: {payload}")
+    except Exception:
+        pass
+
+    ctx = await run_in_threadpool(_prepare_analysis, payload)
 
     try:
-        res = r_interface.run_analysis(csv_path, actual_x_index, actual_y_index, plots_dir=PLOTS_DIR, encoding=encoding, delimiter=delimiter)
+        res, plot_bytes, cached = await _analyze_cached(ctx)
     except Exception as e:
         import traceback
-        tb = traceback.format_exc()
+        tb = getattr(e, "remote_traceback", "") or traceback.format_exc()
         print("[main.analyze] Exception in run_analysis:\n", tb)
         raise HTTPException(status_code=500, detail={"error": str(e), "traceback": tb})
+    finally:
+        ctx["lease"].release()
 
-    # Always return a base64 image: real plot if available, else transparent placeholder
-    plot_base64 = None
-    if res.get("plot_path"):
-        fname = res["plot_path"]
-        full_path = os.path.join(PLOTS_DIR, fname)
-        try:
-            with open(full_path, "rb") as pf:
-                plot_base64 = base64.b64encode(pf.read()).decode("ascii")
-        except Exception:
-            plot_base64 = TRANSPARENT_PNG_BASE64
-    else:
-        plot_base64 = TRANSPARENT_PNG_BASE64
+    return _analyze_response(ctx, res, plot_bytes, cached)
 
+
+def _analyze_response(ctx: dict, res: dict, plot_bytes, cached: bool):
+    meta = ctx["meta"]
     return {
         "recommended_test": res.get("recommended_test"),
         "stats": res.get("stats"),
-        "plot_base64": plot_base64,
-        "actual_x": actual_x,
-        "actual_y": actual_y,
-        "actual_x_index": actual_x_index,
-        "actual_y_index": actual_y_index,
-        "used_encoding": encoding,
-        "used_delimiter": delimiter,
-        "used_header_encoding": used_enc_for_header if 'used_enc_for_header' in locals() else None
+        "assumptions": res.get("assumptions"),
+        "resampling": res.get("resampling"),
+        **_plot_refs(ctx, res, plot_bytes),
+        "actual_x": ctx["actual_x"],
+        "actual_y": ctx["actual_y"],
+        "actual_x_index": ctx["actual_x_index"],
+        "actual_y_index": ctx["actual_y_index"],
+        "used_encoding": meta.get("encoding"),
+        "used_delimiter": meta.get("delimiter"),
+        "used_header_encoding": meta.get("encoding"),
+        "used_engine": ctx["engine"],
+        "streaming": ctx["streaming"],
+        "cached": cached,
     }
 
 
-@app.post("/export")
-async def export_excel(payload: dict):
-    """
-    Wykonuje analizę i zwraca wygenerowany plik Excel jako StreamingResponse.
-    """
-    try:
-        print(f"[main.export] payload: {payload}")
-    except Exception:
-        pass
+def _batch_item(index: int, ctx: dict, res=None, plot_bytes=None, cached=False, error=None):
+    item = {"index": index, "x": ctx["actual_x"], "y": ctx["actual_y"]}
+    if error is not None:
+        item["error"] = error
+        return item
+    item.update({"recommended_test": res.get("recommended_test"), "stats": res.get("stats"),
+                 "assumptions": res.get("assumptions"), "resampling": res.get("resampling"), "cached": cached})
+    item.update(_plot_refs(ctx, res, plot_bytes))
+    return item
 
+
+def _plan_batch(payload: dict):
+    """Validate a batch request and return (dataset, pair contexts)."""
     file_id = payload.get("file_id")
-    x = payload.get("x")
-    y = payload.get("y")
-    if not file_id or (x is None) or (y is None):
-        raise HTTPException(status_code=400, detail="file_id, x i y są wymagane")
-    
-    csv_path = os.path.join(UPLOAD_DIR, f"{file_id}.csv")
-    meta_path = os.path.join(UPLOAD_DIR, f"{file_id}.meta.json")
-    if not os.path.exists(csv_path):
-        raise HTTPException(status_code=404, detail="Zestaw danych nie znaleziony")
-    
-    encoding = None
-    delimiter = None
-    if os.path.exists(meta_path):
+    if not file_id:
+        raise HTTPException(status_code=400, detail="file_id jest wymagane")
+    dataset = _prepare_dataset(file_id, payload)
+    with _release_on_error(dataset):
+        headers = dataset["headers"]
         try:
-            with open(meta_path, "r", encoding="utf-8") as mf:
-                meta = json.load(mf)
-                encoding = meta.get("encoding")
-                delimiter = meta.get("delimiter")
-        except Exception:
-            encoding = None
-            delimiter = None
+            specs = batch_service.pair_specs(payload, headers)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if not specs:
+            raise HTTPException(status_code=400, detail="Podaj listę par (pairs) albo kolumnę y")
 
-    # find headers (try a few encodings)
-    try:
-        headers = None
-        enc_to_try = []
-        if encoding:
-            enc_to_try.append(encoding)
-        enc_to_try += ["utf-8", "cp1250", "latin1", "iso-8859-2", "utf-16"]
-
-        used_enc_for_header = None
-        for e in enc_to_try:
-            try:
-                df_header = pd.read_csv(csv_path, nrows=0, encoding=e, sep=delimiter or None, engine="python")
-                headers = list(df_header.columns)
-                used_enc_for_header = e
-                break
-            except Exception:
+        ctxs = []
+        missing = []
+        for x, y in specs:
+            actual_x, actual_y = _resolve_col(dataset, x), _resolve_col(dataset, y)
+            if actual_x is None or actual_y is None:
+                missing.append([x, y])
+                continue
+            if not payload.get("pairs") and actual_x == actual_y:
                 continue
+            ctxs.append(_pair_ctx(dataset, actual_x, actual_y))
+        if missing:
+            raise HTTPException(status_code=400, detail=f"Nie można znaleźć kolumn: {missing}. Dostępne kolumny: {headers}")
+        if len(ctxs) > batch_service.BATCH_MAX_PAIRS:
+            raise HTTPException(status_code=400, detail=f"Za dużo par: {len(ctxs)} (limit {batch_service.BATCH_MAX_PAIRS})")
+        return dataset, ctxs
 
-        if headers is None:
-            # fallback: read first line as bytes
-            with open(csv_path, "rb") as f:
-                sample = f.read(2000)
-            det = chardet.detect(sample) if chardet else {"encoding": None}
-            enc_try = det.get("encoding") or "utf-8"
-            text = sample.decode(enc_try, errors="replace")
-            if delimiter:
-                hdr_line = text.splitlines()[0]
-                headers = hdr_line.split(delimiter)
-            else:
-                guessed = None
-                for d in [",", ";", "\t", "|"]:
-                    if d in text.splitlines()[0]:
-                        guessed = d
-                        break
-                hdr_line = text.splitlines()[0]
-                headers = hdr_line.split(guessed or ",")
-
-        def _safe_name_local(s: str) -> str:
-            nk = unicodedata.normalize("NFKD", s)
-            return nk.encode("ASCII", "ignore").decode("ASCII")
-
-        def resolve_col(sent):
-            for h in headers:
-                if h == sent:
-                    return h
-            for h in headers:
-                if _safe_name_local(h) == str(sent):
-                    return h
-            for h in headers:
-                if h.lower() == str(sent).lower():
-                    return h
-            return None
-
-        actual_x = resolve_col(x)
-        actual_y = resolve_col(y)
-        if actual_x is None or actual_y is None:
-            raise HTTPException(status_code=400, detail=f"Nie można znaleźć kolumn: {x}, {y}. Dostępne kolumny: {headers}")
 
+class _BatchRun:
+    """Runs the pairs of a planned batch concurrently; iterate results with as_completed()."""
+
+    def __init__(self, dataset: dict, ctxs: list):
+        self.dataset = dataset
+        self.ctxs = ctxs
+        self.projection_path = None
+        self.tasks = []
+        self.started = time.time()
+
+    async def start(self):
+        if self.dataset["streaming"]:
+            pass  # out-of-core pairs read the snapshot themselves
+        elif self.dataset["engine"] == "r" and R_INPUT == "csv":
+            names = list(dict.fromkeys([c["actual_x"] for c in self.ctxs] + [c["actual_y"] for c in self.ctxs]))
+            fd, self.projection_path = tempfile.mkstemp(prefix="proj_", suffix=".csv")
+            os.close(fd)
+            with metrics.timed("projection_write"):
+                await run_in_threadpool(dataset_service.write_projected_csv, self.dataset["snapshot_dir"], self.dataset["manifest"], names, self.projection_path)
+            for c in self.ctxs:
+                c["projection"] = (self.projection_path, names)
+        elif self.dataset["engine"] == "python":
+            for c in self.ctxs:
+                c["parallel"] = True
+        self.tasks = [asyncio.ensure_future(self._run_one(i, c)) for i, c in enumerate(self.ctxs)]
+
+    async def _run_one(self, index: int, ctx: dict):
         try:
-            actual_x_index = headers.index(actual_x) + 1
-            actual_y_index = headers.index(actual_y) + 1
-        except Exception:
-            actual_x_index = None
-            actual_y_index = None
+            res, plot_bytes, cached = await _analyze_cached(ctx)
+            return _batch_item(index, ctx, res, plot_bytes, cached)
+        except Exception as e:
+            print(f"[main.analyze_batch] pair {ctx['actual_x']} ~ {ctx['actual_y']} failed: {e}")
+            return _batch_item(index, ctx, error=str(e))
+
+    def as_completed(self):
+        return asyncio.as_completed(self.tasks)
+
+    def summary(self, failed: int) -> dict:
+        return {"done": True, "count": len(self.tasks), "failed": failed, "elapsed_s": round(time.time() - self.started, 3)}
+
+    def close(self):
+        for t in self.tasks:
+            t.cancel()
+        if self.projection_path:
+            try:
+                os.remove(self.projection_path)
+            except OSError:
+                pass
+            self.projection_path = None
+        self.dataset["lease"].release()
+
 
-    except HTTPException:
+@app.post("/analyze/batch")
+async def analyze_batch(payload: dict):
+    """
+    Analiza wielu par kolumn jednym żądaniem: {"file_id", "pairs": [[x, y], ...]}
+    albo {"file_id", "y": kolumna, "against": "all" | [kolumny]}.
+    Wyniki są strumieniowane (NDJSON) w kolejności zakończenia; "stream": false zwraca jedną listę.
+    """
+    dataset, ctxs = await run_in_threadpool(_plan_batch, payload)
+    print(f"[main.analyze_batch] file_id={dataset['file_id']} engine={dataset['engine']} pairs={len(ctxs)}")
+    run = _BatchRun(dataset, ctxs)
+    try:
+        await run.start()
+    except Exception:
+        run.close()
         raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Błąd odczytu nagłówka CSV: {e}")
 
+    if not payload.get("stream", True):
+        try:
+            results = await asyncio.gather(*run.tasks)
+        finally:
+            run.close()
+        return {"file_id": dataset["file_id"], "engine": dataset["engine"], "results": results,
+                "elapsed_s": round(time.time() - run.started, 3)}
+
+    async def lines():
+        failed = 0
+        try:
+            for fut in run.as_completed():
+                item = await fut
+                failed += 1 if "error" in item else 0
+                yield json.dumps(item, ensure_ascii=False, default=str) + "\n"
+            yield json.dumps(run.summary(failed)) + "\n"
+        finally:
+            # client went away or everything finished
+            run.close()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+def _plan_matrix(payload: dict):
+    """Validate a matrix request and return (dataset, resolved columns, method)."""
+    file_id = payload.get("file_id")
+    if not file_id:
+        raise HTTPException(status_code=400, detail="file_id jest wymagane")
+    dataset = _prepare_dataset(file_id, payload)
+    with _release_on_error(dataset):
+        method = str(payload.get("method") or "pearson").lower()
+        if method not in matrix_service.MATRIX_METHODS:
+            raise HTTPException(status_code=400, detail=f"Nieznana metoda korelacji: {method}. Dostępne: {list(matrix_service.MATRIX_METHODS)}")
+        sent = payload.get("columns") or dataset["headers"]
+        if not isinstance(sent, list):
+            raise HTTPException(status_code=400, detail="Pole 'columns' musi być listą kolumn")
+        names, missing = [], []
+        for col in sent:
+            actual = _resolve_col(dataset, col)
+            if actual is None:
+                missing.append(col)
+            elif actual not in names:
+                names.append(actual)
+        if missing:
+            raise HTTPException(status_code=400, detail=f"Nie można znaleźć kolumn: {missing}. Dostępne kolumny: {dataset['headers']}")
+        if len(names) < 2:
+            raise HTTPException(status_code=400, detail="Macierz wymaga co najmniej dwóch kolumn")
+        if len(names) > matrix_service.MATRIX_MAX_COLUMNS:
+            raise HTTPException(status_code=400, detail=f"Za dużo kolumn: {len(names)} (limit {matrix_service.MATRIX_MAX_COLUMNS})")
+        return dataset, names, method
+
+
+def _matrix_cache_key(dataset: dict, names: list, method: str, kind: str, version: str) -> str:
+    # like _data_version: an append that leaves every selected column unchanged keeps the entry
+    versions = [dataset_service.column_version(dataset["manifest"], n, dataset["content_hash"]) for n in names]
+    data_version = versions[0] if len(set(versions)) == 1 else hashlib.sha256(":".join(versions).encode("ascii")).hexdigest()
+    return make_cache_key(data_version, "\x1f".join(names), method, kind, version)
+
+
+async def _matrix_plot(dataset: dict, names: list, method: str, res: dict):
+    """Heatmap of the combined matrix, drawn once by R (corrplot) and cached; returns (png bytes, error)."""
+    key = _matrix_cache_key(dataset, names, method, "matrix_plot", f"{matrix_service.MATRIX_VERSION}:{r_interface.script_version()}")
+    hit = await result_cache.get_async(key)
+    if hit is not None and hit[1]:
+        return hit[1], None
+    values, p_values, columns = matrix_service.heatmap_input(res)
     try:
-        res = r_interface.run_analysis(csv_path, actual_x_index, actual_y_index, plots_dir=PLOTS_DIR, encoding=encoding, delimiter=delimiter)
+        with metrics.timed("matrix_plot"):
+            out = await r_pool.run("render_association_matrix", values, p_values, columns, plots_dir=plot_store.incoming_dir)
     except Exception as e:
-        import traceback
-        tb = traceback.format_exc()
-        print("[main.export] Exception in run_analysis:\n", tb)
-        raise HTTPException(status_code=500, detail={"error": str(e), "traceback": tb})
+        print(f"[main.analyze_matrix] heatmap failed: {e}")
+        return None, str(e)
+    plot_bytes = await run_in_threadpool(_take_plot_bytes, _record_r_stats(out))
+    if not plot_bytes:
+        return None, "R nie zapisał mapy ciepła"
+    await result_cache.put_async(key, {"plot": True}, plot_bytes)
+    return plot_bytes, None
 
-    # Get plot as base64
-    plot_base64 = None
-    if res.get("plot_path"):
-        fname = res["plot_path"]
-        full_path = os.path.join(PLOTS_DIR, fname)
-        try:
-            with open(full_path, "rb") as pf:
-                plot_base64 = base64.b64encode(pf.read()).decode("ascii")
-        except Exception:
-            plot_base64 = TRANSPARENT_PNG_BASE64
-    else:
-        plot_base64 = TRANSPARENT_PNG_BASE64
 
-    # Prepare result for Excel generation
-    result = {
+@app.post("/analyze/matrix")
+async def analyze_matrix(payload: dict):
+    """
+    Macierz powiązań wszystkich par wybranych kolumn jednym żądaniem:
+    {"file_id", "columns": [...] (domyślnie wszystkie), "method": "pearson" | "spearman", "plot": true}.
+    Pary liczbowe: r Pearsona i rho Spearmana, pary kategoryczne: V Craméra, pary mieszane: eta,
+    każda miara z macierzą p-wartości. "association" łączy je w jedną macierz (dla liczbowych
+    wybrana metoda); "plot": true rysuje z niej jedną mapę ciepła (corrplot w R).
+    """
+    dataset, names, method = await run_in_threadpool(_plan_matrix, payload)
+    started = time.time()
+    try:
+        key = _matrix_cache_key(dataset, names, method, "matrix", matrix_service.MATRIX_VERSION)
+        hit = await result_cache.get_async(key)
+        if hit is not None:
+            res, cached = hit[0], True
+        else:
+            try:
+                with metrics.timed("matrix"):
+                    res = await run_in_threadpool(matrix_service.compute, dataset["snapshot_dir"], dataset["manifest"], names, method)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            await result_cache.put_async(key, res, None)
+            cached = False
+        print(f"[main.analyze_matrix] file_id={dataset['file_id']} columns={len(names)} method={method} cached={cached}")
+
+        plot_bytes, plot_error = None, None
+        if payload.get("plot"):
+            plot_bytes, plot_error = await _matrix_plot(dataset, names, method, res)
+    finally:
+        dataset["lease"].release()
+    plot_id = None
+    if plot_bytes:
+        with metrics.timed("plot_store_put"):
+            plot_id = await run_in_threadpool(plot_store.put, plot_bytes)
+    out = {"file_id": dataset["file_id"], **res, "plot_id": plot_id, "plot_url": f"/plots/{plot_id}" if plot_id else None,
+           "cached": cached, "elapsed_s": round(time.time() - started, 3)}
+    if plot_error:
+        out["plot_error"] = plot_error
+    if dataset["inline_plot"]:
+        out["plot_base64"] = _plot_base64(plot_bytes)
+    return out
+
+
+def _excel_result(ctx: dict, res: dict):
+    return {
         "recommended_test": res.get("recommended_test"),
         "stats": res.get("stats"),
-        "plot_base64": plot_base64,
-        "actual_x": actual_x,
-        "actual_y": actual_y,
+        "resampling": res.get("resampling"),
+        "actual_x": ctx["actual_x"],
+        "actual_y": ctx["actual_y"],
     }
 
+
+def _excel_headers(file_id: str, actual_x: str, actual_y: str):
+    return _attachment_headers(f"analysis_{file_id}_{actual_x}_vs_{actual_y}.xlsx", file_id)
+
+
+def _attachment_headers(filename: str, file_id: str):
+    # Clean filename
+    filename = filename.replace(" ", "_").replace("/", "_").replace("\\", "_")
+
+    # Create ASCII-safe fallback filename
+    filename_ascii = _safe_name(filename)
+    if not filename_ascii.endswith('.xlsx'):
+        filename_ascii = filename_ascii + '.xlsx'
+    # Ensure filename is not empty after ASCII conversion
+    if not filename_ascii or filename_ascii == '.xlsx':
+        filename_ascii = f"analysis_{file_id}.xlsx"
+
+    # Use RFC 2231 encoding for non-ASCII characters
+    filename_encoded = quote(filename.encode('utf-8'), safe='')
+
+    # Provide both ASCII fallback and UTF-8 encoded filename
+    return {
+        "Content-Disposition": f'attachment; filename="{filename_ascii}"; filename*=UTF-8\'\'{filename_encoded}'
+    }
+
+
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+@app.post("/export")
+async def export_excel(payload: dict):
+    """
+    Wykonuje analizę i zwraca wygenerowany plik Excel jako StreamingResponse.
+    """
+    try:
+        print(f"[main.export] payload: {payload}")
+    except Exception:
+        pass
+
+    ctx = await run_in_threadpool(_prepare_analysis, payload)
+
+    try:
+        res, plot_bytes, cached = await _analyze_cached(ctx)
+    except Exception as e:
+        import traceback
+        tb = getattr(e, "remote_traceback", "") or traceback.format_exc()
+        print("[main.export] Exception in run_analysis:\n", tb)
+        raise HTTPException(status_code=500, detail={"error": str(e), "traceback": tb})
+    finally:
+        ctx["lease"].release()
+
     # Generate Excel file
     try:
-        excel_io = report_service.generate_excel_report(result)
-        filename = f"analysis_{file_id}_{actual_x}_vs_{actual_y}.xlsx"
-        # Clean filename
-        filename = filename.replace(" ", "_").replace("/", "_").replace("\\", "_")
-        
-        # Create ASCII-safe fallback filename
-        filename_ascii = _safe_name(filename)
-        if not filename_ascii.endswith('.xlsx'):
-            filename_ascii = filename_ascii + '.xlsx'
-        # Ensure filename is not empty after ASCII conversion
-        if not filename_ascii or filename_ascii == '.xlsx':
-            filename_ascii = f"analysis_{file_id}.xlsx"
-        
-        # Use RFC 2231 encoding for non-ASCII characters
-        filename_encoded = quote(filename.encode('utf-8'), safe='')
-        
-        # Provide both ASCII fallback and UTF-8 encoded filename
-        headers = {
-            "Content-Disposition": f'attachment; filename="{filename_ascii}"; filename*=UTF-8\'\'{filename_encoded}'
-        }
+        with metrics.timed("excel_report"):
+            excel_io = await run_in_threadpool(report_service.generate_excel_report, _excel_result(ctx, res), plot_bytes)
         return StreamingResponse(
             excel_io,
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            headers=headers
+            media_type=XLSX_MEDIA_TYPE,
+            headers=_excel_headers(ctx["file_id"], ctx["actual_x"], ctx["actual_y"])
         )
     except Exception as e:
         import traceback
         tb = traceback.format_exc()
         print("[main.export] Exception in generate_excel_report:\n", tb)
-        raise HTTPException(status_code=500, detail=f"Błąd generowania pliku Excel: {e}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Błąd generowania pliku Excel: {e}")
+
+
+def _report_add(report, item: dict) -> bytes:
+    """Add a batch item to a screening report with its plot from the plot store."""
+    plot_bytes = None
+    path = plot_store.get_path(item["plot_id"]) if item.get("plot_id") else None
+    if path:
+        try:
+            with open(path, "rb") as pf:
+                plot_bytes = pf.read()
+        except OSError:
+            pass
+    return report.add(item, plot_bytes)
+
+
+@app.post("/export/batch")
+async def export_excel_batch(payload: dict):
+    """
+    Analiza wielu par (pola jak w /analyze/batch) jako jeden plik Excel: arkusz "Summary"
+    z wierszem na parę i arkusz na każdą parę. Plik jest wysyłany w trakcie liczenia.
+    """
+    dataset, ctxs = await run_in_threadpool(_plan_batch, payload)
+    print(f"[main.export_excel_batch] file_id={dataset['file_id']} engine={dataset['engine']} pairs={len(ctxs)}")
+    run = _BatchRun(dataset, ctxs)
+    try:
+        await run.start()
+    except Exception:
+        run.close()
+        raise
+    report = report_service.ScreeningReport(dataset["file_id"])
+
+    async def chunks():
+        try:
+            for fut in run.as_completed():
+                item = await fut
+                with metrics.timed("excel_report"):
+                    data = await run_in_threadpool(_report_add, report, item)
+                if data:
+                    yield data
+            yield await run_in_threadpool(report.close)
+        finally:
+            run.close()
+
+    headers = _attachment_headers(f"screening_{dataset['file_id']}.xlsx", dataset["file_id"])
+    return StreamingResponse(chunks(), media_type=XLSX_MEDIA_TYPE, headers=headers)
+
+
+JOB_KINDS = ("analyze", "batch", "export")
+
+
+@app.post("/jobs")
+async def create_job(payload: dict):
+    """
+    Zleca analizę w tle i od razu zwraca job_id. "kind": "analyze" (domyślnie), "batch" lub "export";
+    pozostałe pola jak w /analyze, /analyze/batch i /export.
+    """
+    kind = str(payload.get("kind") or "analyze").lower()
+    if kind not in JOB_KINDS:
+        raise HTTPException(status_code=400, detail=f"Nieznany rodzaj zadania: {kind}. Dostępne: {list(JOB_KINDS)}")
+
+    if kind == "batch":
+        dataset, ctxs = await run_in_threadpool(_plan_batch, payload)
+        lease = dataset["lease"]
+
+        async def work(job):
+            run = _BatchRun(dataset, ctxs)
+            try:
+                await run.start()
+                results = []
+                for fut in run.as_completed():
+                    results.append(await fut)
+                    job.advance()
+            finally:
+                run.close()
+            results.sort(key=lambda r: r["index"])
+            failed = sum(1 for r in results if "error" in r)
+            return {"file_id": dataset["file_id"], "engine": dataset["engine"], "results": results, **run.summary(failed)}
+        total = len(ctxs)
+    else:
+        ctx = await run_in_threadpool(_prepare_analysis, payload)
+        lease = ctx["lease"]
+        total = 1
+
+        async def work(job):
+            res, plot_bytes, cached = await _analyze_cached(ctx)
+            if kind == "analyze":
+                return _analyze_response(ctx, res, plot_bytes, cached)
+            with metrics.timed("excel_report"):
+                excel_io = await run_in_threadpool(report_service.generate_excel_report, _excel_result(ctx, res), plot_bytes)
+            await run_in_threadpool(jobs.save_attachment, job, excel_io.getvalue(),
+                                    _excel_headers(ctx["file_id"], ctx["actual_x"], ctx["actual_y"]))
+            return {"download": f"/jobs/{job.id}/download", "cached": cached}
+
+    try:
+        job = await jobs.submit(kind, work, total=total, on_finish=lease.release)
+    except QueueFull:
+        lease.release()
+        raise HTTPException(status_code=429, detail="Kolejka zadań jest pełna, spróbuj później")
+    print(f"[main.create_job] job {job.id} kind={kind} queued")
+    return job.to_dict()
+
+
+@app.get("/jobs/stats")
+async def job_stats():
+    return jobs.stats()
+
+
+def _get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Zadanie nie znalezione")
+    return job
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    return _get_job(job_id).to_dict()
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    _get_job(job_id)
+    return jobs.cancel(job_id).to_dict(with_result=False)
+
+
+@app.get("/jobs/{job_id}/download")
+async def download_job(job_id: str):
+    job = _get_job(job_id)
+    if job.kind != "export":
+        raise HTTPException(status_code=400, detail="To zadanie nie tworzy pliku")
+    if job.status != DONE or job.attachment is None:
+        raise HTTPException(status_code=409, detail=f"Plik nie jest gotowy (status: {job.status})")
+    path, headers = job.attachment
+    return FileResponse(path, media_type=XLSX_MEDIA_TYPE, headers=headers)
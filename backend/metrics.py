@@ -0,0 +1,213 @@
+import os
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# In-process metrics for the hot path, no external collector needed.
+#
+#   timed(stage) / observe(stage, seconds)  - histogram per stage
+#       (dependency_analysis_stage_seconds{stage=...}); the duration is also
+#       added to the Server-Timing header of the request being served
+#   inc(name, value, **labels)               - counter (<prefix><name>_total)
+#   add_collector(fn)                        - gauges/counters read at scrape
+#       time from the stats() of the stores, queues and pools
+#   exposition()                             - Prometheus text format, GET /metrics
+#
+# R pool workers run in other processes; they return their own stage timings
+# with the result and the server records them with record_timings().
+# In a batch the pairs run concurrently, so the Server-Timing durations of a
+# stage are summed over the pairs and can exceed the request's total.
+
+METRICS_PREFIX = os.environ.get("METRICS_PREFIX", "dependency_analysis_")
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# stage -> [seconds, count] of the request being served (None outside requests)
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _value(v) -> str:
+    if v is None:
+        return "NaN"
+    if isinstance(v, bool):
+        return "1" if v else "0"
+    if isinstance(v, float) and v in (float("inf"), float("-inf")):
+        return "+Inf" if v > 0 else "-Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Histogram:
+    __slots__ = ("buckets", "count", "sum")
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.sum += seconds
+        for i, upper in enumerate(BUCKETS):
+            if seconds <= upper:
+                self.buckets[i] += 1
+
+
+class Metrics:
+    def __init__(self, prefix=METRICS_PREFIX):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._histograms = {}  # (name, labels) -> _Histogram
+        self._counters = {}  # (name, labels) -> value
+        self._help = {}
+        self._collectors = []
+        self.started = time.time()
+
+    def observe(self, stage: str, seconds: float):
+        self._observe("stage_seconds", (("stage", stage),), seconds, "Time spent per processing stage")
+        timings = _request_timings.get()
+        if timings is not None:
+            entry = timings.setdefault(stage, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += 1
+
+    def observe_request(self, handler: str, method: str, status: int, seconds: float):
+        self._observe("request_seconds", (("handler", handler), ("method", method), ("status", status)), seconds,
+                      "HTTP request duration (until the response is complete)")
+
+    def _observe(self, name, labels, seconds, help_text):
+        with self._lock:
+            hist = self._histograms.get((name, labels))
+            if hist is None:
+                hist = self._histograms[(name, labels)] = _Histogram()
+                self._help.setdefault(name, help_text)
+            hist.observe(seconds)
+
+    @contextmanager
+    def timed(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def record_timings(self, timings):
+        """Stage timings measured elsewhere (e.g. in an R worker): {stage: seconds}."""
+        for stage, seconds in (timings or {}).items():
+            if isinstance(seconds, (int, float)):
+                self.observe(stage, float(seconds))
+
+    def inc(self, name: str, value=1, help_text: str = "", **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+            if help_text:
+                self._help.setdefault(name, help_text)
+
+    def add_collector(self, fn):
+        """fn() -> [(name, type, help, value or [(labels dict, value)])], called on every scrape."""
+        self._collectors.append(fn)
+
+    def exposition(self) -> str:
+        p = self.prefix
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items(), key=lambda kv: kv[0])
+            counters = sorted(self._counters.items(), key=lambda kv: kv[0])
+            help_texts = dict(self._help)
+
+        seen = set()
+        for (name, labels), hist in histograms:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# HELP {p}{name} {help_texts.get(name, name)}")
+                lines.append(f"# TYPE {p}{name} histogram")
+            # observe() counts a value in every bucket it fits, so the counts are cumulative
+            for upper, count in zip(BUCKETS, hist.buckets):
+                lines.append(f"{p}{name}_bucket{_labels(labels + (('le', upper),))} {count}")
+            lines.append(f"{p}{name}_bucket{_labels(labels + (('le', '+Inf'),))} {hist.count}")
+            lines.append(f"{p}{name}_sum{_labels(labels)} {_value(hist.sum)}")
+            lines.append(f"{p}{name}_count{_labels(labels)} {hist.count}")
+
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# HELP {p}{name}_total {help_texts.get(name, name)}")
+                lines.append(f"# TYPE {p}{name}_total counter")
+            lines.append(f"{p}{name}_total{_labels(labels)} {_value(value)}")
+
+        for collector in self._collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                print(f"[metrics.exposition] collector failed: {e}")
+                continue
+            for name, kind, help_text, samples in families:
+                lines.append(f"# HELP {p}{name} {help_text}")
+                lines.append(f"# TYPE {p}{name} {kind}")
+                if not isinstance(samples, list):
+                    samples = [({}, samples)]
+                for labels, value in samples:
+                    lines.append(f"{p}{name}{_labels(tuple(sorted(labels.items())))} {_value(value)}")
+
+        lines.append(f"# HELP {p}uptime_seconds Seconds since the server started")
+        lines.append(f"# TYPE {p}uptime_seconds gauge")
+        lines.append(f"{p}uptime_seconds {_value(round(time.time() - self.started, 3))}")
+        return "\n".join(lines) + "\n"
+
+
+def server_timing(timings: dict, total: float) -> str:
+    """Server-Timing header value: stage;dur=<ms> for every stage, then total."""
+    parts = []
+    for stage, (seconds, count) in timings.items():
+        part = f"{stage};dur={seconds * 1000:.1f}"
+        if count > 1:
+            part += f';desc="x{count}"'
+        parts.append(part)
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+class ServerTimingMiddleware:
+    """ASGI middleware: collects the stage timings of a request into a Server-Timing header
+    and records the request duration. Plain ASGI, so streamed responses pass through untouched."""
+
+    def __init__(self, app, registry=None):
+        self.app = app
+        self.metrics = registry or metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timings = {}
+        token = _request_timings.set(timings)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                header = server_timing(timings, time.perf_counter() - started).encode("latin-1")
+                message = dict(message, headers=list(message.get("headers", [])) + [(b"server-timing", header)])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(token)
+            # the router leaves the matched endpoint in the scope; its name keeps the label set small
+            handler = getattr(scope.get("endpoint"), "__name__", "unmatched")
+            self.metrics.observe_request(handler, scope.get("method", ""), status, time.perf_counter() - started)
+
+
+metrics = Metrics()
@@ -0,0 +1,208 @@
+import os
+import re
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Content-addressed plot storage.
+#
+# A plot is stored once as <sha256>.png and served from GET /plots/<sha256>.
+# The name is derived from the bytes, so a URL never changes meaning and
+# clients/proxies may cache it forever (the hash doubles as the ETag). Writes
+# go to a unique temp file and are renamed into place, so concurrent analyses
+# never see (or serve) each other's half-written files.
+#
+# The store is bounded by PLOT_STORE_MAX_BYTES: least recently used plots are
+# evicted first (access time is kept in the file mtime, so the order survives
+# restarts and is shared by server workers). A background sweeper re-scans the
+# directory every PLOT_STORE_SWEEP_INTERVAL seconds, enforces the quota and an
+# optional PLOT_STORE_TTL, and removes leftovers of crashed writes and of
+# engine output that was never collected.
+
+PLOT_STORE_MAX_BYTES = int(os.environ.get("PLOT_STORE_MAX_BYTES", str(512 * 1024 * 1024)))
+PLOT_STORE_TTL = float(os.environ.get("PLOT_STORE_TTL", "0"))
+PLOT_STORE_SWEEP_INTERVAL = float(os.environ.get("PLOT_STORE_SWEEP_INTERVAL", "300"))
+# temp files and uncollected engine output older than this are garbage
+_STALE_SECONDS = 3600
+
+_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class PlotStore:
+    def __init__(self, root: str, max_bytes=PLOT_STORE_MAX_BYTES, ttl=PLOT_STORE_TTL,
+                 sweep_interval=PLOT_STORE_SWEEP_INTERVAL):
+        self.root = root
+        # engines write their PNGs here; main moves them into the store
+        self.incoming_dir = os.path.join(root, "incoming")
+        os.makedirs(self.incoming_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._index = OrderedDict()  # plot_id -> size, least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._sweeper = None
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.evictions = 0
+        self.sweeps = 0
+        self._scan()
+
+    @staticmethod
+    def valid_id(plot_id: str) -> bool:
+        return bool(_ID_RE.match(plot_id or ""))
+
+    def path(self, plot_id: str) -> str:
+        return os.path.join(self.root, f"{plot_id}.png")
+
+    def _scan(self):
+        """Rebuild the index from the directory (files written by other workers included)."""
+        entries = []
+        for name in os.listdir(self.root):
+            plot_id = name[:-4] if name.endswith(".png") else None
+            if plot_id is None or not self.valid_id(plot_id):
+                continue
+            try:
+                st = os.stat(os.path.join(self.root, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, plot_id, st.st_size))
+        entries.sort()
+        with self._lock:
+            self._index = OrderedDict((plot_id, size) for _, plot_id, size in entries)
+            self._bytes = sum(self._index.values())
+
+    def _remove(self, plot_id: str):
+        # caller holds the lock
+        size = self._index.pop(plot_id, None)
+        if size is not None:
+            self._bytes -= size
+        try:
+            os.remove(self.path(plot_id))
+        except OSError:
+            pass
+
+    def _enforce_quota(self, keep: str = None):
+        # caller holds the lock
+        if self.max_bytes <= 0:
+            return
+        for plot_id in list(self._index):
+            if self._bytes <= self.max_bytes:
+                break
+            if plot_id == keep:
+                continue
+            self._remove(plot_id)
+            self.evictions += 1
+
+    def put(self, plot_bytes: bytes) -> str:
+        """Store PNG bytes (no-op when already stored) and return the plot id."""
+        plot_id = hashlib.sha256(plot_bytes).hexdigest()
+        path = self.path(plot_id)
+        if os.path.exists(path):
+            self._touch(plot_id, path, len(plot_bytes))
+            return plot_id
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(plot_bytes)
+        os.replace(tmp, path)
+        with self._lock:
+            if plot_id not in self._index:
+                self._index[plot_id] = len(plot_bytes)
+                self._bytes += len(plot_bytes)
+            self._index.move_to_end(plot_id)
+            self.puts += 1
+            self._enforce_quota(keep=plot_id)
+        return plot_id
+
+    def _touch(self, plot_id: str, path: str, size: int):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            if plot_id not in self._index:
+                self._index[plot_id] = size
+                self._bytes += size
+            self._index.move_to_end(plot_id)
+
+    def get_path(self, plot_id: str):
+        """Path of a stored plot, or None for unknown/invalid ids."""
+        if not self.valid_id(plot_id):
+            return None
+        path = self.path(plot_id)
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        self._touch(plot_id, path, size)
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def _remove_stale(self, directory: str, predicate):
+        now = time.time()
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                if predicate(name) and now - os.stat(path).st_mtime > _STALE_SECONDS:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def sweep(self):
+        """One sweeper pass: re-scan, drop expired plots and garbage, enforce the quota."""
+        self._scan()
+        self._remove_stale(self.root, lambda n: n.endswith(".tmp"))
+        self._remove_stale(self.incoming_dir, lambda n: True)
+        with self._lock:
+            if self.ttl > 0:
+                cutoff = time.time() - self.ttl
+                for plot_id in list(self._index):
+                    try:
+                        expired = os.stat(self.path(plot_id)).st_mtime < cutoff
+                    except OSError:
+                        expired = True
+                    if not expired:
+                        break  # index is ordered by access time
+                    self._remove(plot_id)
+                    self.evictions += 1
+            self._enforce_quota()
+            self.sweeps += 1
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.sweep)
+            except Exception as e:
+                print(f"[plot_store] sweep failed: {e}")
+
+    def start_sweeper(self):
+        if self._sweeper is None and self.sweep_interval > 0:
+            self._sweeper = asyncio.ensure_future(self._sweep_loop())
+
+    def stop_sweeper(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "files": len(self._index),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "puts": self.puts,
+                "evictions": self.evictions,
+                "sweeps": self.sweeps,
+            }
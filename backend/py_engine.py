@@ -0,0 +1,355 @@
+import os
+import math
+import itertools
+import numpy as np
+import pandas as pd
+from scipy import stats as sps
+
+# Native NumPy/SciPy implementation of the decision tree in r_scripts/stat_tests.R.
+# Results use the same shape as r_interface.run_analysis:
+#   {"recommended_test": str, "stats": {...}, "plot_path": str}
+# Method strings, statistics and p-values follow R's stats package (cor.test,
+# chisq.test, t.test, wilcox.test, aov, kruskal.test) so both engines can be
+# compared one-to-one. This engine does not render plots.
+
+# bump when results of this engine change, invalidates cached results
+ENGINE_VERSION = "2"
+
+# Normality checks on large samples. shapiro.test() only takes 3..5000 values;
+# above that stat_tests.R and this engine either run Shapiro-Wilk on a seeded
+# random subsample of NORMALITY_MAX_N values ("subsample") or use the
+# D'Agostino K^2 omnibus test on all values ("dagostino"). Both are linear in n.
+# The method used is reported in the result under "assumptions". The same
+# variables are read by stat_tests.R.
+NORMALITY_LARGE_METHOD = os.environ.get("NORMALITY_LARGE_METHOD", "subsample")
+NORMALITY_MAX_N = 5000
+NORMALITY_SEED = int(os.environ.get("NORMALITY_SEED", "42"))
+
+_COERCE_MIN_GOOD = 3
+_COERCE_MIN_RATIO = 0.7
+
+
+_DOT, _COMMA, _MINUS = ord("."), ord(","), ord("-")
+# upper bound on code points held in the working matrix at once (x4 bytes)
+_COERCE_BLOCK_CELLS = 1 << 22
+
+
+def _coerce_block(u):
+    """coerce_one() over a 'U' array, done on its (rows x width) matrix of code points."""
+    n = u.shape[0]
+    w = u.dtype.itemsize // 4
+    out = np.full(n, np.nan, dtype=np.float64)
+    if n == 0 or w == 0:
+        return out
+    m = u.view(np.uint32).reshape(n, w).copy()
+    is_dot = m == _DOT
+    is_comma = m == _COMMA
+    n_dot = is_dot.sum(axis=1)
+    has_comma = is_comma.any(axis=1)
+    # '.' and ',' -> dots are thousands; only '.', more than once -> thousands too
+    drop_dots = (has_comma & (n_dot > 0)) | (~has_comma & (n_dot > 1))
+    m[is_dot & drop_dots[:, None]] = 0
+    # whichever rule applied, every remaining comma is the decimal separator
+    m[is_comma] = _DOT
+
+    # strip everything except [0-9.-] (this also drops NBSP and other whitespace)
+    is_digit = (m >= 48) & (m <= 57)
+    is_dot = m == _DOT
+    is_minus = m == _MINUS
+    keep = is_digit | is_dot | is_minus
+    order = np.argsort(~keep, axis=1, kind="stable")
+    m = np.take_along_axis(m, order, axis=1)
+    keep = np.take_along_axis(keep, order, axis=1)
+    m[~keep] = 0
+
+    # what as.numeric() accepts from such a string: -?(digits[.digits]|.digits)
+    n_minus = np.take_along_axis(is_minus, order, axis=1).sum(axis=1)
+    ok = (np.take_along_axis(is_digit, order, axis=1).any(axis=1)
+          & (np.take_along_axis(is_dot, order, axis=1).sum(axis=1) <= 1)
+          & ((n_minus == 0) | ((n_minus == 1) & (m[:, 0] == _MINUS))))
+    out[ok] = m.reshape(-1).view(f"<U{w}")[ok].astype(np.float64)
+    return out
+
+
+def coerce_strings(values):
+    """Vectorized coerce_one() from stat_tests.R: float64 array, NaN where a value does not parse.
+
+    Each distinct value is coerced once, and the string rules run as array
+    operations over the code points instead of per-element regexes.
+    """
+    arr = np.asarray(values)
+    if arr.dtype.kind != "U":
+        arr = arr.astype(object)
+    codes, uniques = pd.factorize(arr, use_na_sentinel=True)
+    uniques = np.asarray(uniques, dtype=object).astype(str)
+    by_unique = np.full(uniques.shape[0] + 1, np.nan, dtype=np.float64)
+    width = max(1, uniques.dtype.itemsize // 4)
+    block = max(1, _COERCE_BLOCK_CELLS // width)
+    for start in range(0, uniques.shape[0], block):
+        part = uniques[start:start + block]
+        by_unique[start:start + part.shape[0]] = _coerce_block(part)
+    return by_unique[codes]
+
+
+def coercion_accepted(n_good: int, n_total: int) -> bool:
+    """R's acceptance rule: at least 3 values and at least 70% of the vector parsed."""
+    return n_good >= _COERCE_MIN_GOOD and n_good / max(1, n_total) >= _COERCE_MIN_RATIO
+
+
+def coerce_numeric_if_possible(values):
+    """Port of .coerce_numeric_if_possible: returns a float64 array or the input unchanged."""
+    arr = np.asarray(values)
+    if arr.dtype.kind in "fiu":
+        return arr.astype(np.float64, copy=False)
+    coerced = coerce_strings(arr)
+    n_good = int(np.count_nonzero(~np.isnan(coerced)))
+    if coercion_accepted(n_good, coerced.shape[0]):
+        return coerced
+    return values
+
+
+def _is_numeric(v) -> bool:
+    return isinstance(v, np.ndarray) and v.dtype.kind == "f"
+
+
+def _num(v):
+    """float() that maps NaN/inf failures to None so results stay JSON-safe."""
+    try:
+        f = float(v)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(f) else f
+
+
+def assumption_settings() -> str:
+    """Settings that change test selection; part of the result cache key."""
+    return f"{NORMALITY_LARGE_METHOD}:{NORMALITY_SEED}"
+
+
+def _normality_method(n: int) -> str:
+    if n <= NORMALITY_MAX_N:
+        return "shapiro"
+    return "dagostino" if NORMALITY_LARGE_METHOD == "dagostino" else "shapiro_subsample"
+
+
+def normality_p(vec):
+    """(p-value or None, method) of the normality check used by the decision tree."""
+    vec = vec[~np.isnan(vec)]
+    n = vec.shape[0]
+    method = _normality_method(n)
+    if n < 3:
+        return None, method
+    if np.ptp(vec) == 0:
+        # shapiro.test() errors on identical values
+        return None, method
+    try:
+        if method == "dagostino":
+            return _num(sps.normaltest(vec).pvalue), method
+        if method == "shapiro_subsample":
+            rng = np.random.default_rng(NORMALITY_SEED)
+            vec = vec[rng.choice(n, NORMALITY_MAX_N, replace=False)]
+        return _num(sps.shapiro(vec).pvalue), method
+    except Exception:
+        return None, method
+
+
+def safe_shapiro_p(vec):
+    return normality_p(vec)[0]
+
+
+def variance_homog_p(groups):
+    # stat_tests.R uses car::leveneTest when car is installed and bartlett.test
+    # otherwise; the backend image ships without car, so mirror bartlett.test.
+    if len(groups) < 2 or any(g.shape[0] < 2 for g in groups):
+        return None
+    try:
+        return _num(sps.bartlett(*groups).pvalue)
+    except Exception:
+        return None
+
+
+def _prho_upper(n: int, s: float, lower_tail: bool) -> float:
+    """AS 89 (R's C_pRho): exact for n <= 9, Edgeworth series otherwise."""
+    n3 = n * (n * n - 1) / 3.0
+    if s <= 0:
+        return 0.0 if lower_tail else 1.0
+    if s > n3:
+        return 1.0 if lower_tail else 0.0
+    if n <= 9:
+        base = np.arange(1, n + 1)
+        perms = np.array(list(itertools.permutations(base)))
+        ss = ((base - perms) ** 2).sum(axis=1)
+        ifr = int(np.count_nonzero(ss >= s))
+        nfac = perms.shape[0]
+        return (nfac - ifr) / nfac if lower_tail else ifr / nfac
+    c = (0.2274, 0.2531, 0.1745, 0.0758, 0.1033, 0.3932, 0.0879, 0.0151, 0.0072, 0.0831, 0.0131, 4.6e-4)
+    b = 1.0 / n
+    x = (6.0 * (s - 1) * b / (n * n - 1) - 1) * math.sqrt(1 / b - 1)
+    y = x * x
+    u = x * b * (c[0] + b * (c[1] + c[2] * b) + y * (-c[3] + b * (c[4] + c[5] * b)
+                 - y * b * (c[6] + c[7] * b - y * (c[8] - c[9] * b + y * b * (c[10] - c[11] * y)))))
+    y = u / math.exp(y / 2)
+    pv = (-y if lower_tail else y) + (sps.norm.cdf(x) if lower_tail else sps.norm.sf(x))
+    return min(1.0, max(0.0, pv))
+
+
+def _spearman(x, y):
+    ok = ~(np.isnan(x) | np.isnan(y))
+    x, y = x[ok], y[ok]
+    n = x.shape[0]
+    if n < 2:
+        raise ValueError("not enough finite observations")
+    rx = sps.rankdata(x)
+    ry = sps.rankdata(y)
+    r = float(np.corrcoef(rx, ry)[0, 1])
+    ties = np.unique(x).shape[0] < n or np.unique(y).shape[0] < n
+    return spearman_stats(r, n, ties)
+
+
+def spearman_stats(r: float, n: int, ties: bool):
+    """cor.test(method = "spearman") result from rho of n complete pairs."""
+    if math.isnan(r):
+        return {"method": "Spearman's rank correlation rho", "statistic": None, "p_value": None, "estimate": None}
+    q = (n ** 3 - n) * (1 - r) / 6
+    if n < 1290 and not ties:
+        if q > (n ** 3 - n) / 6:
+            p = _prho_upper(n, round(q), lower_tail=False)
+        else:
+            p = _prho_upper(n, round(q) + 2, lower_tail=True)
+        p = min(2 * p, 1.0)
+    else:
+        t = r / math.sqrt((1 - r * r) / (n - 2)) if abs(r) < 1 else math.copysign(math.inf, r)
+        p = min(2 * sps.t.sf(abs(t), n - 2), 1.0)
+    return {"method": "Spearman's rank correlation rho", "statistic": _num(q), "p_value": _num(p), "estimate": _num(r)}
+
+
+def _pearson(x, y):
+    ok = ~(np.isnan(x) | np.isnan(y))
+    x, y = x[ok], y[ok]
+    n = x.shape[0]
+    if n < 3:
+        raise ValueError("not enough finite observations")
+    return pearson_stats(float(np.corrcoef(x, y)[0, 1]), n)
+
+
+def pearson_stats(r: float, n: int):
+    """cor.test(method = "pearson") result from r of n complete pairs."""
+    if math.isnan(r):
+        return {"method": "Pearson's product-moment correlation", "statistic": None, "p_value": None, "estimate": None}
+    df = n - 2
+    t = math.sqrt(df) * r / math.sqrt(1 - r * r) if abs(r) < 1 else math.copysign(math.inf, r)
+    p = 2 * sps.t.sf(abs(t), df)
+    return {"method": "Pearson's product-moment correlation", "statistic": _num(t), "p_value": _num(p), "estimate": _num(r)}
+
+
+def _chi_square(x, y):
+    ok = pd.notna(x) & pd.notna(y)
+    tab = pd.crosstab(pd.Series(x[ok], dtype=object), pd.Series(y[ok], dtype=object)).to_numpy()
+    return chi_square_stats(tab)
+
+
+def chi_square_stats(tab):
+    """chisq.test() result for a contingency table of counts."""
+    stats = {"method": "Chi-squared test", "statistic": None, "p_value": None}
+    try:
+        if tab.shape[0] == 1 or tab.shape[1] == 1:
+            # chisq.test() treats a one-row/one-column table as a goodness-of-fit vector
+            res = sps.chisquare(tab.ravel())
+        else:
+            res = sps.chi2_contingency(tab, correction=True)
+        stats["statistic"] = _num(res[0])
+        stats["p_value"] = _num(res[1])
+    except Exception:
+        pass
+    return stats
+
+
+def _split_groups(cat, num):
+    """One grouped pass over the rows: (group count incl. NA, sorted labels, values per label, NA label present).
+
+    Replaces a full-vector mask per group; the sort is a radix sort on small integer codes.
+    """
+    codes, uniques = pd.factorize(pd.Series(cat, dtype=object), sort=True)
+    has_na = bool((codes < 0).any())
+    if len(uniques) < np.iinfo(np.int16).max:
+        codes = codes.astype(np.int16)
+    order = np.argsort(codes, kind="stable")
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    ordered = num[order][codes.shape[0] - int(counts.sum()):]
+    parts = np.split(ordered, np.cumsum(counts)[:-1]) if len(uniques) else []
+    # unique(catcol) in R keeps NA as its own "group"
+    return len(uniques) + int(has_na), list(uniques), parts, has_na
+
+
+def _mixed(cat, num):
+    k, labels, parts, has_na = _split_groups(cat, num)
+
+    # an NA group never passes (R's numcol[catcol == NA] is all NA)
+    normal_by_group = not has_na
+    checks = []
+    for part in parts:
+        pv, method = normality_p(part)
+        checks.append({"p_value": pv, "method": method})
+        if pv is None or pv <= 0.05:
+            normal_by_group = False
+
+    # as.factor(): NA dropped, levels sorted
+    groups, levels = [], []
+    for lv, part in zip(labels, parts):
+        part = part[~np.isnan(part)]
+        if part.shape[0]:
+            levels.append(lv)
+            groups.append(part)
+    levene_p = variance_homog_p(groups)
+    assumptions = {"normality": [dict(c, group=lv) for lv, c in zip(labels, checks)], "variance_homogeneity_p": levene_p}
+
+    if k == 2:
+        if len(levels) != 2:
+            raise ValueError("grouping factor must have exactly 2 levels")
+        a, b = groups
+        if normal_by_group:
+            equal_var = levene_p is not None and levene_p > 0.05
+            res = sps.ttest_ind(a, b, equal_var=equal_var)
+            return ("t_student" if equal_var else "welch_t"), {
+                "method": " Two Sample t-test" if equal_var else "Welch Two Sample t-test",
+                "statistic": _num(res.statistic),
+                "p_value": _num(res.pvalue),
+                "estimate": [_num(a.mean()), _num(b.mean())],
+            }, assumptions
+        ties = np.unique(np.concatenate([a, b])).shape[0] < a.shape[0] + b.shape[0]
+        exact = a.shape[0] < 50 and b.shape[0] < 50 and not ties
+        res = sps.mannwhitneyu(a, b, alternative="two-sided", use_continuity=True,
+                               method="exact" if exact else "asymptotic")
+        method = "Wilcoxon rank sum exact test" if exact else "Wilcoxon rank sum test with continuity correction"
+        return "wilcoxon", {"method": method, "statistic": _num(res.statistic), "p_value": _num(res.pvalue)}, assumptions
+
+    if normal_by_group and levene_p is not None and levene_p > 0.05:
+        res = sps.f_oneway(*groups)
+        return "anova", {"method": "ANOVA", "statistic": _num(res.statistic), "p_value": _num(res.pvalue)}, assumptions
+    res = sps.kruskal(*groups)
+    return "kruskal_wallis", {"method": "Kruskal-Wallis rank sum test", "statistic": _num(res.statistic), "p_value": _num(res.pvalue)}, assumptions
+
+
+def run_analysis(x_values, y_values):
+    """Run the stat_tests.R decision tree on two column vectors."""
+    x = coerce_numeric_if_possible(x_values)
+    y = coerce_numeric_if_possible(y_values)
+    is_x_num = _is_numeric(x)
+    is_y_num = _is_numeric(y)
+
+    if is_x_num and is_y_num:
+        (sh_x, method_x), (sh_y, method_y) = normality_p(x), normality_p(y)
+        assumptions = {"normality": [{"variable": "x", "p_value": sh_x, "method": method_x},
+                                     {"variable": "y", "p_value": sh_y, "method": method_y}]}
+        if sh_x is not None and sh_y is not None and sh_x > 0.05 and sh_y > 0.05:
+            return {"recommended_test": "pearson_correlation", "stats": _pearson(x, y), "plot_path": "", "assumptions": assumptions}
+        return {"recommended_test": "spearman_correlation", "stats": _spearman(x, y), "plot_path": "", "assumptions": assumptions}
+
+    if not is_x_num and not is_y_num:
+        return {"recommended_test": "chi_square", "stats": _chi_square(np.asarray(x, dtype=object), np.asarray(y, dtype=object)), "plot_path": ""}
+
+    if not is_x_num:
+        recommended, stats, assumptions = _mixed(np.asarray(x, dtype=object), y)
+    else:
+        recommended, stats, assumptions = _mixed(np.asarray(y, dtype=object), x)
+    return {"recommended_test": recommended, "stats": stats, "plot_path": "", "assumptions": assumptions}
@@ -2,19 +2,27 @@ import os
 import re
 import json
 import tempfile
-import io
 import csv
+import time
+import numpy as np
 
-try:
-    import chardet
-except Exception:
-    chardet = None
+from .services import encoding_service, dataset_service
 
 _r_loaded = False
 _r_run_analysis = None
 _stat_script_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "r_scripts", "stat_tests.R"))
 _stat_script_mtime = None
 _r_formals_names = None
+# bytes looked at when the given encoding does not decode a file
+SNIFF_BYTES = 200000
+
+
+def script_version() -> str:
+    """Version tag of stat_tests.R used for cache keys (the file's mtime, like _stat_script_mtime)."""
+    try:
+        return str(os.path.getmtime(_stat_script_path))
+    except Exception:
+        return "unknown"
 
 
 def _ensure_r_loaded(force_reload: bool = False):
@@ -63,7 +71,40 @@ def _ensure_r_loaded(force_reload: bool = False):
         raise RuntimeError(f"Failed to initialize R/rpy2 or source R script: {e}") from e
 
 
+def _r_vector_to_py(x):
+    """Convert rpy2 vectors into plain Python: named lists -> dict, length-1 atomics -> scalar, NA/NaN -> None."""
+    from rpy2 import rinterface
+    from rpy2.robjects import vectors
+
+    if x is None or x is rinterface.NULL:
+        return None
+    if isinstance(x, (vectors.ListVector, rinterface.ListSexpVector)):
+        items = [_r_vector_to_py(v) for v in x]
+        names = x.names if x.names is not rinterface.NULL else None
+        names = [str(n) for n in names] if names is not None else []
+        if names and len(names) == len(items) and all(names):
+            return {n: v for n, v in zip(names, items)}
+        return items
+    if isinstance(x, (vectors.Vector, rinterface.SexpVector)):
+        values = []
+        for v in x:
+            if v is rinterface.NA_Logical or v is rinterface.NA_Integer or v is rinterface.NA_Character:
+                values.append(None)
+            elif isinstance(v, float) and v != v:
+                values.append(None)
+            elif isinstance(v, (bool, int, float, str)):
+                values.append(v)
+            else:
+                values.append(str(v))
+        return values[0] if len(values) == 1 else values
+    raise TypeError(f"unsupported R object: {type(x)!r}")
+
+
 def _r_to_py(r_obj):
+    try:
+        return _r_vector_to_py(r_obj)
+    except Exception:
+        pass
     try:
         from rpy2.robjects import conversion
         py = conversion.rpy2py(r_obj)
@@ -122,92 +163,49 @@ def _write_meta_encoding_if_possible(csv_path: str, encoding: str, delimiter: st
 
 
 def _detect_encoding_bytes(raw_bytes: bytes):
-    if chardet:
-        try:
-            det = chardet.detect(raw_bytes)
-            enc = det.get("encoding")
-            if enc:
-                e = enc.lower()
-                if e.startswith("windows-"):
-                    e = e.replace("windows-", "cp")
-                return e
-        except Exception:
-            pass
-    return None
+    # BOM / strict UTF-8 / Polish code page checks, chardet only on a bounded sample
+    enc, _ = encoding_service.detect_encoding(raw_bytes[:SNIFF_BYTES])
+    return enc
 
 
-def _convert_to_comma_csv(src_path: str, src_encoding: str = None, src_delim: str = ','):
-    with open(src_path, "rb") as rb:
-        raw = rb.read()
+def _strip_bom(lines):
+    first = True
+    for line in lines:
+        if first:
+            # exactly one BOM in the output: utf-8-sig writes it
+            line = line.lstrip("\ufeff")
+            first = False
+        yield line
 
-    used_enc = None
-    text = None
 
-    # Try given encoding first
-    if src_encoding:
-        try:
-            text = raw.decode(src_encoding)
-            used_enc = src_encoding
-        except Exception:
-            text = None
-
-    # Try chardet suggestion
-    if text is None:
-        det = _detect_encoding_bytes(raw)
-        if det:
-            try:
-                text = raw.decode(det)
-                used_enc = det
-            except Exception:
-                text = None
-
-    # Try a prioritized list suitable for Central/Eastern Europe (Polish)
-    if text is None:
-        for e in ("cp1250", "iso-8859-2", "latin1", "utf-8", "utf-8-sig"):
-            try:
-                text = raw.decode(e)
-                used_enc = e
-                break
-            except Exception:
-                text = None
-                continue
+def _convert_to_comma_csv(src_path: str, src_encoding: str = None, src_delim: str = ','):
+    """Rewrite a CSV as comma-separated UTF-8 with BOM for R, streaming it row by row.
 
-    # Last-resort: decode with latin1 to avoid decode errors (maps bytes 1:1)
-    if text is None:
+    Encodings tried in turn: the given one, the one detected on the first
+    SNIFF_BYTES, then Polish code pages; a decode error part-way through the
+    file restarts the conversion with the next one (latin1 always decodes).
+    Returns (converted path, encoding used).
+    """
+    with open(src_path, "rb") as rb:
+        sample = rb.read(SNIFF_BYTES)
+    candidates = []
+    for enc in (src_encoding, _detect_encoding_bytes(sample), "cp1250", "iso-8859-2", "utf-8", "latin1"):
+        if enc and enc not in candidates:
+            candidates.append(enc)
+
+    fd, out_path = tempfile.mkstemp(prefix="conv_", suffix=".csv")
+    os.close(fd)
+    for enc in candidates:
         try:
-            text = raw.decode("latin1")
-            used_enc = "latin1"
-        except Exception:
-            # final fallback: utf-8 with replacement
-            text = raw.decode("utf-8", errors="replace")
-            used_enc = "utf-8-replace"
-
-    # Strip leading BOM (if any) so writing utf-8-sig produces exactly one BOM
-    if text and text.startswith("\ufeff"):
-        text = text.lstrip("\ufeff")
-
-    # Parse and write out as comma-separated UTF-8-with-BOM
-    if not src_delim:
-        src_delim = ','
-    sio = io.StringIO(text)
-    reader = csv.reader(sio, delimiter=src_delim)
-    tmpf = tempfile.NamedTemporaryFile(prefix="conv_", suffix=".csv", delete=False)
-    out_path = tmpf.name
-    tmpf.close()
-    with open(out_path, "w", encoding="utf-8-sig", newline='') as wf:
-        writer = csv.writer(wf, delimiter=",", quoting=csv.QUOTE_MINIMAL)
-        for row in reader:
-            writer.writerow(row)
-
-    # Debug / diagnostic info
-    try:
-        first_bytes = open(out_path, "rb").read(200)
-        det_out = chardet.detect(first_bytes) if chardet else {"encoding": None}
-        print(f"[r_interface] converted tmp={out_path}, used_enc={used_enc}, out_head_bytes={first_bytes[:80]!r}, chardet_out={det_out}")
-    except Exception:
-        pass
-
-    return out_path, used_enc
+            with open(src_path, "r", encoding=enc, newline="") as rf, \
+                    open(out_path, "w", encoding="utf-8-sig", newline="") as wf:
+                writer = csv.writer(wf, delimiter=",", quoting=csv.QUOTE_MINIMAL)
+                writer.writerows(csv.reader(_strip_bom(rf), delimiter=src_delim or ","))
+            return out_path, enc
+        except (UnicodeDecodeError, LookupError):
+            continue
+    os.remove(out_path)
+    raise ValueError(f"Nie można odczytać pliku {src_path} w żadnym z kodowań: {candidates}")
 
 
 def _build_r_args(csv_path, x, y, plots_dir, enc, delimiter):
@@ -241,10 +239,13 @@ def run_analysis(csv_path: str, x: str, y: str, plots_dir: str = None, encoding:
     csv_to_pass = csv_path
     converted_tmp = None
     used_enc_for_tmp = None
+    timings = {}
     try:
         if (delimiter and delimiter != ',') or (encoding and encoding.lower() not in ("utf-8", "utf8")):
             try:
+                started = time.perf_counter()
                 converted_tmp, used_enc_for_tmp = _convert_to_comma_csv(csv_path, src_encoding=encoding, src_delim=delimiter or ',')
+                timings["r_convert_csv"] = time.perf_counter() - started
                 csv_to_pass = converted_tmp
                 encoding_for_r = "UTF-8"
                 delimiter_for_r = ","
@@ -263,13 +264,164 @@ def run_analysis(csv_path: str, x: str, y: str, plots_dir: str = None, encoding:
         encoding_for_r = encoding
         delimiter_for_r = delimiter
 
+    try:
+        out = _call_r_analysis(csv_to_pass, x, y, plots_dir, encoding_for_r, delimiter_for_r)
+        out["timings"] = dict(timings, **out["timings"])
+        return out
+    finally:
+        # the UTF-8 copy is only needed for this call
+        if converted_tmp:
+            try:
+                os.remove(converted_tmp)
+            except OSError:
+                pass
+
+
+def run_analysis_columns(snapshot_dir: str, x_name: str, y_name: str, plots_dir: str = None):
+    """R analysis of two snapshot columns handed to R in memory - no CSV is written or parsed.
+
+    Numeric columns go over as float64 arrays, text columns as their int32 codes
+    plus levels (R rebuilds the strings); numpy2ri copies each array into an R
+    vector in one go.
+    """
+    _ensure_r_loaded()
+    manifest = dataset_service.load_manifest(snapshot_dir)
+    if manifest is None:
+        raise RuntimeError(f"snapshot not found: {snapshot_dir}")
+    if plots_dir is None:
+        plots_dir = os.path.join(snapshot_dir, "plots")
+
+    started = time.perf_counter()
+    x_values, x_levels = dataset_service.load_analysis_vector(snapshot_dir, manifest, x_name)
+    y_values, y_levels = dataset_service.load_analysis_vector(snapshot_dir, manifest, y_name)
+    load_s = time.perf_counter() - started
+    out = _call_r_vectors(x_values, x_levels, y_values, y_levels, x_name, y_name, plots_dir)
+    out["timings"]["r_load_columns"] = load_s
+    return out
+
+
+def _call_r_vectors(x_values, x_levels, y_values, y_levels, x_name, y_name, plots_dir):
+    from rpy2 import robjects
+    from rpy2.robjects import default_converter, numpy2ri
+    from rpy2.robjects.conversion import localconverter
+
+    started = time.perf_counter()
+    with localconverter(default_converter + numpy2ri.converter) as cv:
+        r_x = cv.py2rpy(x_values)
+        r_y = cv.py2rpy(y_values)
+    kwargs = {}
+    if x_levels is not None:
+        kwargs["x_levels"] = robjects.StrVector(x_levels)
+    if y_levels is not None:
+        kwargs["y_levels"] = robjects.StrVector(y_levels)
+    print(f"[r_interface] calling R run_analysis_vectors with x={x_name}, y={y_name}, rows={len(x_values)}, plots_dir={plots_dir}")
+    with localconverter(default_converter):
+        r_res = robjects.globalenv["run_analysis_vectors"](r_x, r_y, x_name, y_name, plots_dir, **kwargs)
+        py_res = _r_to_py(r_res)
+    out = _analysis_out(r_res, py_res)
+    out["timings"]["r_call"] = time.perf_counter() - started
+    out["encoding_retries"] = 0
+    return out
+
+
+def render_association_matrix(values, p_values, names, plots_dir: str, title: str = "") -> dict:
+    """Heatmap of a whole association matrix with corrplot (plot_association_matrix in stat_tests.R).
+
+    values / p_values are square float64 arrays (NaN = no value); returns
+    {"plot_path", "timings"} like an analysis, so the PNG is collected the same way.
+    """
+    from rpy2 import robjects
+    from rpy2.robjects import default_converter, numpy2ri
+    from rpy2.robjects.conversion import localconverter
+
+    _ensure_r_loaded()
+    started = time.perf_counter()
+    with localconverter(default_converter + numpy2ri.converter) as cv:
+        r_values = cv.py2rpy(np.asarray(values, dtype=np.float64))
+        r_p = cv.py2rpy(np.asarray(p_values, dtype=np.float64))
+    with localconverter(default_converter):
+        r_res = robjects.globalenv["plot_association_matrix"](r_values, r_p, robjects.StrVector(names), plots_dir, title)
+        py_res = _r_to_py(r_res)
+    raw = py_res.get("plot_path", "") if isinstance(py_res, dict) else ""
+    return {"plot_path": _clean_plot_path(raw), "timings": {"r_matrix_plot": time.perf_counter() - started}}
+
+
+_WARM_UP_ROWS = 20
+
+
+def warm_up() -> dict:
+    """Load R, source stat_tests.R and run one tiny analysis with a plot (ggplot2, PNG device).
+
+    Called for every pool worker at startup and after the script changes, so the
+    first real request does not pay for it. Goes through the in-memory hand-off
+    (numpy2ri included). Returns the timings of both steps.
+    """
+    started = time.perf_counter()
+    _ensure_r_loaded()
+    loaded = time.perf_counter()
+    rows = np.arange(_WARM_UP_ROWS)
+    values = rows * 1.5 + rows % 3
+    codes = (rows % 2).astype(np.int32)
+    with tempfile.TemporaryDirectory(prefix="warmup_") as tmp:
+        res = _call_r_vectors(values, None, codes, ["A", "B"], "wartosc", "grupa", tmp)
+    return {"recommended_test": res.get("recommended_test"), "script_version": script_version(),
+            "load_s": round(loaded - started, 3), "analysis_s": round(time.perf_counter() - loaded, 3)}
+
+
+def _analysis_out(r_res, py_res) -> dict:
+    """Shape the R result list into the analysis dict (recommended_test, stats, plot_path, assumptions, timings)."""
+    out = {"recommended_test": "", "stats": {}, "plot_path": ""}
+
+    if isinstance(py_res, dict):
+        out["recommended_test"] = str(py_res.get("recommended_test", "") or "")
+        stats = py_res.get("stats", {})
+        out["stats"] = stats if isinstance(stats, (dict, list, str, int, float, type(None))) else str(stats)
+        raw_plot = py_res.get("plot_path", "")
+        out["plot_path"] = _clean_plot_path(raw_plot)
+        if isinstance(py_res.get("assumptions"), dict):
+            out["assumptions"] = py_res["assumptions"]
+        r_timings = py_res.get("timings")
+    else:
+        r_timings = None
+        try:
+            recommended = None
+            stats = None
+            plot_path = None
+            try:
+                recommended = str(r_res.rx2("recommended_test"))
+            except Exception:
+                recommended = None
+            try:
+                stats = _r_to_py(r_res.rx2("stats"))
+            except Exception:
+                stats = None
+            try:
+                plot_path = r_res.rx2("plot_path")
+            except Exception:
+                plot_path = None
+
+            out["recommended_test"] = recommended or ""
+            out["stats"] = stats or {}
+            out["plot_path"] = _clean_plot_path(plot_path)
+        except Exception:
+            out["recommended_test"] = ""
+            out["stats"] = str(py_res) if py_res is not None else {}
+            out["plot_path"] = ""
+    # R's own stage timings, for the metrics
+    r_timings = r_timings if isinstance(r_timings, dict) else {}
+    out["timings"] = {k: v for k, v in r_timings.items() if isinstance(v, (int, float))}
+    return out
+
+
+def _call_r_analysis(csv_to_pass, x, y, plots_dir, encoding_for_r, delimiter_for_r):
     enc_candidates = []
     if encoding_for_r:
         enc_candidates.append(encoding_for_r)
     enc_candidates += ["UTF-8", "cp1250", "latin1", "iso-8859-2"]
 
     last_exc = None
-    for enc in enc_candidates:
+    started = time.perf_counter()
+    for attempt, enc in enumerate(enc_candidates):
         try:
             _ensure_r_loaded()
 
@@ -297,39 +449,10 @@ def run_analysis(csv_path: str, x: str, y: str, plots_dir: str = None, encoding:
                     # prefer to raise the original conversion-related exception if applicable
                     raise conv_exc from e
 
-            out = {"recommended_test": "", "stats": {}, "plot_path": ""}
-
-            if isinstance(py_res, dict):
-                out["recommended_test"] = str(py_res.get("recommended_test", "") or "")
-                stats = py_res.get("stats", {})
-                out["stats"] = stats if isinstance(stats, (dict, list, str, int, float, type(None))) else str(stats)
-                raw_plot = py_res.get("plot_path", "")
-                out["plot_path"] = _clean_plot_path(raw_plot)
-            else:
-                try:
-                    recommended = None
-                    stats = None
-                    plot_path = None
-                    try:
-                        recommended = str(r_res.rx2("recommended_test"))
-                    except Exception:
-                        recommended = None
-                    try:
-                        stats = _r_to_py(r_res.rx2("stats"))
-                    except Exception:
-                        stats = None
-                    try:
-                        plot_path = r_res.rx2("plot_path")
-                    except Exception:
-                        plot_path = None
-
-                    out["recommended_test"] = recommended or ""
-                    out["stats"] = stats or {}
-                    out["plot_path"] = _clean_plot_path(plot_path)
-                except Exception:
-                    out["recommended_test"] = ""
-                    out["stats"] = str(py_res) if py_res is not None else {}
-                    out["plot_path"] = ""
+            out = _analysis_out(r_res, py_res)
+            # the whole call, all attempts included
+            out["timings"]["r_call"] = time.perf_counter() - started
+            out["encoding_retries"] = attempt
             return out
 
         except Exception as e:
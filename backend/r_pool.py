@@ -0,0 +1,262 @@
+import os
+import asyncio
+import threading
+import traceback
+import multiprocessing as mp
+
+# Pool of long-lived R worker processes.
+#
+# Every worker is a separate Python process with its own embedded R (rpy2) that
+# sources stat_tests.R (and therefore attaches ggplot2) once at start-up. Jobs
+# are handed out through an asyncio queue of idle workers, and the blocking
+# pipe round-trip runs in a thread, so async handlers await results without
+# freezing the event loop. A worker is replaced after R_POOL_MAX_JOBS jobs or
+# when its resident memory grows past R_POOL_MAX_RSS_MB.
+#
+# A job cancelled while R is running terminates that worker (R cannot be
+# interrupted from outside) and a fresh one takes its place. If a replacement
+# cannot be spawned, the dead worker keeps the slot: the next job on it fails
+# fast with RWorkerError and retries the spawn, so the pool never shrinks.
+#
+# R_POOL_SIZE=0 disables the subprocesses and runs R in-process (serialized by
+# a lock, rpy2 is not thread-safe) - handy for local development.
+
+R_POOL_SIZE = int(os.environ.get("R_POOL_SIZE", str(max(1, os.cpu_count() or 1))))
+R_POOL_MAX_JOBS = int(os.environ.get("R_POOL_MAX_JOBS", "200"))
+R_POOL_MAX_RSS_MB = int(os.environ.get("R_POOL_MAX_RSS_MB", "1024"))
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except Exception:
+        try:
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        except Exception:
+            return 0.0
+
+
+def _worker_main(conn):
+    """Entry point of a worker process: preload R, then serve jobs until told to stop."""
+    init_error = None
+    try:
+        from . import r_interface
+        r_interface._ensure_r_loaded()
+    except Exception as e:
+        init_error = f"R worker initialization failed: {e}"
+    conn.send(("ready", init_error, _rss_mb()))
+
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            break
+        if job is None:
+            break
+        fn_name, args, kwargs = job
+        if init_error:
+            conn.send(("err", init_error, "", _rss_mb()))
+            continue
+        try:
+            res = getattr(r_interface, fn_name)(*args, **kwargs)
+            conn.send(("ok", res, "", _rss_mb()))
+        except Exception as e:
+            conn.send(("err", str(e), traceback.format_exc(), _rss_mb()))
+    conn.close()
+
+
+class _Worker:
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+        self.rss_mb = 0.0
+        self.init_error = None
+        self._ready = False
+
+    def wait_ready(self):
+        if not self._ready:
+            _, self.init_error, self.rss_mb = self.conn.recv()
+            self._ready = True
+
+    def call(self, fn_name, args, kwargs):
+        if not self.process.is_alive():
+            raise EOFError("worker process is not running")
+        self.wait_ready()
+        self.conn.send((fn_name, args, kwargs))
+        status, payload, tb, self.rss_mb = self.conn.recv()
+        self.jobs += 1
+        return status, payload, tb
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except Exception:
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout=5)
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+
+class RWorkerError(RuntimeError):
+    def __init__(self, message, tb=""):
+        super().__init__(message)
+        self.remote_traceback = tb
+
+
+class RWorkerPool:
+    def __init__(self, size=R_POOL_SIZE, max_jobs=R_POOL_MAX_JOBS, max_rss_mb=R_POOL_MAX_RSS_MB):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.max_rss_mb = max_rss_mb
+        self._ctx = mp.get_context("spawn")
+        self._idle = None
+        self._workers = []
+        self._local_lock = threading.Lock()
+        self.recycled = 0
+        self.waiting = 0
+        self.started = False
+
+    def _spawn(self):
+        return _Worker(self._ctx)
+
+    async def start(self):
+        if self.started:
+            return
+        self.started = True
+        if self.size <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        self._idle = asyncio.Queue()
+        workers = await asyncio.gather(*[loop.run_in_executor(None, self._spawn) for _ in range(self.size)])
+        for w in workers:
+            self._workers.append(w)
+            self._idle.put_nowait(w)
+
+    async def shutdown(self):
+        loop = asyncio.get_running_loop()
+        workers, self._workers = self._workers, []
+        await asyncio.gather(*[loop.run_in_executor(None, w.stop) for w in workers])
+        self.started = False
+
+    def _run_local(self, fn_name, args, kwargs):
+        from . import r_interface
+        with self._local_lock:
+            return getattr(r_interface, fn_name)(*args, **kwargs)
+
+    async def _replace(self, worker):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, worker.stop)
+        new_worker = await loop.run_in_executor(None, self._spawn)
+        self._workers = [new_worker if w is worker else w for w in self._workers]
+        self.recycled += 1
+        return new_worker
+
+    async def _replace_or_keep(self, worker, reason: str):
+        """_replace(), or the old worker back when no new one can be spawned (the next job retries)."""
+        try:
+            return await self._replace(worker)
+        except Exception as e:
+            print(f"[r_pool] worker replace after {reason} failed: {e}")
+            return worker
+
+    async def _release_replacement(self, worker):
+        self._idle.put_nowait(await self._replace_or_keep(worker, "cancel"))
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "idle": self._idle.qsize() if self._idle is not None else 0,
+            "waiting": self.waiting,
+            "recycled": self.recycled,
+            "workers": [{"pid": w.process.pid, "jobs": w.jobs, "rss_mb": round(w.rss_mb, 1)} for w in self._workers],
+        }
+
+    async def warm_up(self):
+        """Run r_interface.warm_up on every worker (or in-process with R_POOL_SIZE=0); returns their results.
+
+        All workers are taken out of the idle queue first, so each one is warmed
+        exactly once; analyses arriving meanwhile wait for them like for busy workers.
+        """
+        if not self.started:
+            await self.start()
+        loop = asyncio.get_running_loop()
+        if self.size <= 0:
+            return [await loop.run_in_executor(None, self._run_local, "warm_up", (), {})]
+
+        workers = []
+        self.waiting += 1
+        try:
+            while len(workers) < len(self._workers):
+                workers.append(await self._idle.get())
+        finally:
+            self.waiting -= 1
+        results, errors = [], []
+        try:
+            replies = await asyncio.gather(*[loop.run_in_executor(None, w.call, "warm_up", (), {}) for w in workers],
+                                           return_exceptions=True)
+            for i, reply in enumerate(replies):
+                if isinstance(reply, BaseException):
+                    # worker died while loading R - replace it like after a crash mid-job
+                    errors.append(f"R worker crashed: {reply}")
+                    workers[i] = await self._replace_or_keep(workers[i], "crash")
+                elif reply[0] != "ok":
+                    errors.append(reply[1])
+                else:
+                    results.append(reply[1])
+        finally:
+            for w in workers:
+                self._idle.put_nowait(w)
+        if errors:
+            raise RWorkerError(errors[0])
+        return results
+
+    async def run(self, fn_name: str, *args, **kwargs):
+        """Run r_interface.<fn_name>(*args, **kwargs) on a pool worker and return its result."""
+        if not self.started:
+            await self.start()
+        loop = asyncio.get_running_loop()
+        if self.size <= 0:
+            return await loop.run_in_executor(None, self._run_local, fn_name, args, kwargs)
+
+        self.waiting += 1
+        try:
+            worker = await self._idle.get()
+        finally:
+            self.waiting -= 1
+        try:
+            try:
+                status, payload, tb = await loop.run_in_executor(None, worker.call, fn_name, args, kwargs)
+            except (EOFError, OSError, BrokenPipeError) as e:
+                # worker died mid-job (e.g. R segfault) - replace it and report the failure
+                worker = await self._replace_or_keep(worker, "crash")
+                raise RWorkerError(f"R worker crashed: {e}")
+            except asyncio.CancelledError:
+                # the caller gave up (job cancelled, client gone) but R is still busy:
+                # kill the worker so the computation stops, its slot comes back with a fresh one
+                worker.process.terminate()
+                asyncio.ensure_future(self._release_replacement(worker))
+                worker = None
+                raise
+            if worker.jobs >= self.max_jobs or worker.rss_mb > self.max_rss_mb:
+                worker = await self._replace_or_keep(worker, "recycle")
+        finally:
+            if worker is not None:
+                self._idle.put_nowait(worker)
+
+        if status != "ok":
+            raise RWorkerError(payload, tb)
+        return payload
+
+
+pool = RWorkerPool()
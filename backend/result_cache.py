@@ -0,0 +1,271 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Content-addressed cache of analysis results.
+#
+# Key: dataset content hash + resolved column pair + engine + engine/script
+# version, so a re-uploaded identical file or an edited stat_tests.R map to the
+# right entries. Each entry holds the analysis result (recommended_test/stats)
+# and the PNG bytes of its plot, which lets /export reuse what /analyze computed.
+#
+# Memory tier: LRU bounded by RESULT_CACHE_MAX_BYTES, entries expire after
+# RESULT_CACHE_TTL seconds. Optional disk tier under RESULT_CACHE_DIR (unset =
+# memory only) survives restarts and is shared by all server workers. A disk
+# hit touches the entry's .json, so its mtime is the last use; a background
+# sweeper (every RESULT_CACHE_SWEEP_INTERVAL seconds) drops entries unused for
+# RESULT_CACHE_TTL seconds, then the least recently used ones until the tier
+# fits in RESULT_CACHE_DISK_MAX_BYTES, and leftovers of interrupted writes.
+# Async callers use get_async()/put_async(): memory hits answer inline, disk
+# reads and writes run in a worker thread.
+
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", str(24 * 3600)))
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "")
+RESULT_CACHE_DISK_MAX_BYTES = int(os.environ.get("RESULT_CACHE_DISK_MAX_BYTES", str(1024 * 1024 * 1024)))
+RESULT_CACHE_SWEEP_INTERVAL = float(os.environ.get("RESULT_CACHE_SWEEP_INTERVAL", "600"))
+# interrupted writes older than this are garbage
+_STALE_SECONDS = 3600
+
+
+def make_key(content_hash: str, x: str, y: str, engine: str, version: str) -> str:
+    raw = json.dumps([content_hash, x, y, engine, version], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, max_bytes=RESULT_CACHE_MAX_BYTES, ttl=RESULT_CACHE_TTL, disk_dir=RESULT_CACHE_DIR,
+                 disk_max_bytes=RESULT_CACHE_DISK_MAX_BYTES, sweep_interval=RESULT_CACHE_SWEEP_INTERVAL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir or None
+        self.disk_max_bytes = disk_max_bytes
+        self.sweep_interval = sweep_interval
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+        self._entries = OrderedDict()  # key -> (stored_at, size, result, plot_bytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        self.disk_bytes = None
+        self.sweeps = 0
+        self._sweeper = None
+
+    @staticmethod
+    def _entry_size(result, plot_bytes) -> int:
+        return len(json.dumps(result, ensure_ascii=False, default=str)) + len(plot_bytes or b"")
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl > 0 and (time.time() - stored_at) > self.ttl
+
+    def _put_memory(self, key, stored_at, result, plot_bytes):
+        size = self._entry_size(result, plot_bytes)
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old[1]
+        self._entries[key] = (stored_at, size, result, plot_bytes)
+        self._bytes += size
+        while self._bytes > self.max_bytes and self._entries:
+            _, (_, evicted_size, _, _) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def _disk_paths(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json"), os.path.join(self.disk_dir, f"{key}.png")
+
+    @staticmethod
+    def _remove_files(*paths):
+        for p in paths:
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+    def _get_disk(self, key):
+        json_path, png_path = self._disk_paths(key)
+        try:
+            with open(json_path, "r", encoding="utf-8") as f:
+                doc = json.load(f)
+        except Exception:
+            return None
+        if self._expired(doc.get("stored_at", 0)):
+            self._remove_files(json_path, png_path)
+            return None
+        plot_bytes = None
+        if doc.get("has_plot"):
+            try:
+                with open(png_path, "rb") as f:
+                    plot_bytes = f.read()
+            except Exception:
+                return None
+        try:
+            os.utime(json_path)
+        except OSError:
+            pass
+        return doc["stored_at"], doc["result"], plot_bytes
+
+    def _put_disk(self, key, stored_at, result, plot_bytes):
+        json_path, png_path = self._disk_paths(key)
+        try:
+            if plot_bytes:
+                tmp = png_path + ".tmp"
+                with open(tmp, "wb") as f:
+                    f.write(plot_bytes)
+                os.replace(tmp, png_path)
+            tmp = json_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"stored_at": stored_at, "result": result, "has_plot": bool(plot_bytes)}, f, ensure_ascii=False, default=str)
+            os.replace(tmp, json_path)
+        except Exception as e:
+            print(f"[result_cache] disk write failed: {e}")
+
+    def _lookup_memory(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, size, result, plot_bytes = entry
+                if not self._expired(stored_at):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return result, plot_bytes
+                self._entries.pop(key)
+                self._bytes -= size
+        return None
+
+    def _lookup_disk(self, key):
+        found = self._get_disk(key)
+        if found is None:
+            return None
+        stored_at, result, plot_bytes = found
+        with self._lock:
+            self._put_memory(key, stored_at, result, plot_bytes)
+            self.disk_hits += 1
+        return result, plot_bytes
+
+    def _miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def get(self, key):
+        """Return (result, plot_bytes) or None."""
+        hit = self._lookup_memory(key)
+        if hit is None and self.disk_dir:
+            hit = self._lookup_disk(key)
+        if hit is None:
+            self._miss()
+        return hit
+
+    async def get_async(self, key):
+        """get() for the event loop: the disk tier is read in a worker thread."""
+        hit = self._lookup_memory(key)
+        if hit is None and self.disk_dir:
+            hit = await asyncio.get_running_loop().run_in_executor(None, self._lookup_disk, key)
+        if hit is None:
+            self._miss()
+        return hit
+
+    def put(self, key, result, plot_bytes=None):
+        stored_at = time.time()
+        with self._lock:
+            self._put_memory(key, stored_at, result, plot_bytes)
+        if self.disk_dir:
+            self._put_disk(key, stored_at, result, plot_bytes)
+
+    async def put_async(self, key, result, plot_bytes=None):
+        """put() for the event loop: the disk tier is written in a worker thread."""
+        stored_at = time.time()
+        with self._lock:
+            self._put_memory(key, stored_at, result, plot_bytes)
+        if self.disk_dir:
+            await asyncio.get_running_loop().run_in_executor(None, self._put_disk, key, stored_at, result, plot_bytes)
+
+    def sweep(self):
+        """One sweeper pass over the disk tier: TTL, then LRU down to disk_max_bytes, then leftovers."""
+        if not self.disk_dir:
+            return
+        now = time.time()
+        entries, names = [], set(os.listdir(self.disk_dir))
+        for name in names:
+            path = os.path.join(self.disk_dir, name)
+            key = name[:-len(".json")] if name.endswith(".json") else None
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if key is None:
+                # a .png without its .json, or a .tmp of a write that never finished
+                orphan = name.endswith(".png") and f"{name[:-len('.png')]}.json" not in names
+                if (orphan or name.endswith(".tmp")) and now - st.st_mtime > _STALE_SECONDS:
+                    self._remove_files(path)
+                continue
+            size = st.st_size
+            if f"{key}.png" in names:
+                try:
+                    size += os.path.getsize(os.path.join(self.disk_dir, f"{key}.png"))
+                except OSError:
+                    pass
+            entries.append((st.st_mtime, size, key))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for last_used, size, key in entries:
+            # last use >= stored_at: unused for the TTL means expired; read-time checks catch the rest
+            expired = self.ttl > 0 and now - last_used > self.ttl
+            over_quota = self.disk_max_bytes > 0 and total > self.disk_max_bytes
+            if not (expired or over_quota):
+                continue
+            self._remove_files(*self._disk_paths(key))
+            total -= size
+            evicted += 1
+        with self._lock:
+            self.disk_evictions += evicted
+            self.disk_bytes = total
+            self.sweeps += 1
+
+    async def _sweep_loop(self):
+        while True:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.sweep)
+            except Exception as e:
+                print(f"[result_cache] sweep failed: {e}")
+            await asyncio.sleep(self.sweep_interval)
+
+    def start_sweeper(self):
+        if self._sweeper is None and self.disk_dir and self.sweep_interval > 0:
+            self._sweeper = asyncio.ensure_future(self._sweep_loop())
+
+    def stop_sweeper(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "disk_dir": self.disk_dir,
+                "disk_bytes": self.disk_bytes,
+                "disk_max_bytes": self.disk_max_bytes,
+                "disk_evictions": self.disk_evictions,
+                "sweeps": self.sweeps,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+cache = ResultCache()
@@ -0,0 +1,70 @@
+import os
+import functools
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+from .. import py_engine
+from . import dataset_service
+
+# Helpers for /analyze/batch.
+#
+# Pairs on the Python engine run in a pool of processes, so a screening run
+# uses every core instead of one GIL. Workers read columns straight from the
+# snapshot (memory-mapped .npy files, shared through the page cache) and keep
+# the last few columns in memory - in "one Y vs all" every pair reuses Y.
+# R pairs go through the existing R worker pool (backend/r_pool.py).
+
+BATCH_MAX_PAIRS = int(os.environ.get("BATCH_MAX_PAIRS", "500"))
+PY_POOL_SIZE = int(os.environ.get("PY_POOL_SIZE", str(max(1, os.cpu_count() or 1))))
+_COLUMN_CACHE_SIZE = 16
+
+_executor = None
+
+
+def pair_specs(payload: dict, headers: list) -> list:
+    """Requested (x, y) pairs, as sent: {"pairs": [[x, y], {"x": .., "y": ..}]} or {"y": .., "against": "all"}."""
+    pairs = payload.get("pairs")
+    if pairs:
+        out = []
+        for p in pairs:
+            if isinstance(p, dict):
+                out.append((p.get("x"), p.get("y")))
+            elif isinstance(p, (list, tuple)) and len(p) == 2:
+                out.append((p[0], p[1]))
+            else:
+                raise ValueError(f"Niepoprawna para kolumn: {p}")
+        return out
+    y = payload.get("y")
+    if y is None:
+        return []
+    against = payload.get("against", "all")
+    xs = headers if against == "all" else against
+    if not isinstance(xs, list):
+        raise ValueError("Pole 'against' musi być listą kolumn lub 'all'")
+    return [(x, y) for x in xs]
+
+
+@functools.lru_cache(maxsize=_COLUMN_CACHE_SIZE)
+def _column(snapshot_dir: str, content_hash: str, name: str):
+    # content_hash keeps entries of a rebuilt/appended snapshot apart
+    manifest = dataset_service.load_manifest(snapshot_dir)
+    return dataset_service.load_analysis_column(snapshot_dir, manifest, name)
+
+
+def run_python_pair(snapshot_dir: str, content_hash: str, x: str, y: str):
+    """Worker entry point: one pair on the Python engine."""
+    return py_engine.run_analysis(_column(snapshot_dir, content_hash, x), _column(snapshot_dir, content_hash, y))
+
+
+def executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=PY_POOL_SIZE, mp_context=mp.get_context("spawn"))
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
@@ -0,0 +1,489 @@
+import os
+import io
+import copy
+import json
+import codecs
+import shutil
+import functools
+import unicodedata
+import numpy as np
+import pandas as pd
+
+from .. import py_engine
+
+# Columnar snapshot of an uploaded CSV.
+#
+# The raw upload is parsed at upload time and every column is stored as a typed .npy file inside ``<file_id>.snapshot/``:
+#   - numeric columns -> float64 array, NaN for missing values
+#   - text columns    -> int32 codes array (-1 for missing) + levels array
+# ``columns.json`` keeps the header order, the column kinds and the file names.
+# Text columns also get their levels coerced to numbers once at ingest
+# (``c<i>.coerced.npy``, same heuristics as stat_tests.R); when the column passes
+# R's acceptance rule, analyses read it as float64 without re-parsing strings.
+# Missing values follow R's read.table defaults ("NA"; empty cells only in
+# numeric columns), so R sees the same data as when it parsed the raw file.
+# The manifest also carries a column lookup index (exact / ASCII-folded /
+# lower-cased name -> position), so resolving a requested column is a dict
+# lookup instead of normalizing every header on each request.
+# Rows of a later survey wave are appended in place (append_snapshot): column
+# files grow at the end and readers only look at the first manifest["rows"]
+# values, so the new rows appear atomically with the rewritten manifest.
+
+SNAPSHOT_VERSION = 2
+_R_NA_STRINGS = ("NA",)
+# rows per pandas chunk while building a snapshot; bounds peak memory
+SNAPSHOT_CHUNK_ROWS = int(os.environ.get("SNAPSHOT_CHUNK_ROWS", "200000"))
+
+
+def snapshot_dir_for(upload_dir: str, file_id: str) -> str:
+    return os.path.join(upload_dir, f"{file_id}.snapshot")
+
+
+def ascii_fold(s: str) -> str:
+    """Header without diacritics (NFKD, non-ASCII dropped): 'Płeć' -> 'Pe'."""
+    nk = unicodedata.normalize("NFKD", s)
+    return nk.encode("ASCII", "ignore").decode("ASCII")
+
+
+def build_column_index(headers: list) -> dict:
+    """Lookup maps name -> position; the first of duplicate keys wins, as in the old linear scans."""
+    index = {"exact": {}, "ascii": {}, "lower": {}}
+    for i, h in enumerate(headers):
+        index["exact"].setdefault(h, i)
+        index["ascii"].setdefault(ascii_fold(h), i)
+        index["lower"].setdefault(h.lower(), i)
+    return index
+
+
+def column_index(manifest) -> dict:
+    index = manifest.get("index")
+    if index is None:
+        index = manifest["index"] = build_column_index(snapshot_headers(manifest))
+    return index
+
+
+def column_position(manifest, sent):
+    """0-based position of a requested column: exact name, then ASCII-folded header, then case-insensitive."""
+    index = column_index(manifest)
+    pos = index["exact"].get(sent)
+    if pos is None:
+        pos = index["ascii"].get(str(sent))
+    if pos is None:
+        pos = index["lower"].get(str(sent).lower())
+    return pos
+
+
+def resolve_column(manifest, sent):
+    """Header name of a requested column, or None."""
+    pos = column_position(manifest, sent)
+    return None if pos is None else manifest["columns"][pos]["name"]
+
+
+def column_entry(manifest, name: str) -> dict:
+    pos = column_index(manifest)["exact"].get(name)
+    if pos is None:
+        raise KeyError(name)
+    return manifest["columns"][pos]
+
+
+def _read_chunks(csv_path: str, encoding: str, delimiter: str, chunk_rows: int, ncols: int, dtype=None, na_values=None):
+    # positional names avoid pandas' duplicate-header mangling inside the parser
+    enc = encoding if encoding and encoding != "unknown" else None
+    return pd.read_csv(csv_path, encoding=enc, sep=delimiter or ",", header=0,
+                       names=[f"c{i}" for i in range(ncols)], dtype=dtype,
+                       keep_default_na=False, na_values=na_values if na_values is not None else ["NA", ""],
+                       encoding_errors="replace", chunksize=chunk_rows)
+
+
+def _read_header(csv_path: str, encoding: str, delimiter: str):
+    enc = encoding if encoding and encoding != "unknown" else None
+    return pd.read_csv(csv_path, encoding=enc, sep=delimiter or ",", dtype=str, nrows=0,
+                       encoding_errors="replace").columns.tolist()
+
+
+def _open_array(path: str, dtype, rows: int):
+    if rows == 0:
+        np.save(path, np.empty(0, dtype=dtype))
+        return None
+    return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(rows,))
+
+
+def _global_codes(values: pd.Series, levels: dict):
+    """Map a chunk of strings (NaN = missing) to stable int32 codes shared across chunks."""
+    local_codes, uniques = pd.factorize(values, use_na_sentinel=True)
+    ids = np.empty(len(uniques) + 1, dtype=np.int32)
+    ids[-1] = -1
+    for j, u in enumerate(uniques):
+        code = levels.get(u)
+        if code is None:
+            code = levels[u] = len(levels)
+        ids[j] = code
+    return ids[local_codes]
+
+
+def _coerce_levels(snapshot_dir: str, col: dict, i: int, levels, rows: int, chunk_rows: int):
+    """Coerce the distinct values of a text column once and record R's accept/reject decision."""
+    coerced = py_engine.coerce_strings(levels) if levels.shape[0] else np.empty(0, dtype=np.float64)
+    n_good = 0
+    if rows and levels.shape[0]:
+        codes = np.load(os.path.join(snapshot_dir, col["file"]), mmap_mode="r")
+        parsed = ~np.isnan(coerced)
+        for start in range(0, rows, chunk_rows):
+            chunk = np.asarray(codes[start:start + chunk_rows])
+            chunk = chunk[chunk >= 0]
+            n_good += int(np.count_nonzero(parsed[chunk]))
+        del codes
+    col["coerced"] = f"c{i}.coerced.npy"
+    col["coerced_count"] = n_good
+    col["coerces_numeric"] = py_engine.coercion_accepted(n_good, rows)
+    np.save(os.path.join(snapshot_dir, col["coerced"]), coerced)
+
+
+def build_snapshot(csv_path: str, snapshot_dir: str, encoding: str = None, delimiter: str = None,
+                   chunk_rows: int = None):
+    """Parse the CSV in chunks and write one typed .npy file per column.
+
+    Two streaming passes keep memory bounded by the chunk size: the first one
+    lets the C parser infer which columns are numeric and counts rows, the
+    second one parses with fixed dtypes into memory-mapped .npy files.
+    """
+    chunk_rows = chunk_rows or SNAPSHOT_CHUNK_ROWS
+    names = _read_header(csv_path, encoding, delimiter)
+    ncols = len(names)
+
+    # pass 1: column kinds + row count ("NA" and empty cells are missing, as in R)
+    numeric = [True] * ncols
+    has_value = [False] * ncols
+    rows = 0
+    for chunk in _read_chunks(csv_path, encoding, delimiter, chunk_rows, ncols):
+        rows += int(chunk.shape[0])
+        for i in range(ncols):
+            if not numeric[i]:
+                continue
+            col = chunk.iloc[:, i]
+            if col.dtype.kind not in "if":
+                # object (text) or bool (TRUE/FALSE -> logical in R)
+                numeric[i] = False
+                continue
+            if not has_value[i] and col.notna().any():
+                has_value[i] = True
+    # an all-missing column is logical in R, not numeric
+    numeric = [numeric[i] and has_value[i] for i in range(ncols)]
+
+    tmp_dir = snapshot_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    columns = []
+    arrays = []
+    level_maps = []
+    for i, name in enumerate(names):
+        if numeric[i]:
+            fname = f"c{i}.npy"
+            arrays.append(_open_array(os.path.join(tmp_dir, fname), np.float64, rows))
+            columns.append({"name": name, "kind": "numeric", "file": fname})
+            level_maps.append(None)
+        else:
+            fname = f"c{i}.codes.npy"
+            arrays.append(_open_array(os.path.join(tmp_dir, fname), np.int32, rows))
+            columns.append({"name": name, "kind": "text", "file": fname, "levels": f"c{i}.levels.npy"})
+            level_maps.append({})
+
+    # pass 2: fill the arrays; empty cells stay "" in text columns (a level, like in R)
+    dtype = {f"c{i}": (np.float64 if numeric[i] else str) for i in range(ncols)}
+    na_values = {f"c{i}": (["NA", ""] if numeric[i] else ["NA"]) for i in range(ncols)}
+    offset = 0
+    if rows:
+        for chunk in _read_chunks(csv_path, encoding, delimiter, chunk_rows, ncols, dtype=dtype, na_values=na_values):
+            n = int(chunk.shape[0])
+            for i in range(ncols):
+                values = chunk.iloc[:, i]
+                if numeric[i]:
+                    arrays[i][offset:offset + n] = values.to_numpy(dtype=np.float64)
+                else:
+                    arrays[i][offset:offset + n] = _global_codes(values, level_maps[i])
+            offset += n
+    for arr in arrays:
+        if arr is not None:
+            arr.flush()
+    del arrays
+
+    for i, col in enumerate(columns):
+        if col["kind"] == "text":
+            levels = np.array(list(level_maps[i].keys()), dtype=str)
+            np.save(os.path.join(tmp_dir, col["levels"]), levels)
+            _coerce_levels(tmp_dir, col, i, levels, rows, chunk_rows)
+
+    manifest = {"version": SNAPSHOT_VERSION, "rows": rows, "columns": columns,
+                "index": build_column_index([c["name"] for c in columns])}
+    with open(os.path.join(tmp_dir, "columns.json"), "w", encoding="utf-8") as mf:
+        json.dump(manifest, mf, ensure_ascii=False)
+
+    # swap in atomically so readers never see a half-written snapshot
+    shutil.rmtree(snapshot_dir, ignore_errors=True)
+    os.replace(tmp_dir, snapshot_dir)
+    return manifest
+
+
+def load_manifest(snapshot_dir: str):
+    path = os.path.join(snapshot_dir, "columns.json")
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    # parsed once per snapshot build; a rebuilt snapshot has a new mtime
+    return _read_manifest(path, st.st_mtime_ns, st.st_size)
+
+
+@functools.lru_cache(maxsize=64)
+def _read_manifest(path: str, mtime_ns: int, size: int):
+    try:
+        with open(path, "r", encoding="utf-8") as mf:
+            manifest = json.load(mf)
+    except Exception:
+        return None
+    if manifest.get("version") != SNAPSHOT_VERSION:
+        return None
+    column_index(manifest)
+    return manifest
+
+
+def snapshot_headers(manifest) -> list:
+    return [c["name"] for c in manifest["columns"]]
+
+
+def _load_data(snapshot_dir: str, manifest, col: dict):
+    # an append in progress may already have written rows past the manifest's count
+    path = os.path.join(snapshot_dir, col["file"])
+    rows = int(manifest["rows"])
+    if not rows:
+        return np.load(path)[:0]
+    return np.array(np.load(path, mmap_mode="r")[:rows])
+
+
+def load_column(snapshot_dir: str, manifest, name: str):
+    """Return a column as a float64 array (numeric) or an object array of str/None (text)."""
+    col = column_entry(manifest, name)
+    data = _load_data(snapshot_dir, manifest, col)
+    if col["kind"] == "numeric":
+        return data
+    levels = np.load(os.path.join(snapshot_dir, col["levels"])).astype(object)
+    out = np.empty(data.shape[0], dtype=object)
+    present = data >= 0
+    out[present] = levels[data[present]]
+    out[~present] = None
+    return out
+
+
+def load_analysis_column(snapshot_dir: str, manifest, name: str):
+    """Column as the analysis sees it: text that R would coerce to numbers comes back as float64.
+
+    Uses the per-level values coerced at ingest, so this is a single gather
+    instead of string parsing over every row.
+    """
+    col = column_entry(manifest, name)
+    if col["kind"] != "text" or not col.get("coerces_numeric"):
+        return load_column(snapshot_dir, manifest, name)
+    codes = _load_data(snapshot_dir, manifest, col)
+    coerced = np.load(os.path.join(snapshot_dir, col["coerced"]))
+    out = np.full(codes.shape[0], np.nan, dtype=np.float64)
+    present = codes >= 0
+    out[present] = coerced[codes[present]]
+    return out
+
+
+def load_analysis_vector(snapshot_dir: str, manifest, name: str):
+    """Column for the in-memory R hand-off: ``(float64 values, None)`` or ``(int32 codes, levels)`` for text.
+
+    Same data as load_analysis_column, but text stays as codes (-1 for missing)
+    plus a list of level strings, so no per-row Python objects are built.
+    """
+    col = column_entry(manifest, name)
+    if col["kind"] != "text" or col.get("coerces_numeric"):
+        return load_analysis_column(snapshot_dir, manifest, name), None
+    codes = _load_data(snapshot_dir, manifest, col)
+    levels = np.load(os.path.join(snapshot_dir, col["levels"])).astype(object)
+    return codes.astype(np.int32, copy=False), [str(v) for v in levels]
+
+
+def write_projected_csv(snapshot_dir: str, manifest, names: list, out_path: str):
+    """Write only the requested columns as a UTF-8, comma separated CSV (text already coerced where R would)."""
+    data = {i: load_analysis_column(snapshot_dir, manifest, n) for i, n in enumerate(names)}
+    pd.DataFrame(data).to_csv(out_path, index=False, header=list(names), na_rep="NA", encoding="utf-8")
+    return out_path
+
+
+def write_manifest(snapshot_dir: str, manifest):
+    path = os.path.join(snapshot_dir, "columns.json")
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as mf:
+        json.dump(manifest, mf, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def column_version(manifest, name: str, default: str) -> str:
+    """Data version of a column: set by appends that change it, else the dataset's content hash."""
+    return column_entry(manifest, name).get("version") or default
+
+
+def _append_npy(path: str, values, offset: int):
+    """Write values after the first `offset` elements of a 1-D .npy file and grow its header.
+
+    numpy pads .npy headers so the length field can grow in place; files
+    without that room are rewritten.
+    """
+    values = np.ascontiguousarray(values)
+    fmt = np.lib.format
+    with open(path, "r+b") as f:
+        version = fmt.read_magic(f)
+        read_header = fmt.read_array_header_1_0 if version == (1, 0) else fmt.read_array_header_2_0
+        _, _, dtype = read_header(f)
+        data_start = f.tell()
+        header = io.BytesIO()
+        d = {"descr": fmt.dtype_to_descr(dtype), "fortran_order": False, "shape": (offset + values.shape[0],)}
+        (fmt.write_array_header_1_0 if version == (1, 0) else fmt.write_array_header_2_0)(header, d)
+        if header.tell() == data_start:
+            f.seek(data_start + offset * dtype.itemsize)
+            f.write(values.astype(dtype, copy=False).tobytes())
+            f.truncate()
+            # data first: a crash before this line leaves the old length in the header
+            f.seek(0)
+            f.write(header.getvalue())
+            return
+    old = np.load(path, mmap_mode="r")[:offset] if offset else np.empty(0, dtype=values.dtype)
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, np.concatenate([old, values.astype(old.dtype, copy=False)]))
+    del old
+    os.replace(path + ".tmp", path)
+
+
+def _save_npy(path: str, arr):
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, arr)
+    os.replace(path + ".tmp", path)
+
+
+def append_snapshot(csv_path: str, snapshot_dir: str, manifest, encoding: str = None, delimiter: str = None,
+                    chunk_rows: int = None):
+    """Append the rows of a CSV with the same header to the snapshot, in place.
+
+    Only the new rows are parsed: column files grow at the end, text columns
+    get their new levels (coerced once, like at build time) and an updated
+    coercion decision. Returns the new manifest; the caller publishes it with
+    write_manifest(), until then readers see the old rows. Returns None when a
+    column would change kind (text in a numeric column, the first values of an
+    all-missing column) - such a dataset needs a full build_snapshot().
+    Raises ValueError when the header differs.
+    """
+    chunk_rows = chunk_rows or SNAPSHOT_CHUNK_ROWS
+    names = _read_header(csv_path, encoding, delimiter)
+    headers = snapshot_headers(manifest)
+    if names != headers:
+        missing = [h for h in headers if h not in names]
+        extra = [n for n in names if n not in headers]
+        detail = f"brakujące: {missing}, nadmiarowe: {extra}" if missing or extra else "inna kolejność kolumn"
+        raise ValueError(f"Nagłówek dopisywanego pliku nie zgadza się z zestawem danych ({detail})")
+    ncols = len(names)
+    manifest = copy.deepcopy(manifest)
+    columns = manifest["columns"]
+    old_rows = int(manifest["rows"])
+    levels = [np.load(os.path.join(snapshot_dir, c["levels"])) if c["kind"] == "text" else None for c in columns]
+
+    # pass 1: row count and kind check over the new rows; nothing is written yet
+    rows = 0
+    for chunk in _read_chunks(csv_path, encoding, delimiter, chunk_rows, ncols):
+        rows += int(chunk.shape[0])
+        for i, col in enumerate(columns):
+            values = chunk.iloc[:, i]
+            if col["kind"] == "numeric":
+                if values.dtype.kind not in "if":
+                    return None
+            elif levels[i].shape[0] == 0 and values.dtype.kind in "if" and values.notna().any():
+                return None
+    if rows == 0:
+        return manifest
+
+    # pass 2: same dtypes and missing values as build_snapshot
+    level_maps = [None if lv is None else {str(v): j for j, v in enumerate(lv)} for lv in levels]
+    dtype = {f"c{i}": (np.float64 if c["kind"] == "numeric" else str) for i, c in enumerate(columns)}
+    na_values = {f"c{i}": (["NA", ""] if c["kind"] == "numeric" else ["NA"]) for i, c in enumerate(columns)}
+    offset = old_rows
+    for chunk in _read_chunks(csv_path, encoding, delimiter, chunk_rows, ncols, dtype=dtype, na_values=na_values):
+        n = int(chunk.shape[0])
+        for i, col in enumerate(columns):
+            values = chunk.iloc[:, i]
+            path = os.path.join(snapshot_dir, col["file"])
+            if col["kind"] == "numeric":
+                _append_npy(path, values.to_numpy(dtype=np.float64), offset)
+            else:
+                _append_npy(path, _global_codes(values, level_maps[i]), offset)
+        offset += n
+    total = old_rows + rows
+
+    for i, col in enumerate(columns):
+        if col["kind"] != "text":
+            continue
+        old_levels = levels[i]
+        coerced = np.load(os.path.join(snapshot_dir, col["coerced"]))[:old_levels.shape[0]]
+        if "coerced_count" not in col:
+            # manifests written before appends existed: count the old rows once
+            _coerce_levels(snapshot_dir, col, i, old_levels, old_rows, chunk_rows)
+        if len(level_maps[i]) > old_levels.shape[0]:
+            all_levels = np.array(list(level_maps[i].keys()), dtype=str)
+            coerced = np.concatenate([coerced, py_engine.coerce_strings(all_levels[old_levels.shape[0]:])])
+            _save_npy(os.path.join(snapshot_dir, col["levels"]), all_levels)
+            _save_npy(os.path.join(snapshot_dir, col["coerced"]), coerced)
+        parsed = ~np.isnan(coerced)
+        codes = np.load(os.path.join(snapshot_dir, col["file"]), mmap_mode="r")
+        n_good = col["coerced_count"]
+        for start in range(old_rows, total, chunk_rows):
+            part = np.asarray(codes[start:min(start + chunk_rows, total)])
+            n_good += int(np.count_nonzero(parsed[part[part >= 0]]))
+        del codes
+        col["coerced_count"] = n_good
+        col["coerces_numeric"] = py_engine.coercion_accepted(n_good, total)
+    manifest["rows"] = total
+    return manifest
+
+
+def encode_appended_rows(src_path: str, src_encoding: str, dst_path: str, dst_encoding: str, out_path: str,
+                         chunk_size: int = 1 << 20):
+    """Data rows of src_path (header dropped) in the encoding of dst_path, written to out_path.
+
+    out_path starts with a line break when dst_path does not end with one, so
+    its bytes can be appended to dst_path as they are. Raises ValueError when a
+    character cannot be written in the dataset's encoding.
+    """
+    with open(dst_path, "rb") as f:
+        head = f.read(4)
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(0, size - 4))
+        tail = f.read()
+    dst_enc = dst_encoding if dst_encoding and dst_encoding != "unknown" else "utf-8"
+    if codecs.lookup(dst_enc).name in ("utf-16", "utf-32"):
+        # the codec would put a BOM in front of every write; continue in the file's byte order
+        bom = codecs.BOM_UTF16_LE if codecs.lookup(dst_enc).name == "utf-16" else codecs.BOM_UTF32_LE
+        dst_enc = f"{codecs.lookup(dst_enc).name}-{'le' if head.startswith(bom) else 'be'}"
+    src_enc = src_encoding if src_encoding and src_encoding != "unknown" else "utf-8"
+    if codecs.lookup(src_enc).name == "utf-8":
+        src_enc = "utf-8-sig"
+    decoder = codecs.getincrementaldecoder(src_enc)(errors="replace")
+    encoder = codecs.getincrementalencoder(dst_enc)()
+    newline = "\n".encode(dst_enc)
+    in_header = True
+    with open(src_path, "rb") as src, open(out_path, "wb") as out:
+        if size and not tail.endswith(newline):
+            out.write(newline)
+        while True:
+            raw = src.read(chunk_size)
+            text = decoder.decode(raw, final=not raw)
+            if in_header:
+                cut = text.find("\n")
+                text = "" if cut < 0 else text[cut + 1:]
+                in_header = cut < 0
+            try:
+                out.write(encoder.encode(text, final=not raw))
+            except UnicodeEncodeError as e:
+                raise ValueError(f"Znak {e.object[e.start:e.end]!r} nie istnieje w kodowaniu zestawu danych ({dst_enc})") from e
+            if not raw:
+                break
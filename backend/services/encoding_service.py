@@ -0,0 +1,142 @@
+import os
+import csv
+import codecs
+import numpy as np
+
+try:
+    import chardet
+except Exception:
+    chardet = None
+
+# Encoding and delimiter detection for uploaded CSVs.
+#
+# Cheap, exact checks first, chardet (pure Python, slow) only when they all
+# fail:
+#   1. byte order mark (UTF-8 / UTF-16 / UTF-32)
+#   2. NUL bytes -> UTF-16 without BOM (ASCII text with every other byte 0)
+#   3. strict UTF-8 decode of the sample (pure ASCII counts as UTF-8)
+#   4. Polish data in a single-byte code page: cp1250 and ISO-8859-2 share
+#      most Polish letters, but ą ś ź Ą Ś Ź sit on different bytes, so their
+#      byte frequencies decide between the two
+#   5. chardet on at most CHARDET_SAMPLE_BYTES of the sample
+# The delimiter is the candidate that splits the first lines into the same
+# number (> 1) of fields, with csv.Sniffer as the fallback.
+
+CHARDET_SAMPLE_BYTES = int(os.environ.get("CHARDET_SAMPLE_BYTES", "32768"))
+DELIMITER_SNIFF_LINES = 50
+DELIMITERS = [",", ";", "\t", "|"]
+
+_BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+_PL_LETTERS = "ąćęłńóśźżĄĆĘŁŃÓŚŹŻ"
+_CP1250_PL = set(_PL_LETTERS.encode("cp1250"))
+_LATIN2_PL = set(_PL_LETTERS.encode("iso-8859-2"))
+_CP1250_ONLY = np.array(sorted(_CP1250_PL - _LATIN2_PL))
+_LATIN2_ONLY = np.array(sorted(_LATIN2_PL - _CP1250_PL))
+_PL_ANY = np.array(sorted(_CP1250_PL | _LATIN2_PL))
+# share of non-ASCII bytes that must be Polish letters before the heuristic decides
+_PL_MIN_SHARE = 0.6
+
+
+def normalize_encoding(enc: str):
+    if not enc:
+        return enc
+    e = enc.lower()
+    if e.startswith("windows-"):
+        e = e.replace("windows-", "cp")
+    if e in ("iso-8859-1", "latin1"):
+        return "latin1"
+    if e.startswith("utf-8") or e == "ascii":
+        return "utf-8"
+    return e
+
+
+def _polish_code_page(sample: bytes):
+    counts = np.bincount(np.frombuffer(sample, dtype=np.uint8), minlength=256)
+    non_ascii = int(counts[128:].sum())
+    if not non_ascii or counts[_PL_ANY].sum() < _PL_MIN_SHARE * non_ascii:
+        return None
+    cp1250, latin2 = int(counts[_CP1250_ONLY].sum()), int(counts[_LATIN2_ONLY].sum())
+    if cp1250 == latin2:
+        return None
+    return "cp1250" if cp1250 > latin2 else "iso-8859-2"
+
+
+def detect_encoding(sample: bytes):
+    """(encoding, how it was found) for the first bytes of a file."""
+    for bom, enc in _BOMS:
+        if sample.startswith(bom):
+            return enc, "bom"
+    if b"\x00" in sample:
+        head = sample[:1000]
+        odd_nuls = head[1::2].count(0)
+        even_nuls = head[0::2].count(0)
+        if odd_nuls > even_nuls:
+            return "utf-16-le", "nul"
+        if even_nuls > odd_nuls:
+            return "utf-16-be", "nul"
+    try:
+        # final=False: the sample may end inside a multi-byte character
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8", "utf-8"
+    except UnicodeDecodeError:
+        pass
+    enc = _polish_code_page(sample)
+    if enc:
+        return enc, "polish"
+    if chardet is not None:
+        try:
+            enc = normalize_encoding(chardet.detect(sample[:CHARDET_SAMPLE_BYTES]).get("encoding") or "")
+        except Exception:
+            enc = None
+        if enc:
+            return enc, "chardet"
+    return "cp1250", "default"
+
+
+def _sniff_delimiter(text: str):
+    try:
+        return csv.Sniffer().sniff(text, delimiters=DELIMITERS).delimiter
+    except Exception:
+        pass
+    lines = text.splitlines()
+    if not lines:
+        return ","
+    header = lines[0]
+    counts = {c: header.count(c) for c in DELIMITERS}
+    best = max(counts.items(), key=lambda kv: kv[1])
+    return best[0] if best[1] > 0 else ","
+
+
+def detect_delimiter(text: str, truncated: bool = True):
+    """Delimiter giving a consistent field count (> 1) over the first lines."""
+    lines = text.splitlines()
+    if truncated and len(lines) > 1:
+        lines = lines[:-1]  # the last line of a sample may be cut off
+    lines = [ln for ln in lines[:DELIMITER_SNIFF_LINES + 1] if ln.strip()]
+    if not lines:
+        return ","
+    best, best_fields = None, 1
+    for d in DELIMITERS:
+        try:
+            widths = [len(row) for row in csv.reader(lines, delimiter=d) if row]
+        except csv.Error:
+            continue
+        if widths and widths[0] > best_fields and all(w == widths[0] for w in widths):
+            best, best_fields = d, widths[0]
+    if best is not None:
+        return best
+    return _sniff_delimiter("\n".join(lines))
+
+
+def detect(sample: bytes, truncated: bool = True) -> dict:
+    """Encoding and delimiter of a CSV from its first bytes."""
+    encoding, source = detect_encoding(sample)
+    text = codecs.getincrementaldecoder(encoding)(errors="replace").decode(sample, final=not truncated)
+    return {"encoding": encoding, "encoding_source": source, "delimiter": detect_delimiter(text.lstrip("\ufeff"), truncated)}
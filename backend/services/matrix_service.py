@@ -0,0 +1,279 @@
+import os
+import math
+import numpy as np
+from scipy import stats as sps
+
+from . import dataset_service
+
+# All-pairs association matrix over a set of columns (POST /analyze/matrix).
+#
+# Instead of one test per pair, every measure comes out of a few matrix
+# products over blocks of rows:
+#   - numeric x numeric: Pearson's r and Spearman's rho on pairwise complete
+#     observations, p-values from the t distribution with n - 2 df. Spearman is
+#     Pearson on the ranks of each column, so this is psych::corr.test /
+#     cor(use = "pairwise.complete.obs"); per-pair cor.test (POST /analyze)
+#     reranks the complete pairs and uses the exact test for small n.
+#   - text x text: Cramer's V of the contingency table, p-value of chisq.test
+#     without continuity correction
+#   - text x numeric: correlation ratio eta, p-value of the one-way ANOVA F test
+# Text columns enter the products as one-hot blocks of their level codes, so
+# every contingency table and per-group sum of a row block is one product.
+# Columns are numeric or text exactly as /analyze sees them (ingest coercion).
+
+MATRIX_VERSION = "1"
+MATRIX_METHODS = ("pearson", "spearman")
+MATRIX_MAX_COLUMNS = int(os.environ.get("MATRIX_MAX_COLUMNS", "300"))
+# text columns with more levels (identifiers, free text) are left out of the matrix
+MATRIX_MAX_LEVELS = int(os.environ.get("MATRIX_MAX_LEVELS", "50"))
+# rows x numeric columns held in memory at once (8 bytes each)
+MATRIX_MAX_CELLS = int(os.environ.get("MATRIX_MAX_CELLS", "50000000"))
+_BLOCK_ROWS = 8192
+# one-hot columns per product; larger level sets are split into groups
+_GROUP_LEVELS = 2048
+
+
+def _load(snapshot_dir: str, manifest, names: list):
+    """(numeric names, n x p matrix with NaN, text names, [(codes, level count)], skipped)."""
+    rows = int(manifest["rows"])
+    num_names, num_values, text_names, text_codes, skipped = [], [], [], [], []
+    for name in names:
+        values, levels = dataset_service.load_analysis_vector(snapshot_dir, manifest, name)
+        if levels is None:
+            num_names.append(name)
+            num_values.append(values)
+        elif len(levels) > MATRIX_MAX_LEVELS:
+            skipped.append({"column": name, "reason": f"za dużo wartości ({len(levels)} > {MATRIX_MAX_LEVELS})"})
+        else:
+            text_names.append(name)
+            text_codes.append((values, len(levels)))
+    if rows * len(num_names) > MATRIX_MAX_CELLS:
+        raise ValueError(f"Za dużo danych dla macierzy: {rows} wierszy x {len(num_names)} kolumn liczbowych "
+                         f"(limit {MATRIX_MAX_CELLS} komórek). Wybierz mniej kolumn.")
+    # column-major: ranking works on one column at a time
+    X = np.empty((rows, len(num_names)), dtype=np.float64, order="F")
+    for j, values in enumerate(num_values):
+        X[:, j] = values
+    return num_names, X, text_names, text_codes, skipped
+
+
+def _column_means(X):
+    """Means of the present values; subtracted before the block sums so they do not cancel."""
+    present = ~np.isnan(X)
+    counts = present.sum(axis=0)
+    means = np.divide(np.nansum(X, axis=0), counts, out=np.zeros(X.shape[1]), where=counts > 0)
+    return means
+
+
+def _numeric_sums(X):
+    """Pairwise complete (n, r) of the columns of X, NaN marking missing values."""
+    p = X.shape[1]
+    means = _column_means(X)
+    N = np.zeros((p, p))
+    Sxy = np.zeros((p, p))
+    Sx = np.zeros((p, p))
+    Sxx = np.zeros((p, p))
+    for start in range(0, X.shape[0], _BLOCK_ROWS):
+        block = X[start:start + _BLOCK_ROWS]
+        present = ~np.isnan(block)
+        M = present.astype(np.float64)
+        Z = np.where(present, block - means, 0.0)
+        N += M.T @ M
+        Sxy += Z.T @ Z
+        # Sx[i, j]: sum of column i over the rows where column j is present too
+        Sx += Z.T @ M
+        Sxx += (Z * Z).T @ M
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cov = Sxy - Sx * Sx.T / N
+        var = Sxx - Sx * Sx / N
+        r = cov / np.sqrt(var * var.T)
+    r = np.clip(r, -1.0, 1.0)
+    np.fill_diagonal(r, np.where(np.diag(var) > 0, 1.0, np.nan))
+    return N, r
+
+
+def _correlation_p(r, n):
+    """Two-sided p-value of cor.test's t statistic, r of n complete pairs."""
+    df = n - 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = r * np.sqrt(df / (1.0 - r * r))
+        p = 2.0 * sps.t.sf(np.abs(t), df)
+    p[np.abs(r) == 1.0] = 0.0
+    p[df < 1] = np.nan
+    return p
+
+
+def _rank_columns(X):
+    """Average ranks of every column over its present values, in place (NaN stays NaN)."""
+    for j in range(X.shape[1]):
+        present = ~np.isnan(X[:, j])
+        X[present, j] = sps.rankdata(X[present, j])
+    return X
+
+
+def _groups(text_codes):
+    """Split the text columns into groups of at most _GROUP_LEVELS one-hot columns: [(indices, offsets, width)]."""
+    groups, current, offsets, width = [], [], [], 0
+    for i, (_, k) in enumerate(text_codes):
+        if current and width + k > _GROUP_LEVELS:
+            groups.append((current, offsets, width))
+            current, offsets, width = [], [], 0
+        current.append(i)
+        offsets.append(width)
+        width += k
+    if current:
+        groups.append((current, offsets, width))
+    return groups
+
+
+def _one_hot(text_codes, group, start, stop):
+    indices, offsets, width = group
+    H = np.zeros((stop - start, width))
+    for i, off in zip(indices, offsets):
+        codes = text_codes[i][0][start:stop]
+        rows = np.nonzero(codes >= 0)[0]
+        H[rows, off + codes[rows]] = 1.0
+    return H
+
+
+def _chi_square(table):
+    """(statistic, df, n) of a contingency table; levels absent from the complete pairs are dropped like table() does."""
+    table = table[table.sum(axis=1) > 0][:, table.sum(axis=0) > 0]
+    n = table.sum()
+    if table.shape[0] < 2 or table.shape[1] < 2:
+        return math.nan, 0, n
+    expected = np.outer(table.sum(axis=1), table.sum(axis=0)) / n
+    return float(((table - expected) ** 2 / expected).sum()), (table.shape[0] - 1) * (table.shape[1] - 1), n
+
+
+def _text_tables(text_codes, rows):
+    """Cramer's V, p and n for every pair of text columns."""
+    m = len(text_codes)
+    chi2, dof, N, smaller = np.full((m, m), np.nan), np.zeros((m, m)), np.zeros((m, m)), np.zeros((m, m))
+    groups = _groups(text_codes)
+    for a, ga in enumerate(groups):
+        for gb in groups[a:]:
+            T = np.zeros((ga[2], gb[2]))
+            for start in range(0, rows, _BLOCK_ROWS):
+                stop = min(start + _BLOCK_ROWS, rows)
+                Ha = _one_hot(text_codes, ga, start, stop)
+                T += Ha.T @ (Ha if gb is ga else _one_hot(text_codes, gb, start, stop))
+            for i, oi in zip(ga[0], ga[1]):
+                for j, oj in zip(gb[0], gb[1]):
+                    if j < i:
+                        continue
+                    table = T[oi:oi + text_codes[i][1], oj:oj + text_codes[j][1]]
+                    chi2[i, j], dof[i, j], N[i, j] = _chi_square(table)
+                    # V's denominator: min(rows, cols) - 1 of the table after dropping empty levels
+                    smaller[i, j] = min(np.count_nonzero(table.sum(axis=1)), np.count_nonzero(table.sum(axis=0))) - 1
+    chi2, dof, N, smaller = (np.triu(a) + np.triu(a, 1).T for a in (chi2, dof, N, smaller))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        V = np.minimum(np.sqrt(chi2 / (N * smaller)), 1.0)
+        P = sps.chi2.sf(chi2, np.maximum(dof, 1))
+    P[dof < 1] = np.nan
+    return V, P, N
+
+
+def _eta(text_codes, X, rows):
+    """Correlation ratio eta, ANOVA p and n for every (text, numeric) pair."""
+    m, p = len(text_codes), X.shape[1]
+    E, P, N = np.full((m, p), np.nan), np.full((m, p), np.nan), np.zeros((m, p))
+    if not m or not p:
+        return E, P, N
+    means = _column_means(X)
+    for indices, offsets, width in _groups(text_codes):
+        counts, sums, squares = np.zeros((width, p)), np.zeros((width, p)), np.zeros((width, p))
+        for start in range(0, rows, _BLOCK_ROWS):
+            stop = min(start + _BLOCK_ROWS, rows)
+            H = _one_hot(text_codes, (indices, offsets, width), start, stop)
+            block = X[start:stop]
+            present = ~np.isnan(block)
+            Z = np.where(present, block - means, 0.0)
+            counts += H.T @ present.astype(np.float64)
+            sums += H.T @ Z
+            squares += H.T @ (Z * Z)
+        for i, off in zip(indices, offsets):
+            n_g = counts[off:off + text_codes[i][1]]
+            s_g = sums[off:off + text_codes[i][1]]
+            n = n_g.sum(axis=0)
+            s = s_g.sum(axis=0)
+            k = (n_g > 0).sum(axis=0)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ss_total = squares[off:off + text_codes[i][1]].sum(axis=0) - s * s / n
+                ss_between = np.where(n_g > 0, s_g * s_g / np.where(n_g > 0, n_g, 1.0), 0.0).sum(axis=0) - s * s / n
+                ss_between = np.clip(ss_between, 0.0, ss_total)
+                eta = np.sqrt(ss_between / ss_total)
+                f = (ss_between / (k - 1)) / ((ss_total - ss_between) / (n - k))
+                pv = sps.f.sf(f, k - 1, n - k)
+            ok = (k >= 2) & (n > k) & (ss_total > 0)
+            E[i] = np.where(ok, eta, np.nan)
+            P[i] = np.where(ok, pv, np.nan)
+            N[i] = n
+    return E, P, N
+
+
+def _json(a):
+    """Matrix as nested lists with None for NaN/inf (JSON has no NaN)."""
+    return [[v if math.isfinite(v) else None for v in row] for row in np.asarray(a, dtype=np.float64).tolist()]
+
+
+def _counts(a):
+    return [[int(v) for v in row] for row in np.asarray(a).tolist()]
+
+
+def compute(snapshot_dir: str, manifest, names: list, method: str = "pearson") -> dict:
+    """Association matrices of the given (resolved) columns.
+
+    `association` is the combined matrix over all kept columns, in request
+    order: r (of `method`) for numeric pairs, Cramer's V for text pairs and eta
+    for mixed pairs, with its p-values and the number of complete pairs. The
+    per-measure matrices are included as well.
+    """
+    rows = int(manifest["rows"])
+    num_names, X, text_names, text_codes, skipped = _load(snapshot_dir, manifest, names)
+
+    n_num, pearson = _numeric_sums(X)
+    pearson_p = _correlation_p(pearson, n_num)
+    eta, eta_p, n_mixed = _eta(text_codes, X, rows)
+    v, v_p, n_text = _text_tables(text_codes, rows)
+    n_rank, spearman = _numeric_sums(_rank_columns(X))
+    spearman_p = _correlation_p(spearman, n_rank)
+
+    kept = [n for n in names if n in set(num_names) | set(text_names)]
+    num_pos = {n: i for i, n in enumerate(num_names)}
+    text_pos = {n: i for i, n in enumerate(text_names)}
+    r, r_p = (pearson, pearson_p) if method == "pearson" else (spearman, spearman_p)
+    size = len(kept)
+    value, p_value, count = np.full((size, size), np.nan), np.full((size, size), np.nan), np.zeros((size, size))
+    for a, name_a in enumerate(kept):
+        for b, name_b in enumerate(kept):
+            if name_a in num_pos and name_b in num_pos:
+                i, j = num_pos[name_a], num_pos[name_b]
+                value[a, b], p_value[a, b], count[a, b] = r[i, j], r_p[i, j], n_num[i, j]
+            elif name_a in text_pos and name_b in text_pos:
+                i, j = text_pos[name_a], text_pos[name_b]
+                value[a, b], p_value[a, b], count[a, b] = v[i, j], v_p[i, j], n_text[i, j]
+            else:
+                i, j = (text_pos[name_a], num_pos[name_b]) if name_a in text_pos else (text_pos[name_b], num_pos[name_a])
+                value[a, b], p_value[a, b], count[a, b] = eta[i, j], eta_p[i, j], n_mixed[i, j]
+
+    return {
+        "rows": rows,
+        "method": method,
+        "columns": kept,
+        "types": ["numeric" if n in num_pos else "categorical" for n in kept],
+        "association": {"value": _json(value), "p": _json(p_value), "n": _counts(count)},
+        "pearson": {"columns": num_names, "r": _json(pearson), "p": _json(pearson_p)},
+        "spearman": {"columns": num_names, "r": _json(spearman), "p": _json(spearman_p)},
+        "cramers_v": {"columns": text_names, "v": _json(v), "p": _json(v_p)},
+        "eta": {"rows": text_names, "columns": num_names, "eta": _json(eta), "p": _json(eta_p)},
+        "skipped": skipped,
+    }
+
+
+def heatmap_input(result: dict):
+    """(values, p-values, names) of the combined matrix for the R heatmap; NaN where a cell has no value."""
+    size = len(result["columns"])
+    values, p_values = (np.array([[np.nan if v is None else v for v in row] for row in result["association"][key]],
+                                 dtype=np.float64).reshape(size, size) for key in ("value", "p"))
+    return values, p_values, list(result["columns"])
@@ -0,0 +1,297 @@
+import os
+import json
+import math
+import numpy as np
+
+from .. import py_engine
+
+# Column profile computed over the whole dataset (not a 1000-row sample).
+#
+# The profiler walks the columnar snapshot chunk by chunk (arrays are
+# memory-mapped, so memory stays bounded) and records, per column: storage
+# dtype, numeric-coercion success rate, missing count, distinct count, min /
+# max / mean / variance and the top-k categories. Numericness uses the same
+# rule as stat_tests.R (numeric column, or text that coerces for >= 70% of the
+# values), so the column picker and the analysis agree.
+#
+# Distinct counts of numeric columns come from a HyperLogLog sketch; the
+# registers are kept next to the profile so appended rows can be merged in.
+# Text columns get exact counts from their level codes.
+
+PROFILE_FILE = "profile.json"
+SKETCH_FILE = "profile_sketch.npz"
+PROFILE_CHUNK_ROWS = int(os.environ.get("PROFILE_CHUNK_ROWS", "1000000"))
+TOP_K = 10
+HLL_P = 12
+_HLL_M = 1 << HLL_P
+
+
+def _splitmix64(x):
+    z = x + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def hll_new():
+    return np.zeros(_HLL_M, dtype=np.uint8)
+
+
+def hll_add_floats(registers, values):
+    values = values[~np.isnan(values)]
+    if values.shape[0] == 0:
+        return registers
+    values = values + 0.0  # -0.0 -> 0.0
+    with np.errstate(over="ignore"):
+        h = _splitmix64(values.view(np.uint64))
+    idx = (h >> np.uint64(64 - HLL_P)).astype(np.int64)
+    w = (h << np.uint64(HLL_P)) | np.uint64(1 << (HLL_P - 1))
+    rank = (64 - np.floor(np.log2(w.astype(np.float64)))).astype(np.uint8)
+    np.maximum.at(registers, idx, rank)
+    return registers
+
+
+def hll_merge(a, b):
+    return np.maximum(a, b)
+
+
+def hll_estimate(registers) -> int:
+    m = float(_HLL_M)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    est = alpha * m * m / np.sum(np.power(2.0, -registers.astype(np.float64)))
+    zeros = int(np.count_nonzero(registers == 0))
+    if est <= 2.5 * m and zeros > 0:
+        est = m * math.log(m / zeros)
+    return int(round(est))
+
+
+def merge_moments(a, b):
+    """Chan et al. parallel merge of (count, mean, M2)."""
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    if n == 0:
+        return (0, 0.0, 0.0)
+    delta = mean_b - mean_a
+    mean = mean_a + delta * n_b / n
+    m2 = m2_a + m2_b + delta * delta * n_a * n_b / n
+    return (n, mean, m2)
+
+
+def _chunk_moments(values):
+    n = values.shape[0]
+    if n == 0:
+        return (0, 0.0, 0.0)
+    mean = float(values.mean())
+    return (n, mean, float(((values - mean) ** 2).sum()))
+
+
+def _finite(v):
+    if v is None:
+        return None
+    v = float(v)
+    return v if math.isfinite(v) else None
+
+
+def _numeric_stats(count, moments, vmin, vmax):
+    n, mean, m2 = moments
+    return {
+        "min": _finite(vmin) if count else None,
+        "max": _finite(vmax) if count else None,
+        "mean": _finite(mean) if n else None,
+        "variance": _finite(m2 / (n - 1)) if n > 1 else None,
+    }
+
+
+def _profile_numeric(data, rows, chunk_rows, start=0, prev=None, registers=None):
+    """Numeric profile of data[start:rows], merged into `prev` (profile of the rows before) if given."""
+    registers = hll_new() if registers is None else registers
+    moments = (0, 0.0, 0.0)
+    vmin, vmax = math.inf, -math.inf
+    missing = 0
+    if prev is not None:
+        st = prev["state"]
+        moments = (st["n"], st["mean"], st["m2"])
+        vmin, vmax = st["min"], st["max"]
+        missing = prev["missing"]
+    for start in range(start, rows, chunk_rows):
+        chunk = np.asarray(data[start:min(start + chunk_rows, rows)])
+        ok = ~np.isnan(chunk)
+        missing += int(chunk.shape[0] - np.count_nonzero(ok))
+        vals = chunk[ok]
+        if vals.shape[0]:
+            moments = merge_moments(moments, _chunk_moments(vals))
+            vmin = min(vmin, float(vals.min()))
+            vmax = max(vmax, float(vals.max()))
+        hll_add_floats(registers, chunk)
+    count = rows - missing
+    out = {
+        "dtype": "float64",
+        "is_numeric": count > 0,
+        "count": count,
+        "missing": missing,
+        "coercion_rate": (count / rows) if rows else 0.0,
+        "distinct": hll_estimate(registers),
+        "distinct_exact": False,
+        "top": [],
+        "state": {"n": moments[0], "mean": moments[1], "m2": moments[2], "min": vmin, "max": vmax},
+    }
+    out.update(_numeric_stats(count, moments, vmin, vmax))
+    return out, registers
+
+
+def profile_from_counts(levels, counts, missing, rows, coerced=None):
+    """Profile of a text column from its level counts (also used after appends)."""
+    if coerced is None:
+        coerced = py_engine.coerce_strings(levels) if levels.shape[0] else np.empty(0)
+    parsed = ~np.isnan(coerced)
+    n_good = int(counts[parsed].sum()) if levels.shape[0] else 0
+    is_numeric = py_engine.coercion_accepted(n_good, rows)
+
+    order = np.argsort(-counts, kind="stable")[:TOP_K]
+    out = {
+        "dtype": "string",
+        "is_numeric": bool(is_numeric),
+        "count": int(rows - missing),
+        "missing": int(missing),
+        "coercion_rate": (n_good / rows) if rows else 0.0,
+        "distinct": int(np.count_nonzero(counts)),
+        "distinct_exact": True,
+        "top": [{"value": str(levels[i]), "count": int(counts[i])} for i in order if counts[i] > 0],
+    }
+    if n_good:
+        w = counts[parsed].astype(np.float64)
+        v = coerced[parsed]
+        mean = float((w * v).sum() / n_good)
+        m2 = float((w * (v - mean) ** 2).sum())
+        out.update(_numeric_stats(n_good, (n_good, mean, m2), v.min(), v.max()))
+    else:
+        out.update(_numeric_stats(0, (0, 0.0, 0.0), None, None))
+    return out
+
+
+def _profile_text(codes, levels, coerced, rows, chunk_rows, start=0, prev=None, counts=None):
+    """Text profile of codes[start:rows], added to `prev` / `counts` (the rows before) if given."""
+    if counts is None:
+        counts = np.zeros(levels.shape[0], dtype=np.int64)
+    elif counts.shape[0] < levels.shape[0]:
+        # levels first seen in the appended rows
+        counts = np.concatenate([counts, np.zeros(levels.shape[0] - counts.shape[0], dtype=np.int64)])
+    missing = prev["missing"] if prev is not None else 0
+    for start in range(start, rows, chunk_rows):
+        chunk = np.asarray(codes[start:min(start + chunk_rows, rows)])
+        present = chunk >= 0
+        missing += int(chunk.shape[0] - np.count_nonzero(present))
+        counts += np.bincount(chunk[present], minlength=levels.shape[0])[:levels.shape[0]]
+    return profile_from_counts(levels, counts, missing, rows, coerced), counts
+
+
+def build_profile(snapshot_dir: str, manifest, chunk_rows: int = None):
+    """Profile every snapshot column and write profile.json into the snapshot.
+
+    HLL registers (numeric columns) and level counts (text columns) go to
+    profile_sketch.npz so a later append can update the profile without a rescan.
+    """
+    chunk_rows = chunk_rows or PROFILE_CHUNK_ROWS
+    rows = int(manifest["rows"])
+    columns = []
+    sketches = {}
+    for i, col in enumerate(manifest["columns"]):
+        data = np.load(os.path.join(snapshot_dir, col["file"]), mmap_mode="r") if rows else np.empty(0)
+        if col["kind"] == "numeric":
+            prof, registers = _profile_numeric(data, rows, chunk_rows)
+            sketches[f"c{i}"] = registers
+        else:
+            levels = np.load(os.path.join(snapshot_dir, col["levels"]))
+            coerced = np.load(os.path.join(snapshot_dir, col["coerced"])) if col.get("coerced") else None
+            prof, counts = _profile_text(data, levels, coerced, rows, chunk_rows)
+            sketches[f"c{i}"] = counts
+        prof["name"] = col["name"]
+        prof["type"] = "mierzalne" if prof["is_numeric"] else "niemierzalne"
+        columns.append(prof)
+        del data
+
+    profile = {"rows": rows, "columns": columns}
+    save_profile(snapshot_dir, profile, sketches)
+    return profile
+
+
+def append_profile(snapshot_dir: str, manifest, old_rows: int, chunk_rows: int = None):
+    """Update the stored profile with the rows appended after old_rows, without rescanning the others.
+
+    Numeric columns merge the new rows into the saved moments, min/max and HLL
+    registers; text columns add their level counts. Returns (profile,
+    sketches, changed) - the caller saves them with save_profile() - or None
+    when there is no profile of exactly old_rows rows to update.
+
+    `changed` names the columns whose analyses can now give another result.
+    Rows missing in a column leave it unchanged (the tests drop them), unless
+    they are its first missing values (R counts an NA group) or flip its
+    numeric coercion.
+    """
+    chunk_rows = chunk_rows or PROFILE_CHUNK_ROWS
+    profile = load_profile(snapshot_dir)
+    if profile is None or profile["rows"] != old_rows or len(profile["columns"]) != len(manifest["columns"]):
+        return None
+    try:
+        with np.load(os.path.join(snapshot_dir, SKETCH_FILE)) as f:
+            old_sketches = {k: f[k] for k in f.files}
+    except Exception:
+        return None
+    rows = int(manifest["rows"])
+    columns, sketches, changed = [], {}, []
+    for i, col in enumerate(manifest["columns"]):
+        prev = profile["columns"][i]
+        data = np.load(os.path.join(snapshot_dir, col["file"]), mmap_mode="r") if rows else np.empty(0)
+        if col["kind"] == "numeric":
+            prof, sketches[f"c{i}"] = _profile_numeric(data, rows, chunk_rows, start=old_rows, prev=prev,
+                                                       registers=old_sketches[f"c{i}"].copy())
+        else:
+            levels = np.load(os.path.join(snapshot_dir, col["levels"]))
+            coerced = np.load(os.path.join(snapshot_dir, col["coerced"])) if col.get("coerced") else None
+            prof, sketches[f"c{i}"] = _profile_text(data, levels, coerced, rows, chunk_rows, start=old_rows,
+                                                    prev=prev, counts=old_sketches[f"c{i}"])
+        prof["name"] = col["name"]
+        prof["type"] = "mierzalne" if prof["is_numeric"] else "niemierzalne"
+        columns.append(prof)
+        del data
+        if (prof["count"] > prev["count"] or prof["is_numeric"] != prev["is_numeric"]
+                or (col["kind"] == "text" and prev["missing"] == 0 and prof["missing"] > 0)):
+            changed.append(col["name"])
+    return {"rows": rows, "columns": columns}, sketches, changed
+
+
+def save_profile(snapshot_dir: str, profile, sketches):
+    np.savez(os.path.join(snapshot_dir, SKETCH_FILE), **sketches)
+    tmp = os.path.join(snapshot_dir, PROFILE_FILE + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(profile, f, ensure_ascii=False)
+    os.replace(tmp, os.path.join(snapshot_dir, PROFILE_FILE))
+
+
+def load_profile(snapshot_dir: str):
+    path = os.path.join(snapshot_dir, PROFILE_FILE)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def drop_profile(snapshot_dir: str):
+    """Remove a stored profile that no longer matches the snapshot; the next reader rebuilds it."""
+    for name in (PROFILE_FILE, SKETCH_FILE):
+        try:
+            os.remove(os.path.join(snapshot_dir, name))
+        except OSError:
+            pass
+
+
+def public_profile(profile):
+    """Profile without the internal merge state."""
+    return {
+        "rows": profile["rows"],
+        "columns": [{k: v for k, v in c.items() if k != "state"} for c in profile["columns"]],
+    }
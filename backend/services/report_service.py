@@ -1,89 +1,306 @@
 from io import BytesIO
+import re
 import base64
+import datetime
 import json
 from typing import Any, Dict
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
 from openpyxl import Workbook
 from openpyxl.utils.dataframe import dataframe_to_rows
 from openpyxl.drawing.image import Image as OpenpyxlImage
-from PIL import Image
+from openpyxl.writer.excel import ExcelWriter
+from openpyxl.packaging.extended import ExtendedProperties
+from openpyxl.packaging.relationship import get_rels_path
+from openpyxl.styles.stylesheet import write_stylesheet
+from openpyxl.workbook._writer import WorkbookWriter
+from openpyxl.writer.theme import theme_xml
+from openpyxl.xml.functions import tostring
+from openpyxl.xml.constants import ARC_APP, ARC_CORE, ARC_THEME, ARC_STYLE, ARC_ROOT_RELS, ARC_WORKBOOK, ARC_WORKBOOK_RELS
 import pandas as pd
 
-def generate_excel_report(result: Dict[str, Any]) -> BytesIO:
-    wb = Workbook()
-    # Summary sheet
-    ws = wb.active
-    ws.title = "Summary"
-    ws.append(["Pole", "Wartość"])
-    ws.append(["Recommended test", result.get("recommended_test", "")])
-    
-    # Extract p-value from stats
-    stats = result.get("stats", {})
-    p_value_display = ""
+# Excel reports.
+#
+# Workbooks are built in openpyxl write-only mode and written straight into a
+# zip stream (ExcelReport): each sheet goes into the archive as soon as it is
+# complete, so only the sheet being filled is held, and take() hands out the
+# bytes produced so far. Plots are embedded as the stored PNG bytes (no decode /
+# re-encode); they are already compressed, so they are stored, not deflated.
+#
+# generate_excel_report() - one analysis: Summary, Stats and Plot sheets.
+# ScreeningReport - many analysed pairs: a Summary sheet with one row per pair
+# and a sheet per pair, written pair by pair while the batch runs.
+
+_INVALID_TITLE_CHARS = re.compile(r"[\\/*?:\[\]]")
+_MAX_TITLE = 31
+
+
+def _sheet_title(title: str) -> str:
+    return _INVALID_TITLE_CHARS.sub("_", str(title))[:_MAX_TITLE] or "Sheet"
+
+
+class _Sink:
+    """Non-seekable file object for ZipFile: keeps the bytes written since the last take()."""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        out = b"".join(self._parts)
+        self._parts = []
+        return out
+
+
+class _OpenpyxlParts:
+    """The parts of openpyxl's ExcelWriter that ExcelReport drives one sheet at a time.
+
+    openpyxl only writes a whole workbook at once (ExcelWriter.save), so
+    streaming needs its private internals; every such access is kept in this
+    class. Written against openpyxl 3.1.2 (pinned in backend/requirements.txt):
+    re-check it on upgrade - test_excel_report_reloads_with_image covers it.
+    """
+
+    def __init__(self, wb, archive):
+        self.wb = wb
+        self.archive = archive
+        self._writer = ExcelWriter(wb, archive)
+
+    def write_worksheet(self, ws, sheet_id: int):
+        """Worksheet xml, its drawing, images (stored as is) and relationships."""
+        ws._id = sheet_id
+        writer = self._writer
+        writer.write_worksheet(ws)
+        if ws._drawing:
+            writer._write_drawing(ws._drawing)
+            for r in ws._rels.Relationship:
+                if "drawing" in r.Type:
+                    r.Target = ws._drawing.path
+            for img in ws._drawing.images:
+                self.archive.writestr(img.path[1:], img._data(), compress_type=ZIP_STORED)
+            # the images are in the archive, do not keep their bytes until close()
+            writer._images.clear()
+            ws._drawing.images = []
+            ws._images = []
+        if ws._rels:
+            self.archive.writestr(get_rels_path(ws.path)[1:], tostring(ws._rels.to_tree()))
+
+    def write_workbook(self):
+        """Workbook-level parts: properties, theme, styles, workbook xml and content types."""
+        archive, wb = self.archive, self.wb
+        archive.writestr(ARC_APP, tostring(ExtendedProperties().to_tree()))
+        archive.writestr(ARC_CORE, tostring(wb.properties.to_tree()))
+        archive.writestr(ARC_THEME, theme_xml)
+        archive.writestr(ARC_STYLE, tostring(write_stylesheet(wb)))
+        writer = WorkbookWriter(wb)
+        archive.writestr(ARC_ROOT_RELS, writer.write_root_rels())
+        archive.writestr(ARC_WORKBOOK, writer.write())
+        archive.writestr(ARC_WORKBOOK_RELS, writer.write_rels())
+        self._writer.manifest._write(archive, wb)
+
+
+class ExcelReport:
+    """Write-only workbook streamed as an .xlsx zip, sheet by sheet."""
+
+    def __init__(self):
+        self.wb = Workbook(write_only=True)
+        self._sink = _Sink()
+        # a non-seekable target makes ZipFile write data descriptors instead of seeking back
+        self._archive = ZipFile(self._sink, "w", ZIP_DEFLATED, allowZip64=True)
+        self._parts = _OpenpyxlParts(self.wb, self._archive)
+        self._written = 0
+
+    def create_sheet(self, title: str, index: int = None):
+        return self.wb.create_sheet(_sheet_title(title), index)
+
+    def move_sheet(self, ws, index: int):
+        """Put a sheet at this tab position (sheets may be written in any order)."""
+        # by title: move_sheet() does not take write-only sheet objects
+        self.wb.move_sheet(ws.title, index - self.wb.sheetnames.index(ws.title))
+
+    def write_sheet(self, ws):
+        """Put a finished sheet (rows appended, images added) into the archive."""
+        self._written += 1
+        self._parts.write_worksheet(ws, self._written)
+
+    def add_image(self, ws, png_bytes: bytes, anchor: str) -> bool:
+        try:
+            img = OpenpyxlImage(BytesIO(png_bytes))
+        except Exception:
+            return False
+        img.anchor = anchor
+        ws.add_image(img)
+        return True
+
+    def close(self):
+        """Write the workbook parts (the sheets are already in the archive) and the zip directory."""
+        self.wb.properties.modified = datetime.datetime.utcnow()
+        self._parts.write_workbook()
+        self._archive.close()
+
+    def take(self) -> bytes:
+        """Bytes of the file produced since the last call."""
+        return self._sink.take()
+
+
+def _p_value_display(stats) -> str:
     if isinstance(stats, dict):
         p_value_raw = stats.get("p_value")
         if p_value_raw is not None:
             # Format p-value to a reasonable precision
             try:
-                p_value_display = f"{float(p_value_raw):.6f}"
+                return f"{float(p_value_raw):.6f}"
             except (ValueError, TypeError):
-                p_value_display = str(p_value_raw)
-    
-    ws.append(["P-value", p_value_display])
-    ws.append(["Actual X", result.get("actual_x", "")])
-    ws.append(["Actual Y", result.get("actual_y", "")])
-    ws.append([])
-    ws.append(["Info", "Plik wygenerowany przez aplikację Analiza zależności zmiennych"])
+                return str(p_value_raw)
+    return ""
+
 
-    # Stats sheet - note: stats was already fetched above
-    ws2 = wb.create_sheet("Stats")
+def _stats_rows(stats):
     if stats is None or (isinstance(stats, (dict, list)) and len(stats) == 0):
-        ws2.append(["Brak statystyk"])
-    else:
-        if isinstance(stats, dict):
-            ws2.append(["Nazwa", "Wartość"])
-            for k, v in stats.items():
-                try:
-                    if isinstance(v, (dict, list)):
-                        v_str = json.dumps(v, ensure_ascii=False)
-                    else:
-                        v_str = str(v)
-                except Exception:
-                    v_str = str(v)
-                ws2.append([k, v_str])
-        elif isinstance(stats, list):
+        return [["Brak statystyk"]]
+    rows = []
+    if isinstance(stats, dict):
+        rows.append(["Nazwa", "Wartość"])
+        for k, v in stats.items():
             try:
-                df = pd.DataFrame(stats)
-                if df.empty:
-                    ws2.append(["Brak danych w liście statystyk"])
+                if isinstance(v, (dict, list)):
+                    v_str = json.dumps(v, ensure_ascii=False)
                 else:
-                    for r in dataframe_to_rows(df, index=False, header=True):
-                        ws2.append(r)
+                    v_str = str(v)
             except Exception:
-                ws2.append(["Index", "Value"])
-                for i, s in enumerate(stats):
-                    ws2.append([i, str(s)])
-        else:
-            ws2.append([str(stats)])
+                v_str = str(v)
+            rows.append([k, v_str])
+    elif isinstance(stats, list):
+        try:
+            df = pd.DataFrame(stats)
+            if df.empty:
+                rows.append(["Brak danych w liście statystyk"])
+            else:
+                rows.extend(dataframe_to_rows(df, index=False, header=True))
+        except Exception:
+            rows.append(["Index", "Value"])
+            for i, s in enumerate(stats):
+                rows.append([i, str(s)])
+    else:
+        rows.append([str(stats)])
+    return rows
+
+
+def _resampling_rows(resampling):
+    if not resampling:
+        return []
+    if resampling.get("error"):
+        return [["Resampling", resampling["error"]]]
+    perm, boot = resampling.get("permutation") or {}, resampling.get("bootstrap") or {}
+    ci = boot.get("ci") or [None, None]
+    return [
+        ["Permutation p-value", perm.get("p_value")],
+        ["Permutations", perm.get("resamples")],
+        [f"Bootstrap {boot.get('estimate', '')}", boot.get("value")],
+        [f"Bootstrap CI {boot.get('confidence', '')}", f"[{ci[0]}, {ci[1]}]"],
+    ]
+
+
+def generate_excel_report(result: Dict[str, Any], plot_bytes: bytes = None) -> BytesIO:
+    """Workbook for one analysis; plot_bytes is the stored PNG (or result["plot_base64"])."""
+    report = ExcelReport()
+    stats = result.get("stats", {})
+
+    # Summary sheet
+    ws = report.create_sheet("Summary")
+    ws.append(["Pole", "Wartość"])
+    ws.append(["Recommended test", result.get("recommended_test", "")])
+    ws.append(["P-value", _p_value_display(stats)])
+    ws.append(["Actual X", result.get("actual_x", "")])
+    ws.append(["Actual Y", result.get("actual_y", "")])
+    for row in _resampling_rows(result.get("resampling")):
+        ws.append(row)
+    ws.append([])
+    ws.append(["Info", "Plik wygenerowany przez aplikację Analiza zależności zmiennych"])
+    report.write_sheet(ws)
+
+    ws2 = report.create_sheet("Stats")
+    for row in _stats_rows(stats):
+        ws2.append(row)
+    report.write_sheet(ws2)
 
     # Plot sheet
-    plot_b64 = result.get("plot_base64")
-    if plot_b64:
+    if plot_bytes is None and result.get("plot_base64"):
         try:
-            img_bytes = base64.b64decode(plot_b64)
-            pil_img = Image.open(BytesIO(img_bytes)).convert("RGBA")
-            img_io = BytesIO()
-            pil_img.save(img_io, format="PNG")
-            img_io.seek(0)
-
-            ws3 = wb.create_sheet("Plot")
-            img_for_xl = OpenpyxlImage(img_io)
-            img_for_xl.anchor = "A1"
-            ws3.add_image(img_for_xl)
+            plot_bytes = base64.b64decode(result["plot_base64"])
         except Exception:
-            ws3 = wb.create_sheet("Plot")
+            plot_bytes = b""
+    if plot_bytes is not None:
+        ws3 = report.create_sheet("Plot")
+        if not report.add_image(ws3, plot_bytes, "A1"):
             ws3.append(["Nie udało się załadować wykresu do pliku Excel."])
+        report.write_sheet(ws3)
+
+    report.close()
+    return BytesIO(report.take())
+
+
+class ScreeningReport:
+    """Workbook for many analysed pairs, produced while they complete.
+
+    add() writes the sheet of one pair (a batch item of /analyze/batch) and
+    returns the bytes ready to send; close() adds the Summary sheet in front,
+    orders the pair sheets by pair index and returns the rest of the file.
+    """
+
+    SUMMARY_HEADER = ["Lp.", "Zmienna X", "Zmienna Y", "Recommended test", "Statistic", "P-value",
+                      "Permutation p-value", "Arkusz", "Błąd"]
+
+    def __init__(self, file_id: str = ""):
+        self.file_id = file_id
+        self.report = ExcelReport()
+        self._summary = []
+        self._sheets = []  # (pair index, sheet) in the order the pairs finished
+
+    def add(self, item: Dict[str, Any], plot_bytes: bytes = None) -> bytes:
+        index = item.get("index", len(self._summary))
+        ws = self.report.create_sheet(f"{index + 1} {item.get('x')} ~ {item.get('y')}")
+        self._sheets.append((index, ws))
+        ws.append(["Pole", "Wartość"])
+        ws.append(["Zmienna X", item.get("x")])
+        ws.append(["Zmienna Y", item.get("y")])
+        stats = item.get("stats") or {}
+        if item.get("error"):
+            ws.append(["Błąd", item["error"]])
+        else:
+            ws.append(["Recommended test", item.get("recommended_test", "")])
+            ws.append(["P-value", _p_value_display(stats)])
+            for row in _resampling_rows(item.get("resampling")):
+                ws.append(row)
+            ws.append([])
+            for row in _stats_rows(stats):
+                ws.append(row)
+            if plot_bytes:
+                self.report.add_image(ws, plot_bytes, "E2")
+        self.report.write_sheet(ws)
+
+        perm = (item.get("resampling") or {}).get("permutation") or {}
+        self._summary.append([index + 1, item.get("x"), item.get("y"), item.get("recommended_test"),
+                              stats.get("statistic") if isinstance(stats, dict) else None,
+                              stats.get("p_value") if isinstance(stats, dict) else None,
+                              perm.get("p_value"), ws.title, item.get("error")])
+        return self.report.take()
 
-    out = BytesIO()
-    wb.save(out)
-    out.seek(0)
-    return out
\ No newline at end of file
+    def close(self) -> bytes:
+        summary = self.report.create_sheet("Summary", 0)
+        summary.append(self.SUMMARY_HEADER)
+        for row in sorted(self._summary, key=lambda r: r[0]):
+            summary.append(row)
+        summary.append([])
+        summary.append(["Info", f"Plik wygenerowany przez aplikację Analiza zależności zmiennych (zbiór {self.file_id})"])
+        self.report.write_sheet(summary)
+        # pairs finish in any order; the tabs follow the pair index
+        for position, (_, ws) in enumerate(sorted(self._sheets, key=lambda s: s[0]), 1):
+            self.report.move_sheet(ws, position)
+        self.report.close()
+        return self.report.take()
@@ -0,0 +1,409 @@
+import os
+import math
+import time
+import functools
+import numpy as np
+import pandas as pd
+from scipy import stats as sps
+
+from .. import py_engine
+from . import dataset_service
+
+# Permutation p-values and bootstrap confidence intervals (opt-in, {"resampling": ...}).
+#
+# The test family comes from the decision tree (recommended_test); resampling
+# then runs on the same complete observations the test used:
+#   - correlation: y is permuted against x; bootstrap of Pearson's r or
+#     Spearman's rho over resampled pairs
+#   - groups: values are permuted across the groups; stratified bootstrap
+#     (every group keeps its size) of the mean difference (t-test, Welch),
+#     the rank-biserial correlation (Wilcoxon), eta^2 (ANOVA) or epsilon^2
+#     (Kruskal-Wallis)
+#   - chi-square: random tables with the observed margins (Patefield);
+#     multinomial bootstrap of Cramer's V
+# Resamples run in batches of (batch x rows) matrices: a batch of permutations
+# is one rng.permuted() call followed by a matrix product or np.add.reduceat,
+# and a bootstrap batch is a matrix of drawn row indices. Rank statistics of a
+# resample come from counting the draws per distinct value (the copies of a row
+# tie with each other), so no resample is sorted.
+#
+# Batches are spread over the Python process pool (batch_service.executor()).
+# Batch i always draws from the generator seeded with [seed, kind, i], so results depend on
+# the seed and not on the number of workers. The permutation loop stops early
+# once the Monte Carlo error of the p-value is below RESAMPLING_P_REL_TOL of
+# the p-value and the p-value is clearly on one side of 0.05.
+
+RESAMPLING_VERSION = "1"
+RESAMPLING_RESAMPLES = int(os.environ.get("RESAMPLING_RESAMPLES", "10000"))
+RESAMPLING_MAX_RESAMPLES = int(os.environ.get("RESAMPLING_MAX_RESAMPLES", "100000"))
+RESAMPLING_SEED = int(os.environ.get("RESAMPLING_SEED", "42"))
+RESAMPLING_P_REL_TOL = float(os.environ.get("RESAMPLING_P_REL_TOL", "0.1"))
+# values held in one batch matrix (x 8 bytes); sets the number of resamples per batch
+RESAMPLING_BATCH_CELLS = int(os.environ.get("RESAMPLING_BATCH_CELLS", str(1 << 20)))
+RESAMPLING_MIN_RESAMPLES = 1000
+_ALPHA = 0.05
+_Z = 2.576  # 99% two-sided
+_MAX_BATCH = 1000
+_KINDS = {"permutation": 0, "bootstrap": 1}
+
+
+def options(value):
+    """Normalized resampling options from the request ({"resampling": true | {...}}), or None when not requested."""
+    if value is None or value is False:
+        return None
+    if value is True:
+        value = {}
+    if not isinstance(value, dict):
+        raise ValueError("Pole 'resampling' musi być true/false albo obiektem")
+    try:
+        resamples = int(value.get("resamples", RESAMPLING_RESAMPLES))
+        seed = int(value.get("seed", RESAMPLING_SEED))
+        confidence = float(value.get("confidence", 0.95))
+    except (TypeError, ValueError):
+        raise ValueError("Niepoprawne parametry resamplingu")
+    if not 1 <= resamples <= RESAMPLING_MAX_RESAMPLES:
+        raise ValueError(f"Liczba powtórzeń musi być w zakresie 1..{RESAMPLING_MAX_RESAMPLES}")
+    if not 0 < confidence < 1:
+        raise ValueError("Poziom ufności musi być w przedziale (0, 1)")
+    return {"resamples": resamples, "seed": seed, "confidence": confidence}
+
+
+def cache_version(opts: dict, recommended_test: str) -> str:
+    """Result cache version of a resampling run: everything that changes its output."""
+    return f"{RESAMPLING_VERSION}:{recommended_test}:{opts['resamples']}:{opts['seed']}:{opts['confidence']}:{RESAMPLING_P_REL_TOL}"
+
+
+def _resampled_midranks(draws, run, runs: int):
+    """Midranks within every resample (size x n drawn rows) and the size of every tie run.
+
+    run: tie run (index of the distinct value) of each row. Counting the draws
+    per run gives the ranks without sorting the resample.
+    """
+    size, n = draws.shape
+    keys = run[draws]
+    keys += (np.arange(size) * runs)[:, None]
+    ties = np.bincount(keys.ravel(), minlength=size * runs)
+    # every resample draws n rows, so resample j starts at rank j * n
+    mid = np.cumsum(ties) - (ties - 1) / 2.0 - np.repeat(np.arange(size) * n, runs)
+    return mid[keys], ties.reshape(size, runs)
+
+
+def _tie_runs(v):
+    _, run = np.unique(v, return_inverse=True)
+    return run, int(run.max()) + 1
+
+
+def _permuted(rng, values, size: int):
+    m = np.tile(values, (size, 1))
+    return rng.permuted(m, axis=1, out=m)
+
+
+def _rng(seed: int, kind: str, index: int):
+    # SFC64 shuffles ~20% faster than the default PCG64
+    return np.random.Generator(np.random.SFC64(np.random.SeedSequence([seed, _KINDS[kind], index])))
+
+
+class _Correlation:
+    """Pearson / Spearman on complete pairs."""
+
+    def __init__(self, x, y, rank: bool):
+        ok = ~(np.isnan(x) | np.isnan(y))
+        x, y = x[ok], y[ok]
+        self.rows = x.shape[0]
+        if self.rows < 3:
+            raise ValueError("not enough finite observations")
+        self.rank = rank
+        self.statistic = "abs_rho" if rank else "abs_r"
+        self.estimate_name = "rho" if rank else "r"
+        if rank:
+            self.runs_x, self.runs_y = _tie_runs(x), _tie_runs(y)
+            x, y = sps.rankdata(x), sps.rankdata(y)
+        else:
+            # standardized, so the weighted sums below do not cancel
+            x = (x - x.mean()) / (x.std() or 1.0)
+            y = (y - y.mean()) / (y.std() or 1.0)
+        self.x, self.y = x, y
+        xc, yc = x - x.mean(), y - y.mean()
+        self._xc = xc / (np.sqrt(xc @ xc) or 1.0)
+        self._yc = yc / (np.sqrt(yc @ yc) or 1.0)
+        self.observed = float(abs(self._yc @ self._xc))
+        self.sample = np.arange(self.rows)[None]
+        self.width = self.rows
+
+    def permutation_stats(self, rng, size: int):
+        return np.abs(_permuted(rng, self._yc, size) @ self._xc)
+
+    def bootstrap_draws(self, rng, size: int):
+        return rng.integers(0, self.rows, size=(size, self.rows))
+
+    def estimates(self, draws):
+        """Estimate in each resample (rows of drawn row indices)."""
+        if self.rank:
+            x = _resampled_midranks(draws, *self.runs_x)[0]
+            y = _resampled_midranks(draws, *self.runs_y)[0]
+        else:
+            x, y = self.x[draws], self.y[draws]
+        n = self.rows
+        mx, my = x.sum(axis=1) / n, y.sum(axis=1) / n
+        sxy = np.einsum("ij,ij->i", x, y) / n - mx * my
+        sxx = np.einsum("ij,ij->i", x, x) / n - mx * mx
+        syy = np.einsum("ij,ij->i", y, y) / n - my * my
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return sxy / np.sqrt(sxx * syy)
+
+
+class _Groups:
+    """t-test / Welch / Wilcoxon / ANOVA / Kruskal-Wallis on the non-missing values of each level."""
+
+    def __init__(self, cat, num, test: str):
+        _, labels, parts, _ = py_engine._split_groups(cat, num)
+        groups, levels = [], []
+        for lv, part in zip(labels, parts):
+            part = part[~np.isnan(part)]
+            if part.shape[0]:
+                levels.append(lv)
+                groups.append(part)
+        if len(groups) < 2:
+            raise ValueError("grouping factor must have at least 2 levels")
+        self.test = test
+        self.levels = [str(lv) for lv in levels]
+        self.sizes = np.array([g.shape[0] for g in groups])
+        self.offsets = np.concatenate([[0], np.cumsum(self.sizes)[:-1]])
+        self.rows = int(self.sizes.sum())
+        values = np.concatenate(groups)
+        self.by_rank = test in ("wilcoxon", "kruskal_wallis")
+        if self.by_rank:
+            self.runs = _tie_runs(values)
+            values = sps.rankdata(values)
+        self.values = values
+        # permutation statistic: |Welch t|, otherwise the between-group sum of
+        # squares (monotone in the pooled t, F, W and H when the total is fixed)
+        self.statistic = "abs_welch_t" if test == "welch_t" else "between_ss"
+        self.estimate_name = {"t_student": "mean_difference", "welch_t": "mean_difference", "wilcoxon": "rank_biserial",
+                              "anova": "eta_squared", "kruskal_wallis": "epsilon_squared"}[test]
+        self._centered = values - values.mean()
+        self._low = np.repeat(self.offsets, self.sizes)
+        self._high = self._low + np.repeat(self.sizes, self.sizes)
+        self.observed = float(self._stats(self._centered[None])[0])
+        self.sample = np.arange(self.rows)[None]
+        self.width = self.rows
+
+    def permutation_stats(self, rng, size: int):
+        return self._stats(_permuted(rng, self._centered, size))
+
+    def _stats(self, m):
+        sums = np.add.reduceat(m, self.offsets, axis=1)
+        if self.statistic == "between_ss":
+            return (sums * sums / self.sizes).sum(axis=1)
+        sq = np.add.reduceat(m * m, self.offsets, axis=1)
+        n = self.sizes
+        var = (sq - sums * sums / n) / np.maximum(n - 1, 1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.abs(sums[:, 0] / n[0] - sums[:, 1] / n[1]) / np.sqrt(var[:, 0] / n[0] + var[:, 1] / n[1])
+
+    def bootstrap_draws(self, rng, size: int):
+        # stratified: the draws for group g come from the rows of group g
+        return rng.integers(self._low, self._high, size=(size, self.rows))
+
+    def estimates(self, draws):
+        """Estimate in each resample (rows of drawn row indices, laid out group by group)."""
+        n, total = self.sizes, self.rows
+        if self.by_rank:
+            values, ties = _resampled_midranks(draws, *self.runs)
+        else:
+            values, ties = self._centered[draws], None
+        sums = np.add.reduceat(values, self.offsets, axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if self.test in ("t_student", "welch_t"):
+                return sums[:, 0] / n[0] - sums[:, 1] / n[1]
+            if self.test == "wilcoxon":
+                u = sums[:, 0] - n[0] * (n[0] + 1) / 2.0
+                return 2.0 * u / (n[0] * n[1]) - 1.0
+            between = (sums * sums / n).sum(axis=1)
+            if self.test == "anova":
+                mean = sums.sum(axis=1) / total
+                sst = np.einsum("ij,ij->i", values, values) - total * mean * mean
+                return (between - total * mean * mean) / sst
+            h = 12.0 / (total * (total + 1)) * between - 3.0 * (total + 1)
+            h /= 1.0 - (ties ** 3 - ties).sum(axis=1) / float(total ** 3 - total)
+            return h / (total - 1)
+
+
+class _Table:
+    """Chi-square on the contingency table of the two variables."""
+
+    statistic = "chi_squared"
+    estimate_name = "cramers_v"
+
+    def __init__(self, x, y):
+        ok = pd.notna(x) & pd.notna(y)
+        tab = pd.crosstab(pd.Series(x[ok], dtype=object), pd.Series(y[ok], dtype=object)).to_numpy()
+        if tab.shape[0] < 2 or tab.shape[1] < 2:
+            raise ValueError("contingency table needs at least 2 rows and 2 columns")
+        self.table = tab
+        self.rows = int(tab.sum())
+        self._row, self._col = tab.sum(axis=1), tab.sum(axis=0)
+        self._expected = np.outer(self._row, self._col) / self.rows
+        self._dist = sps.random_table(self._row, self._col)
+        self.observed = float(self._stats(tab[None])[0])
+        self.sample = tab.reshape(1, -1)
+        self.width = tab.size
+
+    def permutation_stats(self, rng, size: int):
+        return self._stats(self._dist.rvs(size=size, random_state=rng))
+
+    def _stats(self, tabs):
+        return (tabs * tabs / self._expected).sum(axis=(1, 2)) - self.rows
+
+    def bootstrap_draws(self, rng, size: int):
+        return rng.multinomial(self.rows, (self.table / self.rows).ravel(), size=size)
+
+    def estimates(self, counts):
+        """Cramer's V of each resampled table (rows of cell counts)."""
+        tabs = counts.reshape(-1, *self.table.shape).astype(np.float64)
+        expected = tabs.sum(axis=2)[:, :, None] * tabs.sum(axis=1)[:, None, :] / self.rows
+        with np.errstate(invalid="ignore", divide="ignore"):
+            chi2 = np.where(expected > 0, (tabs - expected) ** 2 / expected, 0.0).sum(axis=(1, 2))
+        return np.sqrt(chi2 / (self.rows * (min(self.table.shape) - 1)))
+
+
+def prepare(x_values, y_values, recommended_test: str):
+    """Resampling problem for a pair and the test the decision tree chose for it."""
+    x = py_engine.coerce_numeric_if_possible(x_values)
+    y = py_engine.coerce_numeric_if_possible(y_values)
+    is_x_num, is_y_num = py_engine._is_numeric(x), py_engine._is_numeric(y)
+    if recommended_test in ("pearson_correlation", "spearman_correlation") and is_x_num and is_y_num:
+        return _Correlation(x, y, rank=recommended_test == "spearman_correlation")
+    if recommended_test == "chi_square" and not is_x_num and not is_y_num:
+        return _Table(np.asarray(x, dtype=object), np.asarray(y, dtype=object))
+    if recommended_test in ("t_student", "welch_t", "wilcoxon", "anova", "kruskal_wallis") and is_x_num != is_y_num:
+        if is_x_num:
+            return _Groups(np.asarray(y, dtype=object), x, recommended_test)
+        return _Groups(np.asarray(x, dtype=object), y, recommended_test)
+    raise ValueError(f"Resampling nie jest dostępny dla testu {recommended_test}")
+
+
+@functools.lru_cache(maxsize=4)
+def _problem(snapshot_dir: str, content_hash: str, x: str, y: str, recommended_test: str):
+    # content_hash keeps problems of a rebuilt/appended snapshot apart
+    manifest = dataset_service.load_manifest(snapshot_dir)
+    return prepare(dataset_service.load_analysis_column(snapshot_dir, manifest, x),
+                   dataset_service.load_analysis_column(snapshot_dir, manifest, y), recommended_test)
+
+
+def _batch(problem, kind: str, seed: int, index: int, size: int):
+    rng = _rng(seed, kind, index)
+    if kind == "permutation":
+        # permutations equal to the observed statistic up to rounding count as hits
+        return int(np.count_nonzero(problem.permutation_stats(rng, size) >= problem.observed * (1.0 - 1e-9)))
+    return problem.estimates(problem.bootstrap_draws(rng, size))
+
+
+def run_batches(snapshot_dir: str, content_hash: str, x: str, y: str, recommended_test: str,
+                kind: str, seed: int, first: int, sizes: list):
+    """Worker entry point: batches first, first + 1, ... of one kind.
+
+    Permutation batches return their number of hits, bootstrap batches their estimates.
+    """
+    problem = _problem(snapshot_dir, content_hash, x, y, recommended_test)
+    return [_batch(problem, kind, seed, first + i, size) for i, size in enumerate(sizes)]
+
+
+def _precise_enough(hits: int, done: int) -> bool:
+    if done < RESAMPLING_MIN_RESAMPLES:
+        return False
+    p = (hits + 1) / (done + 1)
+    se = math.sqrt(p * (1 - p) / done)
+    return se <= RESAMPLING_P_REL_TOL * p and abs(p - _ALPHA) > _Z * se
+
+
+class _Runner:
+    """Hands out batches of one resampling run to the pool (or runs them here) in rounds."""
+
+    def __init__(self, pair: tuple, problem, opts: dict, executor=None, workers: int = 1):
+        self.pair = pair
+        self.opts = opts
+        self.executor = executor
+        self.workers = max(1, workers) if executor is not None else 1
+        size = max(1, min(_MAX_BATCH, RESAMPLING_BATCH_CELLS // max(1, problem.width)))
+        total = opts["resamples"]
+        self.sizes = [min(size, total - start) for start in range(0, total, size)]
+        # a few tasks per worker and round keep the pool busy without overshooting an early stop
+        self.per_task = max(1, min(len(self.sizes) // (4 * self.workers), 25))
+
+    def rounds(self, kind: str):
+        """Yields the results of the batches in order, one round of tasks at a time."""
+        step = self.per_task * self.workers
+        for start in range(0, len(self.sizes), step):
+            tasks = [(first, self.sizes[first:min(first + self.per_task, len(self.sizes))])
+                     for first in range(start, min(start + step, len(self.sizes)), self.per_task)]
+            args = [(*self.pair, kind, self.opts["seed"], first, sizes) for first, sizes in tasks]
+            if self.executor is None:
+                done = [run_batches(*a) for a in args]
+            else:
+                done = [f.result() for f in [self.executor.submit(run_batches, *a) for a in args]]
+            for (first, sizes), results in zip(tasks, done):
+                yield from zip(sizes, results)
+
+
+def resample(snapshot_dir: str, content_hash: str, x: str, y: str, recommended_test: str, opts: dict,
+             executor=None, workers: int = 1) -> dict:
+    """Permutation p-value and bootstrap confidence interval for an analysed pair.
+
+    executor: a process pool (batch_service.executor()) to spread the batches
+    over, None = run them in this process.
+    """
+    started = time.perf_counter()
+    pair = (snapshot_dir, content_hash, x, y, recommended_test)
+    problem = _problem(*pair)
+    runner = _Runner(pair, problem, opts, executor, workers)
+
+    t = time.perf_counter()
+    hits = done = 0
+    stopped_early = False
+    for size, batch_hits in runner.rounds("permutation"):
+        hits += batch_hits
+        done += size
+        if done < opts["resamples"] and _precise_enough(hits, done):
+            stopped_early = True
+            break
+    p = (hits + 1) / (done + 1)
+    permutation = {
+        "statistic": problem.statistic,
+        "observed": py_engine._num(problem.observed),
+        "p_value": p,
+        "monte_carlo_se": math.sqrt(p * (1 - p) / done),
+        "resamples": done,
+        "stopped_early": stopped_early,
+        "seconds": round(time.perf_counter() - t, 3),
+    }
+
+    t = time.perf_counter()
+    estimates = np.concatenate([e for _, e in runner.rounds("bootstrap")])
+    estimates = estimates[np.isfinite(estimates)]
+    level = opts["confidence"]
+    ci = np.quantile(estimates, [(1 - level) / 2, (1 + level) / 2]) if estimates.shape[0] else [None, None]
+    bootstrap = {
+        "estimate": problem.estimate_name,
+        "value": py_engine._num(problem.estimates(problem.sample)[0]),
+        "ci": [py_engine._num(ci[0]), py_engine._num(ci[1])],
+        "confidence": level,
+        "method": "percentile",
+        "standard_error": py_engine._num(estimates.std(ddof=1)) if estimates.shape[0] > 1 else None,
+        "resamples": int(estimates.shape[0]),
+        "seconds": round(time.perf_counter() - t, 3),
+    }
+    if isinstance(problem, _Groups):
+        bootstrap["groups"] = problem.levels
+
+    print(f"[resampling_service.resample] {x} ~ {y} ({recommended_test}): {done} permutations, "
+          f"{bootstrap['resamples']} bootstrap resamples, {runner.workers} workers")
+    return {
+        "test": recommended_test,
+        "rows": problem.rows,
+        "seed": opts["seed"],
+        "workers": runner.workers,
+        "permutation": permutation,
+        "bootstrap": bootstrap,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
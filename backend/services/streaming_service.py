@@ -0,0 +1,520 @@
+import os
+import math
+import shutil
+import tempfile
+import numpy as np
+from scipy import stats as sps
+
+from .. import py_engine
+from . import dataset_service
+
+# Out-of-core analysis of large datasets.
+#
+# The in-memory engines load both columns (R: a data.frame of the projection)
+# before testing, so the dataset size is bounded by RAM. Here the same decision
+# tree as py_engine.run_analysis runs over the memory-mapped snapshot columns in
+# chunks of STREAMING_CHUNK_ROWS rows and only keeps sufficient statistics:
+#   - Pearson: counts, means and co-moments (merged chunk by chunk)
+#   - chi-square: sparse contingency counts of the level codes
+#   - t-test / Welch / ANOVA / Bartlett: per-group count, mean and M2
+#   - normality: the same seeded subsample as py_engine (or K^2 moments)
+#   - Spearman / Wilcoxon / Kruskal-Wallis: midranks from an external-memory
+#     ranking; values are split into value-range buckets on disk (pivots from
+#     a sample), each bucket is ranked on its own, and values equal to a pivot
+#     get a bucket of their own that needs no sort, so heavy ties stay bounded
+# Memory is bounded by the chunk and bucket sizes, not by the row count. When
+# fewer than STREAMING_IN_MEMORY_ROWS rows take part, the rows are gathered and
+# passed to py_engine, so small samples keep their exact tests.
+
+STREAMING_MIN_ROWS = int(os.environ.get("STREAMING_MIN_ROWS", "5000000"))
+STREAMING_CHUNK_ROWS = int(os.environ.get("STREAMING_CHUNK_ROWS", "1000000"))
+STREAMING_RANK_BUCKET_ROWS = int(os.environ.get("STREAMING_RANK_BUCKET_ROWS", "4000000"))
+STREAMING_IN_MEMORY_ROWS = int(os.environ.get("STREAMING_IN_MEMORY_ROWS", "100000"))
+_PIVOT_SAMPLE = 100000
+
+
+def use_streaming(manifest) -> bool:
+    return STREAMING_MIN_ROWS > 0 and int(manifest["rows"]) >= STREAMING_MIN_ROWS
+
+
+class _Column:
+    """Row-chunk reader of one snapshot column as the analysis sees it."""
+
+    def __init__(self, snapshot_dir: str, manifest, name: str):
+        col = dataset_service.column_entry(manifest, name)
+        rows = int(manifest["rows"])
+        # rows past the manifest's count belong to an append still in progress
+        self.data = np.load(os.path.join(snapshot_dir, col["file"]), mmap_mode="r")[:rows] if rows else np.empty(0)
+        self.coerced = None
+        self.levels = None
+        if col["kind"] == "text":
+            if col.get("coerces_numeric"):
+                self.coerced = np.load(os.path.join(snapshot_dir, col["coerced"]))
+            else:
+                self.levels = np.load(os.path.join(snapshot_dir, col["levels"]))
+        self.numeric = self.levels is None
+
+    def chunk(self, start: int, stop: int):
+        """float64 values (NaN = missing) or int32 level codes (-1 = missing)."""
+        d = np.asarray(self.data[start:stop])
+        if self.coerced is None:
+            return d
+        out = np.full(d.shape[0], np.nan)
+        present = d >= 0
+        out[present] = self.coerced[d[present]]
+        return out
+
+    def missing(self, values):
+        return np.isnan(values) if self.numeric else values < 0
+
+    def to_engine(self, values):
+        """Gathered values in the form py_engine.run_analysis takes."""
+        if self.numeric:
+            return values
+        out = np.empty(values.shape[0], dtype=object)
+        present = values >= 0
+        out[present] = self.levels[values[present]]
+        out[~present] = None
+        return out
+
+
+def _chunks(rows: int, chunk_rows: int):
+    for start in range(0, rows, chunk_rows):
+        yield start, min(rows, start + chunk_rows)
+
+
+class _Moments:
+    """Per-group count / mean / M2 / min / max, merged chunk by chunk (Chan et al.)."""
+
+    def __init__(self, k: int):
+        self.n = np.zeros(k, dtype=np.int64)
+        self.mean = np.zeros(k)
+        self.m2 = np.zeros(k)
+        self.lo = np.full(k, np.inf)
+        self.hi = np.full(k, -np.inf)
+
+    def add(self, codes, values):
+        k = self.n.shape[0]
+        n_c = np.bincount(codes, minlength=k)
+        has = n_c > 0
+        mean_c = np.zeros(k)
+        mean_c[has] = np.bincount(codes, weights=values, minlength=k)[has] / n_c[has]
+        d = values - mean_c[codes]
+        m2_c = np.bincount(codes, weights=d * d, minlength=k)
+        n_new = self.n + n_c
+        delta = mean_c - self.mean
+        safe = np.maximum(n_new, 1)
+        self.mean = np.where(has, self.mean + delta * n_c / safe, self.mean)
+        self.m2 = self.m2 + m2_c + np.where(has, delta * delta * self.n * n_c / safe, 0.0)
+        self.n = n_new
+        np.minimum.at(self.lo, codes, values)
+        np.maximum.at(self.hi, codes, values)
+
+
+class _CoMoments:
+    """Count, means and co-moments of complete (x, y) pairs."""
+
+    def __init__(self):
+        self.n, self.mx, self.my, self.cxx, self.cyy, self.cxy = 0, 0.0, 0.0, 0.0, 0.0, 0.0
+
+    def add(self, x, y):
+        nb = x.shape[0]
+        if nb == 0:
+            return
+        mxb, myb = float(x.mean()), float(y.mean())
+        dxb, dyb = x - mxb, y - myb
+        cxx, cyy, cxy = float(dxb @ dxb), float(dyb @ dyb), float(dxb @ dyb)
+        n = self.n + nb
+        dx, dy = mxb - self.mx, myb - self.my
+        f = self.n * nb / n
+        self.cxx += cxx + dx * dx * f
+        self.cyy += cyy + dy * dy * f
+        self.cxy += cxy + dx * dy * f
+        self.mx += dx * nb / n
+        self.my += dy * nb / n
+        self.n = n
+
+    def r(self) -> float:
+        if self.cxx <= 0 or self.cyy <= 0:
+            return math.nan
+        return max(-1.0, min(1.0, self.cxy / math.sqrt(self.cxx * self.cyy)))
+
+
+class _OrdinalSample:
+    """Picks the values at preset ordinals out of a stream of values fed in order."""
+
+    def __init__(self, picks):
+        self.picks = np.sort(picks)
+        self.seen = 0
+        self.parts = []
+
+    def add(self, values):
+        lo = np.searchsorted(self.picks, self.seen)
+        hi = np.searchsorted(self.picks, self.seen + values.shape[0])
+        if hi > lo:
+            self.parts.append(values[self.picks[lo:hi] - self.seen])
+        self.seen += values.shape[0]
+
+    def values(self):
+        return np.concatenate(self.parts) if self.parts else np.empty(0)
+
+
+def _pivot_sample(n: int):
+    rng = np.random.default_rng(py_engine.NORMALITY_SEED)
+    return _OrdinalSample(rng.choice(n, min(n, _PIVOT_SAMPLE), replace=False))
+
+
+class _Normality:
+    """py_engine.normality_p for one variable/group, fed the non-missing values in row order."""
+
+    def __init__(self, n: int, mean: float, constant: bool):
+        self.n = n
+        self.mean = mean
+        self.constant = constant
+        self.method = py_engine._normality_method(n)
+        self.power_sums = np.zeros(3)  # sums of d^2, d^3, d^4 around the mean
+        self.sample = None
+        if self.method == "shapiro_subsample":
+            # same draw as py_engine.normality_p, so both pick the same values
+            rng = np.random.default_rng(py_engine.NORMALITY_SEED)
+            self.sample = _OrdinalSample(rng.choice(n, py_engine.NORMALITY_MAX_N, replace=False))
+        elif self.method == "shapiro":
+            self.sample = _OrdinalSample(np.arange(n))
+
+    def add(self, values):
+        if self.sample is not None:
+            self.sample.add(values)
+        else:
+            d = values - self.mean
+            d2 = d * d
+            self.power_sums += (d2.sum(), (d2 * d).sum(), (d2 * d2).sum())
+
+    def p_value(self):
+        if self.n < 3 or self.constant:
+            return None
+        try:
+            if self.method == "dagostino":
+                m2, m3, m4 = self.power_sums / self.n
+                return py_engine._num(_dagostino_p(self.n, m2, m3, m4))
+            return py_engine._num(sps.shapiro(self.sample.values()).pvalue)
+        except Exception:
+            return None
+
+    def check(self, **extra):
+        return dict(extra, p_value=self.p_value(), method=self.method)
+
+
+def _dagostino_p(n: int, m2: float, m3: float, m4: float) -> float:
+    """scipy.stats.normaltest from central moments."""
+    b1 = m3 / m2 ** 1.5
+    y = b1 * math.sqrt(((n + 1) * (n + 3)) / (6.0 * (n - 2)))
+    beta2 = 3.0 * (n * n + 27 * n - 70) * (n + 1) * (n + 3) / ((n - 2.0) * (n + 5) * (n + 7) * (n + 9))
+    w2 = -1 + math.sqrt(2 * (beta2 - 1))
+    delta = 1 / math.sqrt(0.5 * math.log(w2))
+    alpha = math.sqrt(2.0 / (w2 - 1))
+    y = 1.0 if y == 0 else y
+    z1 = delta * math.log(y / alpha + math.sqrt((y / alpha) ** 2 + 1))
+    b2 = m4 / m2 ** 2
+    e = 3.0 * (n - 1) / (n + 1)
+    varb2 = 24.0 * n * (n - 2) * (n - 3) / ((n + 1) ** 2 * (n + 3) * (n + 5))
+    xk = (b2 - e) / math.sqrt(varb2)
+    sqrtbeta1 = 6.0 * (n * n - 5 * n + 2) / ((n + 7) * (n + 9)) * math.sqrt((6.0 * (n + 3) * (n + 5)) / (n * (n - 2) * (n - 3)))
+    a = 6.0 + 8.0 / sqrtbeta1 * (2.0 / sqrtbeta1 + math.sqrt(1 + 4.0 / sqrtbeta1 ** 2))
+    denom = 1 + xk * math.sqrt(2 / (a - 4.0))
+    term2 = math.copysign(((1 - 2.0 / a) / abs(denom)) ** (1 / 3.0), denom)
+    z2 = (1 - 2 / (9.0 * a) - term2) / math.sqrt(2 / (9.0 * a))
+    return float(sps.chi2.sf(z1 * z1 + z2 * z2, 2))
+
+
+def _ranked_buckets(batches, n: int, pivot_values, tmp_dir: str, chunk_rows: int):
+    """External-memory midranks of n values.
+
+    batches() yields (values, payload) in any order. Yields (ranks, payload,
+    tie_counts) per bucket, buckets in ascending value order, with ranks
+    counted across all buckets.
+    """
+    n_buckets = max(1, math.ceil(n / STREAMING_RANK_BUCKET_ROWS))
+    pivots = np.unique(np.quantile(pivot_values, np.linspace(0, 1, n_buckets + 1)[1:-1])) if n_buckets > 1 else np.empty(0)
+    offset = 0
+    if pivots.shape[0] == 0:
+        parts = list(batches())
+        values = np.concatenate([v for v, _ in parts]) if parts else np.empty(0)
+        payload = np.concatenate([p for _, p in parts]) if parts else np.empty(0, dtype=np.int64)
+        del parts
+        if values.shape[0]:
+            _, inv, cnt = np.unique(values, return_inverse=True, return_counts=True)
+            yield (np.cumsum(cnt) - (cnt - 1) / 2.0)[inv], payload, cnt
+        return
+
+    # bucket 2i: values between pivots i-1 and i; bucket 2i+1: values equal to pivot i
+    n_files = 2 * pivots.shape[0] + 1
+    paths = [(os.path.join(tmp_dir, f"b{b}.val"), os.path.join(tmp_dir, f"b{b}.pay")) for b in range(n_files)]
+    files = [(open(vp, "wb"), open(pp, "wb")) for vp, pp in paths]
+    try:
+        for values, payload in batches():
+            idx = np.searchsorted(pivots, values, side="left")
+            equal = pivots[np.minimum(idx, pivots.shape[0] - 1)] == values
+            bucket = 2 * idx + equal
+            order = np.argsort(bucket, kind="stable")
+            counts = np.bincount(bucket, minlength=n_files)
+            bounds = np.concatenate([[0], np.cumsum(counts)])
+            values, payload = values[order], payload[order].astype(np.int64)
+            for b in np.flatnonzero(counts):
+                files[b][0].write(values[bounds[b]:bounds[b + 1]].tobytes())
+                files[b][1].write(payload[bounds[b]:bounds[b + 1]].tobytes())
+    finally:
+        for vf, pf in files:
+            vf.close()
+            pf.close()
+
+    for b, (vp, pp) in enumerate(paths):
+        size = os.path.getsize(vp) // 8
+        if size == 0:
+            continue
+        if b % 2 == 1:
+            # all equal: one shared midrank, streamed in chunks without sorting
+            rank = offset + (size + 1) / 2.0
+            payload = np.memmap(pp, dtype=np.int64, mode="r")
+            for start, stop in _chunks(size, chunk_rows):
+                cnt = np.array([size]) if start == 0 else np.empty(0, dtype=np.int64)
+                yield np.full(stop - start, rank), np.asarray(payload[start:stop]), cnt
+            del payload
+        else:
+            values = np.fromfile(vp, dtype=np.float64)
+            payload = np.fromfile(pp, dtype=np.int64)
+            _, inv, cnt = np.unique(values, return_inverse=True, return_counts=True)
+            del values
+            yield (offset + np.cumsum(cnt) - (cnt - 1) / 2.0)[inv], payload, cnt
+        offset += size
+        os.remove(vp)
+        os.remove(pp)
+
+
+def _tie_sum(cnt) -> float:
+    cnt = cnt.astype(np.float64)
+    return float((cnt ** 3 - cnt).sum())
+
+
+def _gather(x: _Column, y: _Column, rows: int, chunk_rows: int):
+    """Rows where x or y is present (plus one all-missing row if any), as py_engine input."""
+    xs, ys, both_missing = [], [], False
+    for start, stop in _chunks(rows, chunk_rows):
+        cx, cy = x.chunk(start, stop), y.chunk(start, stop)
+        keep = ~(x.missing(cx) & y.missing(cy))
+        both_missing = both_missing or not keep.all()
+        xs.append(cx[keep])
+        ys.append(cy[keep])
+    if both_missing:
+        # keeps NA in the grouping column visible to the decision tree
+        xs.append(np.array([np.nan if x.numeric else -1], dtype=xs[0].dtype))
+        ys.append(np.array([np.nan if y.numeric else -1], dtype=ys[0].dtype))
+    return x.to_engine(np.concatenate(xs)), y.to_engine(np.concatenate(ys))
+
+
+def _numeric_pair(x: _Column, y: _Column, rows: int, chunk_rows: int, tmp_dir: str):
+    mx, my, co = _Moments(1), _Moments(1), _CoMoments()
+    for start, stop in _chunks(rows, chunk_rows):
+        cx, cy = x.chunk(start, stop), y.chunk(start, stop)
+        okx, oky = ~np.isnan(cx), ~np.isnan(cy)
+        mx.add(np.zeros(int(okx.sum()), dtype=np.int64), cx[okx])
+        my.add(np.zeros(int(oky.sum()), dtype=np.int64), cy[oky])
+        both = okx & oky
+        co.add(cx[both], cy[both])
+    if max(mx.n[0], my.n[0]) <= STREAMING_IN_MEMORY_ROWS:
+        return py_engine.run_analysis(*_gather(x, y, rows, chunk_rows))
+
+    norm_x = _Normality(int(mx.n[0]), mx.mean[0], mx.lo[0] == mx.hi[0])
+    norm_y = _Normality(int(my.n[0]), my.mean[0], my.lo[0] == my.hi[0])
+    piv_x, piv_y = _pivot_sample(co.n), _pivot_sample(co.n)
+    for start, stop in _chunks(rows, chunk_rows):
+        cx, cy = x.chunk(start, stop), y.chunk(start, stop)
+        okx, oky = ~np.isnan(cx), ~np.isnan(cy)
+        norm_x.add(cx[okx])
+        norm_y.add(cy[oky])
+        both = okx & oky
+        piv_x.add(cx[both])
+        piv_y.add(cy[both])
+    sh_x, sh_y = norm_x.check(variable="x"), norm_y.check(variable="y")
+    assumptions = {"normality": [sh_x, sh_y]}
+    if co.n < 3:
+        raise ValueError("not enough finite observations")
+    if sh_x["p_value"] is not None and sh_y["p_value"] is not None and sh_x["p_value"] > 0.05 and sh_y["p_value"] > 0.05:
+        return {"recommended_test": "pearson_correlation", "stats": py_engine.pearson_stats(co.r(), co.n),
+                "plot_path": "", "assumptions": assumptions}
+
+    # Spearman: rank x and y of the complete pairs into row-indexed files, then Pearson of the ranks
+    ties = False
+    rank_files = []
+    for col, piv in ((x, piv_x), (y, piv_y)):
+        path = os.path.join(tmp_dir, f"ranks{len(rank_files)}.f8")
+        ranks = np.memmap(path, dtype=np.float64, mode="w+", shape=(max(rows, 1),))
+
+        def batches(col=col):
+            for start, stop in _chunks(rows, chunk_rows):
+                cx, cy = x.chunk(start, stop), y.chunk(start, stop)
+                both = np.flatnonzero(~np.isnan(cx) & ~np.isnan(cy))
+                yield (cx if col is x else cy)[both], both + start
+
+        for r, pos, cnt in _ranked_buckets(batches, co.n, piv.values(), tmp_dir, chunk_rows):
+            ranks[pos] = r
+            ties = ties or bool((cnt > 1).any())
+        ranks.flush()
+        rank_files.append(ranks)
+    rx, ry = rank_files
+    co_r = _CoMoments()
+    for start, stop in _chunks(rows, chunk_rows):
+        cx, cy = x.chunk(start, stop), y.chunk(start, stop)
+        both = ~np.isnan(cx) & ~np.isnan(cy)
+        co_r.add(np.asarray(rx[start:stop])[both], np.asarray(ry[start:stop])[both])
+    del rx, ry, rank_files
+    return {"recommended_test": "spearman_correlation", "stats": py_engine.spearman_stats(co_r.r(), co_r.n, ties),
+            "plot_path": "", "assumptions": assumptions}
+
+
+def _chi_square(x: _Column, y: _Column, rows: int, chunk_rows: int):
+    ly = max(1, y.levels.shape[0])
+    keys = np.empty(0, dtype=np.int64)
+    counts = np.empty(0, dtype=np.int64)
+    for start, stop in _chunks(rows, chunk_rows):
+        cx, cy = x.chunk(start, stop), y.chunk(start, stop)
+        ok = (cx >= 0) & (cy >= 0)
+        k, c = np.unique(cx[ok].astype(np.int64) * ly + cy[ok], return_counts=True)
+        keys, inv = np.unique(np.concatenate([keys, k]), return_inverse=True)
+        counts = np.bincount(inv, weights=np.concatenate([counts, c])).astype(np.int64)
+    # crosstab of the present levels (label order does not change the test)
+    r_codes, r_idx = np.unique(keys // ly, return_inverse=True)
+    c_codes, c_idx = np.unique(keys % ly, return_inverse=True)
+    tab = np.zeros((r_codes.shape[0], c_codes.shape[0]), dtype=np.int64)
+    tab[r_idx, c_idx] = counts
+    return {"recommended_test": "chi_square", "stats": py_engine.chi_square_stats(tab), "plot_path": ""}
+
+
+def _bartlett_p(n, var):
+    if n.shape[0] < 2 or (n < 2).any():
+        return None
+    k, total = n.shape[0], n.sum()
+    try:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            spsq = ((n - 1) * var).sum() / (total - k)
+            numer = (total - k) * np.log(spsq) - ((n - 1) * np.log(var)).sum()
+            denom = 1 + 1.0 / (3 * (k - 1)) * ((1.0 / (n - 1)).sum() - 1.0 / (total - k))
+            return py_engine._num(sps.chi2.sf(numer / denom, k - 1))
+    except Exception:
+        return None
+
+
+def _mixed(cat: _Column, num: _Column, rows: int, chunk_rows: int, tmp_dir: str):
+    n_levels = cat.levels.shape[0]
+    present = np.zeros(n_levels, dtype=np.int64)
+    has_na = False
+    valid_rows = 0
+    for start, stop in _chunks(rows, chunk_rows):
+        codes, values = cat.chunk(start, stop), num.chunk(start, stop)
+        has_na = has_na or bool((codes < 0).any())
+        present += np.bincount(codes[codes >= 0], minlength=n_levels)
+        valid_rows += int((~((codes < 0) & np.isnan(values))).sum())
+    if valid_rows <= STREAMING_IN_MEMORY_ROWS:
+        return py_engine._mixed(*_gather(cat, num, rows, chunk_rows))
+
+    # groups in sorted label order, as pd.factorize(sort=True) / as.factor()
+    codes_present = np.flatnonzero(present)
+    order = codes_present[np.argsort(cat.levels[codes_present], kind="stable")]
+    labels = cat.levels[order].tolist()
+    group_of = np.full(n_levels, -1, dtype=np.int64)
+    group_of[order] = np.arange(order.shape[0])
+    k = len(labels) + int(has_na)
+
+    def valid_chunks():
+        for start, stop in _chunks(rows, chunk_rows):
+            codes, values = cat.chunk(start, stop), num.chunk(start, stop)
+            ok = (codes >= 0) & ~np.isnan(values)
+            yield group_of[codes[ok]], values[ok]
+
+    moments = _Moments(len(labels))
+    for g, v in valid_chunks():
+        moments.add(g, v)
+    n_valid = int(moments.n.sum())
+    norms = [_Normality(int(moments.n[i]), moments.mean[i], moments.lo[i] == moments.hi[i]) for i in range(len(labels))]
+    pivots = _pivot_sample(n_valid)
+    for g, v in valid_chunks():
+        pivots.add(v)
+        order_g = np.argsort(g, kind="stable")
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(g, minlength=len(labels)))])
+        v_sorted = v[order_g]
+        for i in np.flatnonzero(np.diff(bounds)):
+            norms[i].add(v_sorted[bounds[i]:bounds[i + 1]])
+
+    checks = [norm.check(group=lv) for lv, norm in zip(labels, norms)]
+    normal_by_group = not has_na and all(c["p_value"] is not None and c["p_value"] > 0.05 for c in checks)
+    used = moments.n > 0
+    n, mean, var = moments.n[used], moments.mean[used], moments.m2[used] / np.maximum(moments.n[used] - 1, 1)
+    levene_p = _bartlett_p(n, var)
+    assumptions = {"normality": checks, "variance_homogeneity_p": levene_p}
+
+    if k == 2:
+        if n.shape[0] != 2:
+            raise ValueError("grouping factor must have exactly 2 levels")
+        if normal_by_group:
+            equal_var = levene_p is not None and levene_p > 0.05
+            res = sps.ttest_ind_from_stats(mean[0], math.sqrt(var[0]), n[0], mean[1], math.sqrt(var[1]), n[1], equal_var=equal_var)
+            return ("t_student" if equal_var else "welch_t"), {
+                "method": " Two Sample t-test" if equal_var else "Welch Two Sample t-test",
+                "statistic": py_engine._num(res.statistic),
+                "p_value": py_engine._num(res.pvalue),
+                "estimate": [py_engine._num(mean[0]), py_engine._num(mean[1])],
+            }, assumptions
+    elif normal_by_group and levene_p is not None and levene_p > 0.05:
+        total = n.sum()
+        grand = (n * mean).sum() / total
+        ssb = (n * (mean - grand) ** 2).sum()
+        ssw = moments.m2[used].sum()
+        df_b, df_w = n.shape[0] - 1, total - n.shape[0]
+        f = (ssb / df_b) / (ssw / df_w)
+        return "anova", {"method": "ANOVA", "statistic": py_engine._num(f), "p_value": py_engine._num(sps.f.sf(f, df_b, df_w))}, assumptions
+
+    # rank-based: per-group rank sums and the tie correction from the external ranking
+    used_groups = np.flatnonzero(used)
+    rank_sums = np.zeros(len(labels))
+    ties = 0.0
+
+    def batches():
+        for g, v in valid_chunks():
+            yield v, g
+
+    for r, g, cnt in _ranked_buckets(batches, n_valid, pivots.values(), tmp_dir, chunk_rows):
+        rank_sums += np.bincount(g, weights=r, minlength=len(labels))
+        ties += _tie_sum(cnt)
+    rank_sums = rank_sums[used_groups]
+    total = float(n.sum())
+    if k == 2:
+        n1, n2 = float(n[0]), float(n[1])
+        u1 = rank_sums[0] - n1 * (n1 + 1) / 2
+        u = max(u1, n1 * n2 - u1)
+        sigma = math.sqrt(n1 * n2 / 12.0 * ((total + 1) - ties / (total * (total - 1))))
+        z = (u - n1 * n2 / 2.0 - 0.5) / sigma if sigma > 0 else math.nan
+        p = min(1.0, 2 * sps.norm.sf(z)) if not math.isnan(z) else None
+        return "wilcoxon", {"method": "Wilcoxon rank sum test with continuity correction",
+                            "statistic": py_engine._num(u1), "p_value": py_engine._num(p)}, assumptions
+    h = 12.0 / (total * (total + 1)) * (rank_sums ** 2 / n).sum() - 3 * (total + 1)
+    h /= 1 - ties / (total ** 3 - total)
+    return "kruskal_wallis", {"method": "Kruskal-Wallis rank sum test", "statistic": py_engine._num(h),
+                              "p_value": py_engine._num(sps.chi2.sf(h, n.shape[0] - 1))}, assumptions
+
+
+def run_analysis(snapshot_dir: str, manifest, x_name: str, y_name: str, chunk_rows: int = None):
+    """py_engine.run_analysis over the snapshot, chunk by chunk, with bounded memory."""
+    chunk_rows = chunk_rows or STREAMING_CHUNK_ROWS
+    rows = int(manifest["rows"])
+    x = _Column(snapshot_dir, manifest, x_name)
+    y = _Column(snapshot_dir, manifest, y_name)
+    tmp_dir = tempfile.mkdtemp(prefix="rank_")
+    try:
+        if x.numeric and y.numeric:
+            return _numeric_pair(x, y, rows, chunk_rows, tmp_dir)
+        if not x.numeric and not y.numeric:
+            return _chi_square(x, y, rows, chunk_rows)
+        cat, num = (x, y) if not x.numeric else (y, x)
+        recommended, stats, assumptions = _mixed(cat, num, rows, chunk_rows, tmp_dir)
+        return {"recommended_test": recommended, "stats": stats, "plot_path": "", "assumptions": assumptions}
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -0,0 +1,313 @@
+import os
+import json
+import time
+import shutil
+import asyncio
+import tempfile
+import threading
+
+from .lazy import lazy_import
+
+dataset_service = lazy_import(".services.dataset_service", __package__)
+
+# Lifecycle of uploaded datasets.
+#
+# A dataset is <file_id>.csv + <file_id>.meta.json + <file_id>.snapshot/ in the
+# upload dir. Datasets are indexed by the sha256 of the uploaded bytes
+# (.index/<hash>.json -> file_id), so uploading the same file again returns the
+# existing dataset together with its snapshot, profile and cached results.
+#
+# The meta file's mtime records the last use. A background sweeper evicts
+# datasets unused for UPLOAD_TTL seconds and then the least recently used ones
+# until the store fits in UPLOAD_STORE_MAX_BYTES. It also removes leftovers:
+# interrupted uploads (.part), half-built snapshots (.snapshot.tmp) and the
+# temporary CSVs written for R (conv_*.csv, proj_*.csv) in the temp dir.
+#
+# Datasets in use (an analysis, a queued or running job, a streamed batch, an
+# append) hold a lease and are never evicted. Neither is the most recently
+# used dataset for being over the quota - an upload larger than the whole
+# quota is refused instead (fits()). Leases live in this process only: run
+# one server process per upload dir. Leftovers (.tmp, .part, .snapshot.tmp)
+# of a leased dataset belong to a running upload, build or append and are kept.
+#
+# The sweep holds the lock only to re-check leases and mark a dataset as
+# evicting; sizing, rmtree and the leftover scans run without it, so lease()
+# and release() from the event loop never wait for the disk. A dataset being
+# evicted is no longer available() to new requests.
+
+UPLOAD_STORE_MAX_BYTES = int(os.environ.get("UPLOAD_STORE_MAX_BYTES", str(10 * 1024 * 1024 * 1024)))
+UPLOAD_TTL = float(os.environ.get("UPLOAD_TTL", str(7 * 24 * 3600)))
+UPLOAD_SWEEP_INTERVAL = float(os.environ.get("UPLOAD_SWEEP_INTERVAL", "600"))
+# leftovers older than this are garbage
+_STALE_SECONDS = 3600
+_TEMP_PREFIXES = ("conv_", "proj_")
+
+
+def _tree_size(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for dirpath, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, f))
+            except OSError:
+                pass
+    return total
+
+
+class UploadStore:
+    def __init__(self, root: str, max_bytes=UPLOAD_STORE_MAX_BYTES, ttl=UPLOAD_TTL,
+                 sweep_interval=UPLOAD_SWEEP_INTERVAL):
+        self.root = root
+        self.index_dir = os.path.join(root, ".index")
+        os.makedirs(self.index_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._leases = {}  # file_id -> number of holders
+        self._evicting = set()
+        self._sweeper = None
+        self.dedup_hits = 0
+        self.evictions = 0
+        self.temp_files_removed = 0
+        self.sweeps = 0
+        self.last_bytes = None
+
+    def csv_path(self, file_id: str) -> str:
+        return os.path.join(self.root, f"{file_id}.csv")
+
+    def meta_path(self, file_id: str) -> str:
+        return os.path.join(self.root, f"{file_id}.meta.json")
+
+    def _pointer(self, content_hash: str) -> str:
+        return os.path.join(self.index_dir, f"{content_hash}.json")
+
+    def find(self, content_hash: str):
+        """file_id of a stored dataset with these bytes, or None.
+
+        The dataset is marked used before the sweeper can run again, so it is
+        not evicted between the lookup and the client's next request.
+        """
+        try:
+            with open(self._pointer(content_hash), "r", encoding="utf-8") as f:
+                file_id = json.load(f)["file_id"]
+        except Exception:
+            return None
+        with self._lock:
+            if file_id in self._evicting or not os.path.exists(self.meta_path(file_id)):
+                return None
+            if not os.path.exists(self.csv_path(file_id)):
+                return None
+            self.touch(file_id)
+            self.dedup_hits += 1
+        return file_id
+
+    def lease(self, file_id: str) -> "Lease":
+        """Keep the dataset from being evicted until the returned lease is released."""
+        with self._lock:
+            self._leases[file_id] = self._leases.get(file_id, 0) + 1
+        return Lease(self, file_id)
+
+    def _release(self, file_id: str):
+        with self._lock:
+            n = self._leases.get(file_id, 0) - 1
+            if n > 0:
+                self._leases[file_id] = n
+            else:
+                self._leases.pop(file_id, None)
+
+    def in_use(self, file_id: str) -> bool:
+        return file_id in self._leases
+
+    def available(self, file_id: str) -> bool:
+        """Whether the dataset exists and is not being evicted; check it after taking a lease."""
+        return file_id not in self._evicting and os.path.exists(self.csv_path(file_id))
+
+    def fits(self, size: int) -> bool:
+        """Whether a dataset of this many bytes can be kept at all under the quota."""
+        return self.max_bytes <= 0 or size <= self.max_bytes
+
+    def register(self, file_id: str, content_hash: str):
+        tmp = f"{self._pointer(content_hash)}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"file_id": file_id}, f)
+        os.replace(tmp, self._pointer(content_hash))
+
+    def unregister(self, file_id: str, content_hash: str):
+        """Drop the index entry of content_hash if it points to file_id."""
+        try:
+            with open(self._pointer(content_hash), "r", encoding="utf-8") as f:
+                if json.load(f).get("file_id") == file_id:
+                    os.remove(self._pointer(content_hash))
+        except Exception:
+            pass
+
+    def touch(self, file_id: str):
+        try:
+            os.utime(self.meta_path(file_id))
+        except OSError:
+            pass
+
+    def remove(self, file_id: str):
+        content_hash = None
+        try:
+            with open(self.meta_path(file_id), "r", encoding="utf-8") as f:
+                content_hash = json.load(f).get("content_hash")
+        except Exception:
+            pass
+        if content_hash:
+            self.unregister(file_id, content_hash)
+        shutil.rmtree(dataset_service.snapshot_dir_for(self.root, file_id), ignore_errors=True)
+        for path in (self.csv_path(file_id), self.meta_path(file_id)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def dataset_size(self, file_id: str) -> int:
+        size = _tree_size(self.csv_path(file_id)) if os.path.exists(self.csv_path(file_id)) else 0
+        snap = dataset_service.snapshot_dir_for(self.root, file_id)
+        if os.path.isdir(snap):
+            size += _tree_size(snap)
+        return size
+
+    def datasets(self):
+        """[(last_used, bytes, file_id)] of every stored dataset, least recently used first."""
+        out = []
+        for name in os.listdir(self.root):
+            if not name.endswith(".meta.json"):
+                continue
+            file_id = name[:-len(".meta.json")]
+            try:
+                last_used = os.stat(self.meta_path(file_id)).st_mtime
+            except OSError:
+                continue
+            out.append((last_used, self.dataset_size(file_id), file_id))
+        out.sort()
+        return out
+
+    def _remove_leftovers(self):
+        now = time.time()
+        with self._lock:
+            leased = set(self._leases)
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if not (name.endswith(".part") or name.endswith(".snapshot.tmp") or name.endswith(".tmp")):
+                continue
+            # <file_id>.csv.part, <file_id>.snapshot.tmp, <file_id>.append.*.tmp: still being written
+            if name.split(".", 1)[0] in leased:
+                continue
+            try:
+                if now - os.stat(path).st_mtime > _STALE_SECONDS:
+                    shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+            except OSError:
+                pass
+        tmp_dir = tempfile.gettempdir()
+        for name in os.listdir(tmp_dir):
+            if not (name.startswith(_TEMP_PREFIXES) and name.endswith(".csv")):
+                continue
+            path = os.path.join(tmp_dir, name)
+            try:
+                if now - os.stat(path).st_mtime > _STALE_SECONDS:
+                    os.remove(path)
+                    self.temp_files_removed += 1
+            except OSError:
+                pass
+
+    def sweep(self):
+        """One sweeper pass: TTL eviction, then LRU eviction down to the quota, then leftovers.
+
+        Leased datasets are skipped; the most recently used one is only evicted by the TTL.
+        """
+        entries = self.datasets()
+        total = sum(size for _, size, _ in entries)
+        newest = entries[-1][2] if entries else None
+        now = time.time()
+        for last_used, size, file_id in entries:
+            expired = self.ttl > 0 and now - last_used > self.ttl
+            over_quota = self.max_bytes > 0 and total > self.max_bytes and file_id != newest
+            if not (expired or over_quota):
+                continue
+            with self._lock:
+                if file_id in self._leases:
+                    continue
+                self._evicting.add(file_id)
+            print(f"[upload_store] evicting dataset {file_id} ({size} bytes, {'expired' if expired else 'over quota'})")
+            try:
+                self.remove(file_id)
+            finally:
+                with self._lock:
+                    self._evicting.discard(file_id)
+            total -= size
+            self.evictions += 1
+        self._remove_leftovers()
+        self.last_bytes = total
+        self.sweeps += 1
+
+    def reindex(self):
+        """Add index entries for datasets stored before the index existed."""
+        for name in os.listdir(self.root):
+            if not name.endswith(".meta.json"):
+                continue
+            try:
+                with open(os.path.join(self.root, name), "r", encoding="utf-8") as f:
+                    content_hash = json.load(f).get("content_hash")
+            except Exception:
+                continue
+            if content_hash and not os.path.exists(self._pointer(content_hash)):
+                self.register(name[:-len(".meta.json")], content_hash)
+
+    async def _sweep_loop(self):
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.reindex)
+        except Exception as e:
+            print(f"[upload_store] reindex failed: {e}")
+        while True:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.sweep)
+            except Exception as e:
+                print(f"[upload_store] sweep failed: {e}")
+            await asyncio.sleep(self.sweep_interval)
+
+    def start_sweeper(self):
+        if self._sweeper is None and self.sweep_interval > 0:
+            self._sweeper = asyncio.ensure_future(self._sweep_loop())
+
+    def stop_sweeper(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+
+    def stats(self) -> dict:
+        return {
+            "bytes": self.last_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "dedup_hits": self.dedup_hits,
+            "evictions": self.evictions,
+            "temp_files_removed": self.temp_files_removed,
+            "sweeps": self.sweeps,
+            "in_use": len(self._leases),
+        }
+
+
+class Lease:
+    """Hold on a dataset (UploadStore.lease); release() is idempotent, so every exit path may call it."""
+
+    def __init__(self, store: UploadStore, file_id: str):
+        self.store = store
+        self.file_id = file_id
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.store._release(self.file_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
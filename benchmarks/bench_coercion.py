@@ -0,0 +1,137 @@
+# Benchmark: numeric coercion of text columns (stat_tests.R heuristics).
+# uruchom: python benchmarks/bench_coercion.py [--rows 1000000]
+#
+# Compares the old element-wise coerce_one() (R vapply, and the same loop in
+# Python) with the vectorized coercion and with reading a snapshot column that
+# was coerced once at ingest. R timings are skipped when rpy2/R are missing.
+import os
+import re
+import sys
+import math
+import time
+import json
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from backend import py_engine  # noqa: E402
+from backend.services import dataset_service  # noqa: E402
+
+R_OLD = r'''
+function(vec) {
+  vec_ch <- as.character(vec)
+  vec_ch <- gsub(" ", "", vec_ch, fixed = TRUE)
+  vec_ch <- gsub("\\s+", "", vec_ch)
+  vec_ch[vec_ch == ""] <- NA_character_
+  coerce_one <- function(s) {
+    if (is.na(s)) return(NA_real_)
+    if (grepl("\\.", s) && grepl(",", s)) {
+      s2 <- gsub("\\.", "", s)
+      s2 <- gsub(",", ".", s2, fixed = TRUE)
+    } else if (grepl(",", s) && !grepl("\\.", s)) {
+      s2 <- gsub(",", ".", s, fixed = TRUE)
+    } else if (grepl("\\.", s) && length(gregexpr("\\.", s)[[1]]) > 1) {
+      s2 <- gsub("\\.", "", s)
+    } else {
+      s2 <- s
+    }
+    s2 <- gsub("[^0-9\\.\\-]", "", s2)
+    if (s2 == "" || s2 == "-" || s2 == "." || s2 == "-.") return(NA_real_)
+    suppressWarnings(as.numeric(s2))
+  }
+  vapply(vec_ch, coerce_one, FUN.VALUE = numeric(1), USE.NAMES = FALSE)
+}
+'''
+
+
+def make_column(rows, seed=0):
+    """Polish-formatted amounts: decimal commas, NBSP/space thousands, dotted thousands, some junk."""
+    rs = np.random.RandomState(seed)
+    v = np.round(rs.lognormal(7, 1.5, rows), 2)
+    style = rs.randint(0, 5, rows)
+    out = np.empty(rows, dtype=object)
+    for i in range(rows):
+        s = f"{v[i]:,.2f}"  # 12,345.67
+        st = style[i]
+        if st == 0:
+            s = s.replace(",", " ").replace(".", ",")
+        elif st == 1:
+            s = s.replace(",", " ").replace(".", ",")
+        elif st == 2:
+            s = s.replace(",", "X").replace(".", ",").replace("X", ".")
+        elif st == 3:
+            s = s.replace(",", "")
+        else:
+            s = "brak" if rs.rand() < 0.5 else ""
+        out[i] = s
+    return out
+
+
+def _coerce_one(s):
+    if s is None:
+        return math.nan
+    s = re.sub(r"\s+", "", s.replace(" ", ""))
+    if "." in s and "," in s:
+        s = s.replace(".", "").replace(",", ".")
+    elif "," in s:
+        s = s.replace(",", ".")
+    elif s.count(".") > 1:
+        s = s.replace(".", "")
+    s = re.sub(r"[^0-9.\-]", "", s)
+    try:
+        return float(s)
+    except ValueError:
+        return math.nan
+
+
+def timed(fn, repeat=3):
+    best = math.inf
+    out = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - t)
+    return best, out
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=1000000)
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+
+    col = make_column(args.rows)
+    results = {"rows": args.rows}
+
+    results["python_elementwise_s"], ref = timed(lambda: np.array([_coerce_one(s) for s in col]), 1)
+    results["python_vectorized_s"], vec = timed(lambda: py_engine.coerce_strings(col), args.repeat)
+    assert np.array_equal(np.isnan(ref), np.isnan(vec)) and np.allclose(ref[~np.isnan(ref)], vec[~np.isnan(vec)])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, "bench.csv")
+        pd.DataFrame({"kwota": col}).to_csv(csv_path, index=False, sep=";")
+        snap = os.path.join(tmp, "bench.snapshot")
+        results["ingest_snapshot_s"], manifest = timed(
+            lambda: dataset_service.build_snapshot(csv_path, snap, encoding="utf-8", delimiter=";"), 1)
+        results["snapshot_read_s"], cached = timed(
+            lambda: dataset_service.load_analysis_column(snap, manifest, "kwota"), args.repeat)
+        assert cached.dtype.kind == "f"
+
+    try:
+        import rpy2.robjects as ro
+        ro.r["source"](os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "r_scripts", "stat_tests.R"))
+        r_col = ro.StrVector([s if s is not None else ro.NA_Character for s in col])
+        r_old = ro.r(R_OLD)
+        r_new = ro.globalenv[".coerce_numeric_if_possible"]
+        results["r_vapply_s"], _ = timed(lambda: r_old(r_col), 1)
+        results["r_vectorized_s"], _ = timed(lambda: r_new(r_col), args.repeat)
+    except Exception as e:
+        results["r_skipped"] = str(e)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
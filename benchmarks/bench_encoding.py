@@ -0,0 +1,156 @@
+# Benchmark: encoding and delimiter detection at upload.
+# uruchom: python benchmarks/bench_encoding.py [--rows 20000] [--keep DIR]
+#
+# Builds a corpus of CSVs the way they reach us in practice (Excel exports in
+# cp1250 with ';' and decimal commas, UTF-8 with and without BOM, UTF-16 from
+# "Unicode text", ISO-8859-2 from old systems, Western latin1/cp1252, tabs and
+# pipes) and runs the old detection (chardet on 200 KB + csv.Sniffer + python
+# engine parse) and the new one (backend/services/encoding_service.py) on each
+# file. Prints the detected encoding/delimiter, whether they decode the file to
+# the same text as the ground truth, and timings.
+import os
+import io
+import sys
+import csv
+import time
+import json
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from backend.services import encoding_service  # noqa: E402
+
+SNIFF_BYTES = 200000
+
+_PL_NAMES = ["Łódź", "Kraków", "Gdańsk", "Wrocław", "Poznań", "Szczecin", "Bielsko-Biała", "Zielona Góra",
+             "Częstochowa", "Świętochłowice", "Żyrardów", "Źródła", "Ostrów Wielkopolski"]
+_PL_ANSWERS = ["zdecydowanie się zgadzam", "raczej się zgadzam", "nie mam zdania", "raczej się nie zgadzam",
+               "zdecydowanie się nie zgadzam", "trudno powiedzieć", "wyższe", "średnie", "zasadnicze zawodowe"]
+_WEST_NAMES = ["Zürich", "Genève", "München", "Düsseldorf", "Málaga", "São Paulo", "Montréal", "Köln", "Århus"]
+
+
+def _frame(rows, names, answers, seed):
+    rs = np.random.RandomState(seed)
+    return pd.DataFrame({
+        "Płeć" if answers is _PL_ANSWERS else "Genre": rs.choice(["K", "M"], rows),
+        "Wiek" if answers is _PL_ANSWERS else "Âge": rs.randint(18, 90, rows),
+        "Miejscowość" if answers is _PL_ANSWERS else "Ville": rs.choice(names, rows),
+        "Odpowiedź" if answers is _PL_ANSWERS else "Réponse": rs.choice(answers, rows),
+        "Dochód netto" if answers is _PL_ANSWERS else "Revenu": np.round(rs.lognormal(8, 0.6, rows), 2),
+    })
+
+
+def corpus(rows):
+    """[(name, bytes, encoding, delimiter)] - encoding/delimiter are the ground truth."""
+    pl = _frame(rows, _PL_NAMES, _PL_ANSWERS, 0)
+    west = _frame(rows, _WEST_NAMES, ["très bien", "größer", "año", "niño", "déjà vu"], 1)
+    cases = [
+        ("excel_pl_cp1250_semicolon", pl, "cp1250", ";", ","),
+        ("excel_pl_cp1250_tab", pl, "cp1250", "\t", ","),
+        ("legacy_pl_latin2_semicolon", pl, "iso-8859-2", ";", ","),
+        ("legacy_pl_latin2_comma", pl, "iso-8859-2", ",", "."),
+        ("pl_utf8_comma", pl, "utf-8", ",", "."),
+        ("pl_utf8_bom_semicolon", pl, "utf-8-sig", ";", ","),
+        ("pl_utf16_tab", pl, "utf-16", "\t", ","),
+        ("pl_utf8_pipe", pl, "utf-8", "|", "."),
+        ("west_latin1_semicolon", west, "latin1", ";", ","),
+        ("west_cp1252_comma", west, "cp1252", ",", "."),
+        ("ascii_comma", pl.assign(**{"Miejscowość": "x", "Odpowiedź": "y"}).rename(columns=lambda c: _ascii_name(c)), "ascii", ",", "."),
+    ]
+    out = []
+    for name, df, enc, sep, decimal in cases:
+        buf = io.StringIO()
+        df.to_csv(buf, index=False, sep=sep, decimal=decimal, quoting=csv.QUOTE_MINIMAL)
+        out.append((name, buf.getvalue().encode(enc), enc, sep))
+    return out
+
+
+def _ascii_name(name):
+    return name.encode("ascii", "ignore").decode("ascii") or "c"
+
+
+def old_detect(path):
+    """Detection as it was before encoding_service (chardet + Sniffer + python engine)."""
+    import chardet
+    with open(path, "rb") as f:
+        sample = f.read(SNIFF_BYTES)
+    enc = encoding_service.normalize_encoding(chardet.detect(sample).get("encoding") or "")
+    decoded = sample.decode(enc, errors="replace") if enc else sample.decode("utf-8", errors="replace")
+    try:
+        delimiter = csv.Sniffer().sniff(decoded, delimiters=[",", ";", "\t", "|"]).delimiter
+    except Exception:
+        header = decoded.splitlines()[0] if decoded else ""
+        counts = {c: header.count(c) for c in [",", ";", "\t", "|"]}
+        best = max(counts.items(), key=lambda kv: kv[1])
+        delimiter = best[0] if best[1] > 0 else ","
+    for e in [enc, "utf-8", "cp1250", "latin1", "iso-8859-2", "utf-16"]:
+        try:
+            pd.read_csv(path, nrows=1000, encoding=e, sep=delimiter, engine="python")
+            return e, delimiter
+        except Exception:
+            continue
+    return "unknown", ","
+
+
+def new_detect(path):
+    with open(path, "rb") as f:
+        sample = f.read(SNIFF_BYTES)
+    det = encoding_service.detect(sample, truncated=len(sample) >= SNIFF_BYTES)
+    pd.read_csv(path, nrows=1000, encoding=det["encoding"], sep=det["delimiter"])
+    return det["encoding"], det["delimiter"]
+
+
+def _decodes_same(data, truth, enc):
+    try:
+        return data.decode(enc).lstrip("\ufeff") == data.decode(truth).lstrip("\ufeff")
+    except Exception:
+        return False
+
+
+def timed(fn, repeat):
+    best, out = float("inf"), None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - t)
+    return best, out
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=20000)
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--keep", help="write the corpus to this directory")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = args.keep or tmp
+        os.makedirs(root, exist_ok=True)
+        results = []
+        for name, data, enc, sep in corpus(args.rows):
+            path = os.path.join(root, f"{name}.csv")
+            with open(path, "wb") as f:
+                f.write(data)
+            t_old, (old_enc, old_sep) = timed(lambda: old_detect(path), 1)
+            t_new, (new_enc, new_sep) = timed(lambda: new_detect(path), args.repeat)
+            results.append({
+                "file": name, "bytes": len(data), "truth": [enc, sep],
+                "old": [old_enc, old_sep], "old_ok": _decodes_same(data, enc, old_enc) and old_sep == sep,
+                "new": [new_enc, new_sep], "new_ok": _decodes_same(data, enc, new_enc) and new_sep == sep,
+                "old_s": round(t_old, 4), "new_s": round(t_new, 4),
+            })
+    summary = {
+        "files": len(results),
+        "old_correct": sum(r["old_ok"] for r in results),
+        "new_correct": sum(r["new_ok"] for r in results),
+        "same_as_old": sum(r["old"] == r["new"] for r in results),
+        "old_total_s": round(sum(r["old_s"] for r in results), 3),
+        "new_total_s": round(sum(r["new_s"] for r in results), 3),
+    }
+    print(json.dumps({"summary": summary, "results": results}, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+# Benchmark: the request pipeline on synthetic datasets (upload -> analyze -> export).
+# uruchom: python benchmarks/bench_pipeline.py [--rows 1000,100000] [--encodings utf-8,cp1250,utf-16]
+#          [--delimiters ",;"] [--numeric 3] [--categorical 2] [--engine stub|r|python]
+#          [--repeat 3] [--out wyniki.json] [--baseline poprzednie.json] [--tolerance 0.25]
+#
+# For every combination of size / encoding / delimiter a dataset is generated
+# (benchmarks/synthetic.py) and these are timed:
+#   detect_encoding       main._detect_encoding_and_columns
+#   convert_to_comma_csv  r_interface._convert_to_comma_csv
+#   upload                POST /upload (a new dataset every run, not the dedup path)
+#   analyze[...]          POST /analyze for a numeric, a mixed and a categorical pair
+#   export                POST /export
+#   excel_report          report_service.generate_excel_report
+# The app runs in-process (TestClient), no server is needed. The result cache is
+# disabled so every analyze/export run computes. HTTP runs also keep the stages
+# from their Server-Timing header (median run).
+#
+# --engine stub (default) swaps the rpy2 boundary for benchmarks/stub_r.py and
+# runs without R; --engine r needs rpy2 + R; --engine python uses the NumPy/SciPy
+# port. Uploaded datasets are removed at the end.
+#
+# Results go to --out as JSON. With --baseline the medians are compared with an
+# earlier file: a benchmark that got slower by more than --tolerance (and by
+# more than 5 ms) is reported as a regression and the exit status is 1.
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import datetime
+import tempfile
+import itertools
+import statistics
+import subprocess
+import contextlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic  # noqa: E402
+
+NOISE_FLOOR_S = 0.005
+
+
+@contextlib.contextmanager
+def quiet(enabled=True):
+    """Silence the [module.func] logging of the backend while timing."""
+    if not enabled:
+        yield
+        return
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def _server_timing(header):
+    stages = {}
+    for part in (header or "").split(","):
+        name, _, rest = part.strip().partition(";")
+        for attr in rest.split(";"):
+            if attr.startswith("dur="):
+                stages[name] = round(float(attr[4:]) / 1000, 6)
+    return stages
+
+
+def measure(fn, repeat, setup=None, teardown=None):
+    """Run fn() repeat times; returns the timing record and the output of the median run."""
+    runs, outputs = [], []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        started = time.perf_counter()
+        out = fn(arg) if setup else fn()
+        runs.append(time.perf_counter() - started)
+        outputs.append(out)
+        if teardown:
+            teardown(out)
+    median_i = sorted(range(len(runs)), key=runs.__getitem__)[len(runs) // 2]
+    record = {"runs": [round(r, 6) for r in runs], "best_s": round(min(runs), 6),
+              "median_s": round(statistics.median(runs), 6)}
+    return record, outputs[median_i]
+
+
+def _http(response):
+    if response.status_code != 200:
+        raise RuntimeError(f"HTTP {response.status_code}: {response.text[:500]}")
+    return response
+
+
+def _pairs(info):
+    numeric = [c["name"] for c in info["columns"] if c["kind"] != "categorical"]
+    categorical = [c["name"] for c in info["columns"] if c["kind"] == "categorical"]
+    pairs = []
+    if len(numeric) >= 2:
+        pairs.append(("num~num", numeric[0], numeric[1]))
+    if numeric and categorical:
+        pairs.append(("cat~num", categorical[0], numeric[0]))
+    if len(categorical) >= 2:
+        pairs.append(("cat~cat", categorical[0], categorical[1]))
+    return pairs
+
+
+def bench_dataset(client, main, r_interface, report_service, info, args):
+    path, engine, repeat = info["path"], args.engine_name, args.repeat
+    results = []
+
+    def add(name, record, stages=None, **extra):
+        results.append({"benchmark": name, **record, **({"stages": stages} if stages else {}), **extra})
+        print(f"  {name:<22} median {record['median_s'] * 1000:10.1f} ms   best {record['best_s'] * 1000:10.1f} ms",
+              file=sys.stderr)
+
+    with quiet(not args.verbose):
+        record, _ = measure(lambda: main._detect_encoding_and_columns(path), repeat)
+    add("detect_encoding", record)
+
+    with quiet(not args.verbose):
+        record, _ = measure(lambda: r_interface._convert_to_comma_csv(path, info["encoding"], info["delimiter"]),
+                            repeat, teardown=lambda out: os.remove(out[0]))
+    add("convert_to_comma_csv", record)
+
+    uploaded = []
+
+    def drop_uploaded():
+        # remove the previous upload, so the next run is not answered by deduplication
+        while uploaded:
+            main.upload_store.remove(uploaded.pop())
+
+    def upload(_):
+        with open(path, "rb") as f:
+            r = _http(client.post("/upload", files={"file": (os.path.basename(path), f, "text/csv")}))
+        uploaded.append(r.json()["file_id"])
+        return r
+
+    with quiet(not args.verbose):
+        record, r = measure(upload, repeat, setup=drop_uploaded)
+    file_id = uploaded[-1]
+    add("upload", record, _server_timing(r.headers.get("server-timing")), rows=r.json().get("rows"),
+        deduplicated=r.json().get("deduplicated"))
+
+    plot_bytes, analysed = None, None
+    for label, x, y in _pairs(info):
+        payload = {"file_id": file_id, "x": x, "y": y, "engine": engine}
+        with quiet(not args.verbose):
+            record, r = measure(lambda: _http(client.post("/analyze", json=payload)), repeat)
+        res = r.json()
+        add(f"analyze[{label}]", record, _server_timing(r.headers.get("server-timing")),
+            recommended_test=res.get("recommended_test"))
+        if analysed is None:
+            analysed = dict(res, file_id=file_id)
+            if res.get("plot_url"):
+                plot_bytes = client.get(res["plot_url"]).content
+
+    if analysed is not None:
+        payload = {"file_id": file_id, "x": analysed["actual_x"], "y": analysed["actual_y"], "engine": engine}
+        with quiet(not args.verbose):
+            record, r = measure(lambda: _http(client.post("/export", json=payload)), repeat)
+        add("export", record, _server_timing(r.headers.get("server-timing")), bytes=len(r.content))
+
+        with quiet(not args.verbose):
+            record, _ = measure(lambda: report_service.generate_excel_report(analysed, plot_bytes), repeat)
+        add("excel_report", record)
+
+    drop_uploaded()
+    return results
+
+
+def wait_ready(client, timeout=600):
+    """Wait for the startup warm-up, so the first measured runs do not include it."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        state = client.get("/ready").json()
+        if state["status"] not in ("starting", "warming"):
+            break
+        time.sleep(0.2)
+    print(f"[bench_pipeline] warm-up {state['status']} in {state['seconds']}s {state.get('error') or ''}", file=sys.stderr)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """[(dataset, benchmark, old_s, new_s, ratio)] of the benchmarks that got slower than allowed."""
+    old = {(r["dataset"], r["benchmark"]): r["median_s"] for r in baseline.get("results", [])}
+    regressions = []
+    for r in results:
+        before = old.get((r["dataset"], r["benchmark"]))
+        if before is None:
+            continue
+        after = r["median_s"]
+        if after > before * (1 + tolerance) and after - before > NOISE_FLOOR_S:
+            regressions.append((r["dataset"], r["benchmark"], before, after, round(after / before, 2)))
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", default="1000,100000", help="comma separated sizes, e.g. 1000,100000,10000000")
+    ap.add_argument("--encodings", default="utf-8,cp1250,utf-16")
+    ap.add_argument("--delimiters", default=",;", help="characters, 't' for tab")
+    ap.add_argument("--numeric", type=int, default=3)
+    ap.add_argument("--categorical", type=int, default=2)
+    ap.add_argument("--engine", default="stub", choices=["stub", "r", "python"])
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--out", help="write the results to this JSON file")
+    ap.add_argument("--baseline", help="earlier results to compare with")
+    ap.add_argument("--tolerance", type=float, default=0.25)
+    ap.add_argument("--keep", help="write the datasets to this directory (and reuse them)")
+    ap.add_argument("--verbose", action="store_true", help="keep the backend logging")
+    args = ap.parse_args()
+    sizes = [int(s) for s in args.rows.split(",") if s]
+    encodings = [e for e in args.encodings.split(",") if e]
+    delimiters = ["\t" if d == "t" else d for d in args.delimiters]
+    args.engine_name = "python" if args.engine == "python" else "r"
+
+    # every analyze/export run computes; the stand-in has to run in this process
+    os.environ["RESULT_CACHE_MAX_BYTES"] = "0"
+    os.environ["RESULT_CACHE_DIR"] = ""
+    if args.engine == "stub":
+        os.environ["R_POOL_SIZE"] = "0"
+    from fastapi.testclient import TestClient
+    from backend import main as backend_main, r_interface
+    from backend.services import report_service
+    if args.engine == "stub":
+        import stub_r
+        stub_r.install()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp, TestClient(backend_main.app) as client:
+        wait_ready(client)
+        root = args.keep or tmp
+        os.makedirs(root, exist_ok=True)
+        for rows, encoding, delimiter in itertools.product(sizes, encodings, delimiters):
+            dataset = f"rows={rows},enc={encoding},sep={delimiter!r},num={args.numeric},cat={args.categorical}"
+            path = os.path.join(root, f"synthetic_{rows}_{encoding}_{ord(delimiter)}_{args.numeric}x{args.categorical}.csv")
+            if os.path.exists(path) and os.path.exists(path + ".json"):
+                with open(path + ".json", "r", encoding="utf-8") as f:
+                    info = json.load(f)
+            else:
+                started = time.perf_counter()
+                info = synthetic.write_csv(path, rows, args.numeric, args.categorical, encoding, delimiter, args.seed)
+                print(f"[bench_pipeline] generated {dataset} ({info['bytes']} bytes) in {time.perf_counter() - started:.1f}s",
+                      file=sys.stderr)
+                with open(path + ".json", "w", encoding="utf-8") as f:
+                    json.dump(info, f, ensure_ascii=False)
+            print(f"[bench_pipeline] {dataset}", file=sys.stderr)
+            for r in bench_dataset(client, backend_main, r_interface, report_service, info, args):
+                results.append({"dataset": dataset, "rows": rows, "encoding": encoding, "delimiter": delimiter,
+                                "bytes": info["bytes"], **r})
+
+    report = {
+        "meta": {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": _git_commit(),
+            "engine": args.engine,
+            "repeat": args.repeat,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    else:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("meta", {}).get("engine") != args.engine:
+            print(f"[bench_pipeline] baseline was measured with engine {baseline.get('meta', {}).get('engine')!r}, "
+                  f"this run with {args.engine!r}", file=sys.stderr)
+        regressions = compare(results, baseline, args.tolerance)
+        for dataset, name, before, after, ratio in regressions:
+            print(f"[bench_pipeline] REGRESSION {name} on {dataset}: {before * 1000:.1f} ms -> {after * 1000:.1f} ms (x{ratio})",
+                  file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print(f"[bench_pipeline] no regressions against {args.baseline} (tolerance {args.tolerance:.0%})", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
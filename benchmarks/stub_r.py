@@ -0,0 +1,94 @@
+# Stand-in for the embedded R engine, for benchmarks on machines without R.
+#
+# install() replaces the rpy2 boundary of backend/r_interface.py
+# (_ensure_r_loaded, _call_r_analysis and _call_r_vectors), so everything around
+# it still runs for real: the r_pool hand-off, snapshot column loads or
+# projection CSVs (R_INPUT=csv), the plot hand-over through the incoming dir,
+# caching and reports. The stand-in does what stat_tests.R does per call (take
+# the vectors or parse the two requested CSV columns, run the tests via the
+# Python port, write an 800x600 PNG) and reports the same timings keys.
+# Numbers measure the pipeline around R, not R itself - use --engine r for that.
+import os
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+from PIL import Image, ImageDraw
+
+from backend import py_engine, r_interface
+
+PLOT_SIZE = (800, 600)
+PLOT_POINTS = 5000
+
+
+def _plot(path, x, y):
+    img = Image.new("RGB", PLOT_SIZE, "white")
+    draw = ImageDraw.Draw(img)
+    xs = pd.to_numeric(pd.Series(x[:PLOT_POINTS]), errors="coerce").to_numpy(dtype=float)
+    ys = pd.to_numeric(pd.Series(y[:PLOT_POINTS]), errors="coerce").to_numpy(dtype=float)
+    keep = np.isfinite(xs) & np.isfinite(ys)
+    if keep.any():
+        xs, ys = xs[keep], ys[keep]
+        px = 40 + (xs - xs.min()) / (np.ptp(xs) or 1) * (PLOT_SIZE[0] - 80)
+        py = PLOT_SIZE[1] - 40 - (ys - ys.min()) / (np.ptp(ys) or 1) * (PLOT_SIZE[1] - 80)
+        for a, b in zip(px, py):
+            draw.ellipse((a - 2, b - 2, a + 2, b + 2), fill=(70, 110, 180))
+    img.save(path, format="PNG")
+
+
+def _analyze(x_values, y_values, plots_dir, timings):
+    started = time.perf_counter()
+    res = py_engine.run_analysis(x_values, y_values)
+    tests_done = time.perf_counter()
+
+    os.makedirs(plots_dir, exist_ok=True)
+    fd, part = tempfile.mkstemp(prefix=".part_plot_", suffix=".png", dir=plots_dir)
+    os.close(fd)
+    name = os.path.basename(part)[len(".part_"):]
+    _plot(part, x_values, y_values)
+    os.replace(part, os.path.join(plots_dir, name))
+    finished = time.perf_counter()
+
+    out = {"recommended_test": res["recommended_test"], "stats": res["stats"], "plot_path": name,
+           "timings": dict(timings, r_tests=tests_done - started, r_plot=finished - tests_done),
+           "encoding_retries": 0}
+    if res.get("assumptions"):
+        out["assumptions"] = res["assumptions"]
+    return out
+
+
+def call_analysis(csv_path, x, y, plots_dir, encoding, delimiter):
+    """Same contract as r_interface._call_r_analysis (x, y are 1-based column positions)."""
+    started = time.perf_counter()
+    # like run_analysis in stat_tests.R, parse only the two requested columns
+    positions = sorted({int(x) - 1, int(y) - 1})
+    df = pd.read_csv(csv_path, encoding=encoding or "utf-8", sep=delimiter or ",", dtype=str, keep_default_na=False,
+                     na_values=["NA", ""], usecols=positions)
+    read_done = time.perf_counter()
+    x_values = df.iloc[:, positions.index(int(x) - 1)].to_numpy(dtype=object)
+    y_values = df.iloc[:, positions.index(int(y) - 1)].to_numpy(dtype=object)
+    out = _analyze(x_values, y_values, plots_dir, {"r_read_csv": read_done - started})
+    out["timings"]["r_call"] = time.perf_counter() - started
+    return out
+
+
+def _as_values(values, levels):
+    if levels is None:
+        return values
+    return np.array(levels + [None], dtype=object)[values]  # code -1 picks the trailing None
+
+
+def call_vectors(x_values, x_levels, y_values, y_levels, x_name, y_name, plots_dir):
+    """Same contract as r_interface._call_r_vectors (text columns as int32 codes plus levels)."""
+    started = time.perf_counter()
+    x_values, y_values = _as_values(x_values, x_levels), _as_values(y_values, y_levels)
+    out = _analyze(x_values, y_values, plots_dir, {"r_input": time.perf_counter() - started})
+    out["timings"]["r_call"] = time.perf_counter() - started
+    return out
+
+
+def install():
+    """Route R analyses of this process to the stand-in (use with R_POOL_SIZE=0)."""
+    r_interface._ensure_r_loaded = lambda force_reload=False: None
+    r_interface._call_r_analysis = call_analysis
+    r_interface._call_r_vectors = call_vectors
@@ -0,0 +1,113 @@
+# Synthetic CSV datasets for the benchmarks.
+# uruchom: python benchmarks/synthetic.py OUT.csv [--rows 1000000] [--numeric 3] [--categorical 2]
+#          [--encoding cp1250] [--delimiter ";"] [--seed 0]
+#
+# Files are written in chunks, so 10M-row files need no more memory than a
+# chunk. Numeric columns mix the shapes the decision tree cares about (normal,
+# skewed, small integers with ties, decimal-comma text the way Excel exports it
+# with ';'); categorical columns use Polish labels, so the encoding matters.
+# The same arguments always produce the same bytes.
+import os
+import io
+import sys
+import csv
+import json
+import codecs
+import argparse
+import numpy as np
+import pandas as pd
+
+CHUNK_ROWS = 200000
+ENCODINGS = ("utf-8", "utf-8-sig", "cp1250", "iso-8859-2", "utf-16")
+DELIMITERS = (",", ";", "\t", "|")
+
+_LEVELS = [
+    ["K", "M"],
+    ["wyższe", "średnie", "zasadnicze zawodowe", "podstawowe"],
+    ["Łódź", "Kraków", "Gdańsk", "Wrocław", "Poznań", "Szczecin", "Bielsko-Biała", "Zielona Góra",
+     "Częstochowa", "Żyrardów"],
+    ["zdecydowanie się zgadzam", "raczej się zgadzam", "nie mam zdania", "raczej się nie zgadzam",
+     "zdecydowanie się nie zgadzam"],
+]
+_NUMERIC = ("normal", "lognormal", "integer", "decimal_text")
+
+
+def column_names(numeric: int, categorical: int):
+    """(name, kind) in file order; kind is a numeric shape or "categorical"."""
+    cols = [(f"liczba_{i + 1}", _NUMERIC[i % len(_NUMERIC)]) for i in range(numeric)]
+    cols += [(f"kategoria_{i + 1}", "categorical") for i in range(categorical)]
+    return cols
+
+
+def _chunk(rs, rows, cols, decimal):
+    data = {}
+    categorical = 0
+    for name, kind in cols:
+        if kind == "normal":
+            data[name] = np.round(rs.normal(50, 10, rows), 3)
+        elif kind == "lognormal":
+            data[name] = np.round(rs.lognormal(8, 0.6, rows), 2)
+        elif kind == "integer":
+            data[name] = rs.randint(18, 90, rows)
+        elif kind == "decimal_text":
+            # thousands separator and decimal comma: stays text until coerced like R does
+            values = rs.normal(5000, 1500, rows)
+            data[name] = pd.Series(values).map(lambda v: f"{v:,.2f}".replace(",", " ").replace(".", decimal))
+        else:
+            levels = _LEVELS[categorical % len(_LEVELS)]
+            categorical += 1
+            data[name] = np.asarray(levels, dtype=object)[rs.randint(0, len(levels), rows)]
+    return pd.DataFrame(data)
+
+
+def write_csv(path: str, rows: int, numeric: int = 3, categorical: int = 2, encoding: str = "utf-8",
+              delimiter: str = ",", seed: int = 0, chunk_rows: int = CHUNK_ROWS) -> dict:
+    """Write the dataset and return its description (columns, bytes, ...)."""
+    cols = column_names(numeric, categorical)
+    # decimal comma goes with ';' / tab, like Polish Excel exports
+    decimal = "," if delimiter in (";", "\t") else "."
+    rs = np.random.RandomState(seed)
+    # incremental encoder: one BOM for utf-16 / utf-8-sig, not one per chunk
+    encoder = codecs.getincrementalencoder(encoding)()
+    size = 0
+    with open(path, "wb") as f:
+        written = 0
+        header = True
+        while written < rows or header:
+            n = min(chunk_rows, rows - written)
+            df = _chunk(rs, n, cols, decimal)
+            buf = io.StringIO()
+            df.to_csv(buf, index=False, header=header, sep=delimiter, decimal=decimal, quoting=csv.QUOTE_MINIMAL)
+            data = encoder.encode(buf.getvalue())
+            f.write(data)
+            size += len(data)
+            written += n
+            header = False
+        tail = encoder.encode("", final=True)
+        f.write(tail)
+        size += len(tail)
+    return {"path": path, "rows": rows, "columns": [{"name": n, "kind": k} for n, k in cols],
+            "encoding": encoding, "delimiter": delimiter, "decimal": decimal, "seed": seed, "bytes": size}
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("out")
+    ap.add_argument("--rows", type=int, default=100000)
+    ap.add_argument("--numeric", type=int, default=3)
+    ap.add_argument("--categorical", type=int, default=2)
+    ap.add_argument("--encoding", default="utf-8", choices=ENCODINGS)
+    ap.add_argument("--delimiter", default=",", help="one of , ; tab |")
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+    delimiter = "\t" if args.delimiter in ("tab", "\\t") else args.delimiter
+    if delimiter not in DELIMITERS:
+        ap.error(f"unsupported delimiter {args.delimiter!r}")
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    info = write_csv(args.out, args.rows, args.numeric, args.categorical, args.encoding, delimiter, args.seed)
+    json.dump(info, sys.stdout, indent=2, ensure_ascii=False)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -101,7 +101,7 @@ export default function AnalyzePanel() {
 
   const [recommended, setRecommended] = useState("");
   const [stats, setStats] = useState(null);
-  const [plotBase64, setPlotBase64] = useState(null);
+  const [plotSrc, setPlotSrc] = useState(null);
   const [plotKey, setPlotKey] = useState(null);
   const [actualX, setActualX] = useState(null);
   const [actualY, setActualY] = useState(null);
@@ -132,7 +132,7 @@ export default function AnalyzePanel() {
       setRows(data.rows || null);
       setRecommended("");
       setStats(null);
-      setPlotBase64(null);
+      setPlotSrc(null);
       setPlotKey(null);
       setActualX(null);
       setActualY(null);
@@ -182,7 +182,8 @@ export default function AnalyzePanel() {
 
       setRecommended(data.recommended_test || "");
       setStats(data.stats || {});
-      setPlotBase64(data.plot_base64 || null);
+      // plot is served as a cacheable resource; base64 only for responses requested with inline_plot
+      setPlotSrc(data.plot_url ? `${API_BASE}${data.plot_url}` : (data.plot_base64 ? `data:image/png;base64,${data.plot_base64}` : null));
       setActualX(data.actual_x || xCol || null);
       setActualY(data.actual_y || yCol || null);
       setPlotKey(Date.now());
@@ -311,11 +312,11 @@ export default function AnalyzePanel() {
             <h5>Wykres</h5>
             <div className="d-flex gap-3 align-items-start">
               <div className="left-thumb">
-                <img id="leftPlot" alt="miniatura" src={plotBase64 ? `data:image/png;base64,${plotBase64}` : undefined} />
+                <img id="leftPlot" alt="miniatura" src={plotSrc || undefined} />
               </div>
               <div className="flex-fill">
-                {plotBase64 ? (
-                  <img key={plotKey || "initial"} id="rightPlot" alt="wykres" className="right-plot" src={`data:image/png;base64,${plotBase64}`} />
+                {plotSrc ? (
+                  <img key={plotKey || "initial"} id="rightPlot" alt="wykres" className="right-plot" src={plotSrc} />
                 ) : (
                   <div className="empty-plot">Brak wykresu</div>
                 )}
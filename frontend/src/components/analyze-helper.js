@@ -44,9 +44,9 @@ async function analyzeAndShow(file_id, x, y) {
       statsContainer.innerHTML = renderStats(stats);
     }
 
-    // --- Plot (base64 zawsze powinien być) ---
-    if (data.plot_base64) {
-      const src = 'data:image/png;base64,' + data.plot_base64;
+    // --- Plot (odnośnik /plots/{id}; base64 tylko przy inline_plot) ---
+    if (data.plot_url || data.plot_base64) {
+      const src = data.plot_url || ('data:image/png;base64,' + data.plot_base64);
       if (rightImg) rightImg.src = src;
       if (leftImg) leftImg.src = src; // jeśli chcesz też miniaturę z lewej
     } else {
@@ -0,0 +1,833 @@
+# Parity tests: Python (NumPy/SciPy) engine vs R engine (stat_tests.R).
+# uruchom: python -m pytest -q test_engines.py
+# Testy porównujące z R są pomijane, jeśli rpy2/R nie są dostępne.
+import math
+import os
+import re
+import numpy as np
+import pandas as pd
+import pytest
+
+from backend import py_engine
+from backend.services import dataset_service
+
+
+def _datasets():
+    rs = np.random.RandomState(1)
+    n = 200
+    a = rs.normal(50, 10, n)
+    grp2 = np.where(rs.rand(n) < 0.5, "A", "B")
+    grp3 = rs.choice(["a", "b", "c"], n)
+    return {
+        "pearson_correlation": pd.DataFrame({"x": a, "y": a * 0.5 + rs.normal(0, 5, n)}),
+        "spearman_correlation": pd.DataFrame({"x": rs.exponential(1, n), "y": rs.exponential(1, n)}),
+        "spearman_small_exact": pd.DataFrame({"x": rs.exponential(1, 8), "y": rs.exponential(1, 8)}),
+        "spearman_ties": pd.DataFrame({"x": rs.randint(0, 5, n), "y": rs.randint(0, 5, n)}),
+        "chi_square_2x2": pd.DataFrame({"x": grp2, "y": rs.choice(["tak", "nie"], n)}),
+        "chi_square": pd.DataFrame({"x": grp3, "y": rs.choice(["p", "q", "r", "s"], n)}),
+        "t_student": pd.DataFrame({"g": grp2, "v": rs.normal(10, 2, n) + (grp2 == "B")}),
+        "welch_t": pd.DataFrame({"g": grp2, "v": np.where(grp2 == "A", rs.normal(10, 1, n), rs.normal(11, 6, n))}),
+        "wilcoxon": pd.DataFrame({"g": grp2, "v": rs.exponential(1, n)}),
+        "wilcoxon_exact": pd.DataFrame({"g": ["A"] * 12 + ["B"] * 15, "v": rs.exponential(1, 27)}),
+        "anova": pd.DataFrame({"g": grp3, "v": rs.normal(20, 3, n)}),
+        "kruskal_wallis": pd.DataFrame({"g": grp3, "v": rs.exponential(2, n)}),
+        "decimal_comma": pd.DataFrame({"x": [f"{v:.2f}".replace(".", ",") for v in a], "g": grp2}),
+    }
+
+
+EXPECTED = {
+    "pearson_correlation": "pearson_correlation",
+    "spearman_correlation": "spearman_correlation",
+    "spearman_small_exact": "spearman_correlation",
+    "spearman_ties": "spearman_correlation",
+    "chi_square_2x2": "chi_square",
+    "chi_square": "chi_square",
+    "t_student": "t_student",
+    "welch_t": "welch_t",
+    "wilcoxon": "wilcoxon",
+    "wilcoxon_exact": "wilcoxon",
+    "anova": "anova",
+    "kruskal_wallis": "kruskal_wallis",
+    "decimal_comma": "t_student",
+}
+
+
+def _snapshot(tmp_path, name, df, sep=";"):
+    csv_path = tmp_path / f"{name}.csv"
+    df.to_csv(csv_path, index=False, sep=sep)
+    snap = str(tmp_path / f"{name}.snapshot")
+    manifest = dataset_service.build_snapshot(str(csv_path), snap, encoding="utf-8", delimiter=sep)
+    return snap, manifest
+
+
+def _run_python(snap, manifest):
+    names = dataset_service.snapshot_headers(manifest)
+    x = dataset_service.load_column(snap, manifest, names[0])
+    y = dataset_service.load_column(snap, manifest, names[1])
+    return py_engine.run_analysis(x, y)
+
+
+def _close(a, b, rel=1e-6, abs_=1e-10):
+    if a is None or b is None:
+        return a is None and b is None
+    if isinstance(a, list) or isinstance(b, list):
+        a = a if isinstance(a, list) else [a]
+        b = b if isinstance(b, list) else [b]
+        return len(a) == len(b) and all(_close(u, v, rel, abs_) for u, v in zip(a, b))
+    return math.isclose(float(a), float(b), rel_tol=rel, abs_tol=abs_)
+
+
+@pytest.mark.parametrize("name", sorted(EXPECTED))
+def test_python_engine_decision_tree(tmp_path, name):
+    snap, manifest = _snapshot(tmp_path, name, _datasets()[name])
+    res = _run_python(snap, manifest)
+    assert res["recommended_test"] == EXPECTED[name]
+    assert {"recommended_test", "stats", "plot_path"} <= set(res) <= {"recommended_test", "stats", "plot_path", "assumptions"}
+    assert res["stats"]["p_value"] is not None and 0.0 <= res["stats"]["p_value"] <= 1.0
+
+
+def test_coercion_matches_r_heuristics():
+    vals = np.array(["1 234,5", "1.234,5", "2,5", "1.234.567", "-3", "abc", None, "7"], dtype=object)
+    out = py_engine.coerce_numeric_if_possible(vals)
+    assert isinstance(out, np.ndarray) and out.dtype.kind == "f"
+    np.testing.assert_allclose(out[:5], [1234.5, 1234.5, 2.5, 1234567.0, -3.0])
+    assert math.isnan(out[5]) and math.isnan(out[6]) and out[7] == 7.0
+    # below the 70% threshold the original vector is returned unchanged
+    mostly_text = np.array(["a", "b", "c", "1", "2", "3"], dtype=object)
+    assert py_engine.coerce_numeric_if_possible(mostly_text) is mostly_text
+
+
+def _coerce_one(s):
+    # element-wise reference of coerce_one() in stat_tests.R
+    if s is None:
+        return math.nan
+    s = re.sub(r"\s+", "", s.replace("\u00a0", ""))
+    if "." in s and "," in s:
+        s = s.replace(".", "").replace(",", ".")
+    elif "," in s:
+        s = s.replace(",", ".")
+    elif s.count(".") > 1:
+        s = s.replace(".", "")
+    s = re.sub(r"[^0-9.\-]", "", s)
+    try:
+        return float(s)
+    except ValueError:
+        return math.nan
+
+
+def test_vectorized_coercion_matches_elementwise():
+    vals = ["1\u00a0234,5", " 12 ", "1.2.3", "1,2,3", "-", ".", "-.", "", "1-2", "--1", "x7y", "3.",
+            ".5", "-,5", "1.234,56 zł", "10%", "1e5", None, "0,0", "-0"]
+    out = py_engine.coerce_strings(np.array(vals, dtype=object))
+    ref = np.array([_coerce_one(v) for v in vals])
+    np.testing.assert_array_equal(np.isnan(out), np.isnan(ref))
+    np.testing.assert_allclose(out[~np.isnan(out)], ref[~np.isnan(ref)])
+
+
+@pytest.mark.parametrize("name", ["decimal_comma", "chi_square"])
+def test_ingest_coercion_matches_engine(tmp_path, name):
+    snap, manifest = _snapshot(tmp_path, name, _datasets()[name])
+    for col in dataset_service.snapshot_headers(manifest):
+        cached = dataset_service.load_analysis_column(snap, manifest, col)
+        fresh = py_engine.coerce_numeric_if_possible(dataset_service.load_column(snap, manifest, col))
+        assert py_engine._is_numeric(cached) == py_engine._is_numeric(fresh)
+        if py_engine._is_numeric(cached):
+            np.testing.assert_array_equal(cached, fresh)
+
+
+@pytest.mark.parametrize("name", ["decimal_comma", "chi_square", "anova"])
+def test_analysis_vector_matches_column(tmp_path, name):
+    snap, manifest = _snapshot(tmp_path, name, _datasets()[name])
+    for col in dataset_service.snapshot_headers(manifest):
+        expected = dataset_service.load_analysis_column(snap, manifest, col)
+        values, levels = dataset_service.load_analysis_vector(snap, manifest, col)
+        if levels is None:
+            assert values.dtype == np.float64
+            np.testing.assert_array_equal(values, expected)
+        else:
+            assert values.dtype == np.int32
+            rebuilt = [levels[c] if c >= 0 else None for c in values]
+            assert rebuilt == list(expected)
+
+
+def test_append_matches_full_rebuild(tmp_path):
+    from backend.services import profile_service
+    rs = np.random.RandomState(3)
+    base = pd.DataFrame({"x": rs.normal(0, 1, 120), "g": rs.choice(["a", "b"], 120),
+                         "d": [f"{v:.2f}".replace(".", ",") for v in rs.normal(5, 1, 120)], "e": [None] * 120})
+    wave = pd.DataFrame({"x": [None] * 30, "g": rs.choice(["b", "c"], 30),
+                         "d": ["NA"] * 30, "e": rs.choice(["tak", "nie"], 30)})
+    snap, manifest = _snapshot(tmp_path, "base", base)
+    profile_service.build_profile(snap, manifest)
+    wave_path = str(tmp_path / "wave.csv")
+    wave.to_csv(wave_path, index=False, sep=";")
+
+    appended = dataset_service.append_snapshot(wave_path, snap, manifest, "utf-8", ";", chunk_rows=7)
+    profile, sketches, changed = profile_service.append_profile(snap, appended, manifest["rows"], chunk_rows=7)
+    dataset_service.write_manifest(snap, appended)
+    assert appended["rows"] == 150
+    assert changed == ["g", "d", "e"]  # x only got missing values
+
+    full_path = str(tmp_path / "full.csv")
+    with open(full_path, "w") as f:
+        f.write(base.to_csv(index=False, sep=";") + wave.to_csv(index=False, sep=";", header=False))
+    ref_snap = str(tmp_path / "full.snapshot")
+    ref = dataset_service.build_snapshot(full_path, ref_snap, encoding="utf-8", delimiter=";")
+    ref_profile = profile_service.build_profile(ref_snap, ref)
+    for col in dataset_service.snapshot_headers(ref):
+        a = dataset_service.load_analysis_column(snap, appended, col)
+        b = dataset_service.load_analysis_column(ref_snap, ref, col)
+        assert list(a) == list(b) if a.dtype == object else np.array_equal(a, b, equal_nan=True)
+    for a, b in zip(profile["columns"], ref_profile["columns"]):
+        for key in ("count", "missing", "distinct", "is_numeric", "top", "min", "max"):
+            assert a[key] == b[key], (a["name"], key)
+        assert _close(a["mean"], b["mean"]) and _close(a["variance"], b["variance"])
+
+
+def test_append_failure_leaves_dataset_untouched(tmp_path, monkeypatch):
+    import json
+    from backend import main
+    from backend.upload_store import UploadStore
+    from backend.services import profile_service
+    monkeypatch.setattr(main, "UPLOAD_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "upload_store", UploadStore(str(tmp_path), sweep_interval=0))
+    csv_path = str(tmp_path / "f.csv")
+    pd.DataFrame({"x": np.arange(20.0), "g": ["a", "b"] * 10}).to_csv(csv_path, index=False, sep=";")
+    snap = dataset_service.snapshot_dir_for(str(tmp_path), "f")
+    profile_service.build_profile(snap, dataset_service.build_snapshot(csv_path, snap, encoding="utf-8", delimiter=";"))
+    meta = {"encoding": "utf-8", "delimiter": ";", "content_hash": "h", "rows": 20}
+    main._write_meta("f", meta)
+    rows_path = str(tmp_path / "rows.csv")
+    pd.DataFrame({"x": [1.5, 2.5], "g": ["c", "a"]}).to_csv(rows_path, index=False, sep=";")
+    with open(csv_path, "rb") as f:
+        before = f.read()
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+
+    # the CSV was appended first: it is cut back when the manifest cannot be published
+    with monkeypatch.context() as m:
+        m.setattr(dataset_service, "write_manifest", fail)
+        with pytest.raises(OSError):
+            main._append_rows("f", dict(meta), rows_path, "u", "utf-8", ";")
+    with open(csv_path, "rb") as f:
+        assert f.read() == before
+    assert dataset_service.load_manifest(snap)["rows"] == 20
+    assert main._read_meta("f") == meta
+
+    # after publishing, a profile that cannot be saved is dropped instead of going stale
+    with monkeypatch.context() as m:
+        m.setattr(profile_service, "save_profile", fail)
+        assert main._append_rows("f", dict(meta), rows_path, "u", "utf-8", ";")[0] == 2
+    assert profile_service.load_profile(snap) is None
+    assert dataset_service.load_manifest(snap)["rows"] == 22
+    with open(csv_path, "rb") as f:
+        assert f.read() == before + b"1.5;c\n2.5;a\n"
+    with open(main.upload_store.meta_path("f"), "r", encoding="utf-8") as f:
+        assert json.load(f)["rows"] == 22
+
+
+def test_association_matrix_matches_pairwise(tmp_path):
+    from scipy import stats as sps
+    from backend.services import matrix_service
+    rs = np.random.RandomState(4)
+    n = 400
+    a = rs.normal(0, 1, n)
+    b = a + rs.normal(0, 1, n)
+    b[rs.rand(n) < 0.1] = np.nan
+    c = rs.exponential(1, n).round(1)
+    c[rs.rand(n) < 0.2] = np.nan
+    g = rs.choice(["x", "y", "z"], n).astype(object)
+    g[rs.rand(n) < 0.1] = "NA"
+    h = np.where(a > 0, "p", "q")
+    df = pd.DataFrame({"a": a, "g": g, "b": b, "h": h, "c": c})
+    snap, manifest = _snapshot(tmp_path, "matrix", df)
+    res = matrix_service.compute(snap, manifest, ["a", "g", "b", "h", "c"], method="spearman")
+    assert res["columns"] == ["a", "g", "b", "h", "c"]
+    assert res["types"] == ["numeric", "categorical", "numeric", "categorical", "numeric"]
+    cols = {name: dataset_service.load_analysis_column(snap, manifest, name) for name in res["columns"]}
+
+    num = res["pearson"]["columns"]
+    for i, x in enumerate(num):
+        for j, y in enumerate(num[i + 1:], i + 1):
+            ref = py_engine._pearson(cols[x], cols[y])
+            assert _close(res["pearson"]["r"][i][j], ref["estimate"]) and _close(res["pearson"]["p"][i][j], ref["p_value"])
+    # Spearman ranks each column over its own values (psych::corr.test), then correlates the complete pairs
+    ranks_a, ranks_b = sps.rankdata(cols["a"]), sps.rankdata(cols["b"], nan_policy="omit")
+    assert _close(res["spearman"]["r"][0][1], py_engine._pearson(ranks_a, ranks_b)["estimate"])
+
+    tab = pd.crosstab(pd.Series(cols["g"]), pd.Series(cols["h"])).to_numpy()
+    chi2, p, _, _ = sps.chi2_contingency(tab, correction=False)
+    assert _close(res["cramers_v"]["v"][0][1], math.sqrt(chi2 / (tab.sum() * (min(tab.shape) - 1))))
+    assert _close(res["cramers_v"]["p"][0][1], p)
+
+    for i, cat in enumerate(res["eta"]["rows"]):
+        for j, x in enumerate(num):
+            _, _, parts, _ = py_engine._split_groups(cols[cat], cols[x])
+            groups = [part[~np.isnan(part)] for part in parts]
+            values = np.concatenate(groups)
+            ss_between = sum(len(q) * (q.mean() - values.mean()) ** 2 for q in groups)
+            assert _close(res["eta"]["eta"][i][j], math.sqrt(ss_between / ((values - values.mean()) ** 2).sum()))
+            assert _close(res["eta"]["p"][i][j], sps.f_oneway(*groups).pvalue, abs_=1e-12)
+    assoc = res["association"]
+    assert assoc["value"][1][2] == res["eta"]["eta"][0][1] and assoc["value"][1][3] == res["cramers_v"]["v"][0][1]
+    assert assoc["n"][2][4] == int((~np.isnan(b) & ~np.isnan(c)).sum())
+
+
+def test_column_index_resolution():
+    headers = ["Płeć", "wiek", "Wiek", "Dochód netto"]
+    manifest = {"columns": [{"name": h} for h in headers]}
+    assert dataset_service.resolve_column(manifest, "Płeć") == "Płeć"
+    assert dataset_service.resolve_column(manifest, "Pec") == "Płeć"  # ASCII-folded header
+    assert dataset_service.resolve_column(manifest, "Wiek") == "Wiek"  # exact beats case-insensitive
+    assert dataset_service.resolve_column(manifest, "WIEK") == "wiek"  # first case-insensitive match
+    assert dataset_service.resolve_column(manifest, "dochód NETTO") == "Dochód netto"
+    assert dataset_service.resolve_column(manifest, "brak") is None
+    assert dataset_service.column_index(manifest)["exact"]["Dochód netto"] == 3
+
+
+@pytest.mark.parametrize("encoding,delimiter", [
+    ("cp1250", ";"), ("iso-8859-2", ";"), ("utf-8", ","), ("utf-8-sig", ";"), ("utf-16", "\t"), ("cp1250", "|"),
+])
+def test_encoding_detection_fast_path(encoding, delimiter):
+    from backend.services import encoding_service
+    rows = [["Płeć", "Miejscowość", "Dochód"]] + [["K", "Świętochłowice", "1234,5"], ["M", "Łódź", "99"], ["K", "Źródła", "12,75"]] * 20
+    text = "\n".join(delimiter.join(r) for r in rows) + "\n"
+    data = text.encode(encoding)
+    det = encoding_service.detect(data, truncated=False)
+    assert data.decode(det["encoding"]).lstrip("\ufeff") == text
+    assert det["delimiter"] == delimiter
+    assert det["encoding_source"] != "chardet"
+
+
+def test_csv_conversion_for_r_streams(tmp_path, monkeypatch):
+    from backend import r_interface
+    # the sample looks like UTF-8, a later row is cp1250: the conversion restarts with the next encoding
+    monkeypatch.setattr(r_interface, "SNIFF_BYTES", 8)
+    src = tmp_path / "late.csv"
+    src.write_bytes("a;b\n1;2\n3;\"ż;x\"\n".encode("cp1250"))
+    out, used = r_interface._convert_to_comma_csv(str(src), None, ";")
+    with open(out, "rb") as f:
+        converted = f.read()
+    os.remove(out)
+    assert used == "cp1250"
+    assert converted == "\ufeffa,b\r\n1,2\r\n3,ż;x\r\n".encode("utf-8")
+
+
+@pytest.mark.parametrize("method", ["subsample", "dagostino"])
+def test_large_sample_normality(monkeypatch, method):
+    monkeypatch.setattr(py_engine, "NORMALITY_LARGE_METHOD", method)
+    rs = np.random.RandomState(3)
+    x = rs.normal(50, 10, 20000)
+    y = 0.5 * x + rs.normal(0, 5, 20000)
+    res = py_engine.run_analysis(x, y)
+    # shapiro.test() stops at 5000 values; large normal data used to fall through to Spearman
+    assert res["recommended_test"] == "pearson_correlation"
+    expected = "shapiro_subsample" if method == "subsample" else "dagostino"
+    assert [c["method"] for c in res["assumptions"]["normality"]] == [expected, expected]
+    assert py_engine.run_analysis(x, y) == res  # seeded, reproducible
+
+    groups = np.array(["a", "b", None], dtype=object)[rs.randint(0, 3, 18000)]
+    res = py_engine.run_analysis(groups, x)
+    assert res["recommended_test"] == "kruskal_wallis"  # an NA group never passes
+    res = py_engine.run_analysis(np.where(groups == None, "a", groups), rs.exponential(size=18000))  # noqa: E711
+    assert res["recommended_test"] == "wilcoxon"
+    res = py_engine.run_analysis(np.where(groups == None, "a", groups), x)  # noqa: E711
+    assert res["recommended_test"] in ("t_student", "welch_t")
+    assert [c["group"] for c in res["assumptions"]["normality"]] == ["a", "b"]
+
+
+@pytest.fixture(scope="module")
+def large_snapshot(tmp_path_factory):
+    rs = np.random.RandomState(5)
+    n = 40000
+    x = rs.normal(10, 2, n)
+    x[rs.rand(n) < 0.01] = np.nan
+    df = pd.DataFrame({
+        "x": x,
+        "y": 0.3 * x + rs.normal(0, 2, n),
+        "e": np.round(rs.exponential(3, n), 1),  # heavy ties
+        "g2": rs.choice(["alfa", "beta"], n),
+        "g3": rs.choice(["alfa", "beta", "gamma", "delta"], n),
+        "t": rs.choice(["tak", "nie", "brak"], n),
+    })
+    return _snapshot(tmp_path_factory.mktemp("large"), "large", df)
+
+
+@pytest.mark.parametrize("x,y", [("x", "y"), ("x", "e"), ("g2", "x"), ("g2", "e"), ("g3", "x"), ("g3", "e"), ("t", "g3")])
+def test_streaming_matches_in_memory(monkeypatch, large_snapshot, x, y):
+    from backend.services import streaming_service
+    monkeypatch.setattr(streaming_service, "STREAMING_RANK_BUCKET_ROWS", 7000)
+    monkeypatch.setattr(streaming_service, "STREAMING_IN_MEMORY_ROWS", 1000)
+    snap, manifest = large_snapshot
+    expected = py_engine.run_analysis(dataset_service.load_analysis_column(snap, manifest, x),
+                                      dataset_service.load_analysis_column(snap, manifest, y))
+    res = streaming_service.run_analysis(snap, manifest, x, y, chunk_rows=3000)
+    assert res["recommended_test"] == expected["recommended_test"]
+    assert res["stats"]["method"] == expected["stats"]["method"]
+    for key in ("statistic", "p_value", "estimate"):
+        if key in expected["stats"]:
+            assert _close(res["stats"][key], expected["stats"][key], rel=1e-8), key
+    if "assumptions" in expected:
+        got = [c["p_value"] for c in res["assumptions"]["normality"]]
+        assert all(_close(a, b["p_value"], rel=1e-8) for a, b in zip(got, expected["assumptions"]["normality"]))
+
+
+def _effect_size(test, x, y):
+    """Reference value of the bootstrapped estimate, straight from SciPy."""
+    from scipy import stats as sps
+    if test == "pearson_correlation":
+        return sps.pearsonr(x, y)[0]
+    if test == "spearman_correlation":
+        return sps.spearmanr(x, y)[0]
+    if test == "chi_square":
+        tab = pd.crosstab(x, y).to_numpy()
+        return math.sqrt(sps.chi2_contingency(tab, correction=False)[0] / (tab.sum() * (min(tab.shape) - 1)))
+    groups = [y[x == lv] for lv in sorted(set(x))]
+    if test in ("t_student", "welch_t"):
+        return groups[0].mean() - groups[1].mean()
+    if test == "wilcoxon":
+        return 2 * sps.mannwhitneyu(*groups).statistic / (len(groups[0]) * len(groups[1])) - 1
+    if test == "anova":
+        allv = np.concatenate(groups)
+        return sum(len(g) * (g.mean() - allv.mean()) ** 2 for g in groups) / ((allv - allv.mean()) ** 2).sum()
+    return sps.kruskal(*groups).statistic / (len(x) - 1)
+
+
+@pytest.mark.parametrize("name", sorted(EXPECTED))
+def test_resampling_estimates(name):
+    from backend.services import resampling_service
+    df = _datasets()[name]
+    x, y = (py_engine.coerce_numeric_if_possible(df[c].to_numpy()) for c in df.columns)
+    test = EXPECTED[name]
+    problem = resampling_service.prepare(x, y, test)
+    if test in ("chi_square", "pearson_correlation", "spearman_correlation"):
+        cat, num = x, y
+    else:
+        cat, num = (x, y) if x.dtype == object else (y, x)
+    assert _close(problem.estimates(problem.sample)[0], _effect_size(test, cat, num), rel=1e-9)
+    if test in ("spearman_correlation", "wilcoxon", "kruskal_wallis"):
+        # ranks of a resample come from counting draws, check one against re-ranking it
+        draws = problem.bootstrap_draws(np.random.default_rng(3), 2)
+        if test == "spearman_correlation":
+            ref = _effect_size(test, x[draws[1]], y[draws[1]])
+        else:
+            levels = sorted(set(cat))
+            labels = np.repeat(levels, [np.count_nonzero(cat == lv) for lv in levels])
+            values = np.concatenate([num[cat == lv] for lv in levels])
+            ref = _effect_size(test, labels[draws[1]], values[draws[1]])
+        assert _close(problem.estimates(draws)[1], ref, rel=1e-9)
+
+
+def test_resampling_reproducible_across_workers(large_snapshot):
+    from concurrent.futures import ThreadPoolExecutor
+    from backend.services import resampling_service
+    snap, manifest = large_snapshot
+    assert resampling_service.options(None) is None
+    with pytest.raises(ValueError):
+        resampling_service.options({"resamples": 0})
+    opts = resampling_service.options({"resamples": 300, "seed": 7})
+    for x, y in [("g3", "e"), ("x", "y"), ("t", "g3")]:
+        test = py_engine.run_analysis(dataset_service.load_analysis_column(snap, manifest, x),
+                                      dataset_service.load_analysis_column(snap, manifest, y))["recommended_test"]
+        one = resampling_service.resample(snap, "large", x, y, test, opts)
+        with ThreadPoolExecutor(3) as pool:
+            three = resampling_service.resample(snap, "large", x, y, test, opts, executor=pool, workers=3)
+        assert one["permutation"]["resamples"] == three["permutation"]["resamples"] == 300
+        assert one["permutation"]["p_value"] == three["permutation"]["p_value"]
+        assert one["bootstrap"]["ci"] == three["bootstrap"]["ci"]
+        lo, hi = one["bootstrap"]["ci"]
+        assert lo <= one["bootstrap"]["value"] <= hi
+
+
+def test_resampling_stops_early(monkeypatch, large_snapshot):
+    from backend.services import resampling_service
+    monkeypatch.setattr(resampling_service, "RESAMPLING_MIN_RESAMPLES", 200)
+    snap, _ = large_snapshot
+    res = resampling_service.resample(snap, "large", "g2", "x", "t_student", resampling_service.options({"resamples": 5000}))
+    assert res["permutation"]["stopped_early"]
+    assert res["permutation"]["resamples"] < 5000
+    assert res["permutation"]["p_value"] > 0.05
+
+
+def test_excel_report_reloads_with_image():
+    import io
+    import openpyxl
+    from PIL import Image
+    from backend.services import report_service
+    buf = io.BytesIO()
+    Image.new("RGB", (60, 40), (0, 120, 200)).save(buf, format="PNG")
+    png = buf.getvalue()
+    result = {"recommended_test": "t_student", "stats": {"statistic": 2.1, "p_value": 0.04}, "actual_x": "g", "actual_y": "v"}
+    data = report_service.generate_excel_report(result, png).getvalue()
+    wb = openpyxl.load_workbook(io.BytesIO(data))
+    assert wb.sheetnames == ["Summary", "Stats", "Plot"]
+    assert list(wb["Summary"].values)[1] == ("Recommended test", "t_student")
+    images = wb["Plot"]._images
+    assert len(images) == 1 and images[0]._data() == png
+    assert (images[0].width, images[0].height) == (60, 40)
+
+
+def test_screening_report_streams_pairs():
+    import io
+    import zipfile
+    import openpyxl
+    from PIL import Image
+    from backend.services import report_service
+    buf = io.BytesIO()
+    Image.new("RGB", (40, 30), (200, 0, 0)).save(buf, format="PNG")
+    png = buf.getvalue()
+    report = report_service.ScreeningReport("f")
+    chunks = []
+    for index in (2, 0, 1):
+        item = {"index": index, "x": f"x{index}", "y": "y", "recommended_test": "chi_square", "stats": {"statistic": 1.5, "p_value": 0.2}}
+        if index == 1:
+            item = {"index": 1, "x": "x1", "y": "y", "error": "brak danych"}
+        chunks.append(report.add(item, png if index == 0 else None))
+        # every pair leaves as soon as it is written
+        assert chunks[-1]
+    chunks.append(report.close())
+    data = b"".join(chunks)
+    # the stored PNG is embedded byte for byte
+    archive = zipfile.ZipFile(io.BytesIO(data))
+    assert [archive.read(n) for n in archive.namelist() if n.startswith("xl/media/")] == [png]
+    wb = openpyxl.load_workbook(io.BytesIO(data))
+    assert wb.sheetnames == ["Summary", "1 x0 ~ y", "2 x1 ~ y", "3 x2 ~ y"]
+    rows = list(wb["Summary"].values)
+    assert [r[0] for r in rows[1:4]] == [1, 2, 3]
+    assert rows[2][-1] == "brak danych"
+    assert len(wb["1 x0 ~ y"]._images) == 1
+
+
+def test_result_cache_disk_sweep(tmp_path):
+    import asyncio
+    import time
+    from backend.result_cache import ResultCache
+    cache = ResultCache(max_bytes=1 << 20, ttl=3600, disk_dir=str(tmp_path), disk_max_bytes=0, sweep_interval=0)
+    for key in ("a", "b", "c"):
+        cache.put(key, {"v": key}, b"p" * 100)
+    entry = os.path.getsize(tmp_path / "b.json") + 100
+    now = time.time()
+    for key, age in (("a", 7200), ("b", 300), ("c", 200)):
+        os.utime(tmp_path / f"{key}.json", (now - age, now - age))
+    (tmp_path / "x.json.tmp").write_text("{")
+    (tmp_path / "orphan.png").write_bytes(b"p")
+    for name in ("x.json.tmp", "orphan.png"):
+        os.utime(tmp_path / name, (now - 7200, now - 7200))
+
+    # a disk hit (served from a worker thread) marks the entry used, so "b" goes first by quota
+    fresh = ResultCache(max_bytes=1 << 20, ttl=3600, disk_dir=str(tmp_path), disk_max_bytes=entry, sweep_interval=0)
+    assert asyncio.run(fresh.get_async("b")) == ({"v": "b"}, b"p" * 100)
+    os.utime(tmp_path / "c.json", (now - 250, now - 250))
+    fresh.sweep()
+    assert sorted(os.listdir(tmp_path)) == ["b.json", "b.png"]
+    assert fresh.stats()["disk_evictions"] == 2 and fresh.stats()["disk_bytes"] == entry
+    assert fresh.get("c") is None and fresh.stats()["misses"] == 1
+
+
+def _stored_dataset(store, file_id, size, last_used):
+    import json
+    with open(store.csv_path(file_id), "wb") as f:
+        f.write(b"x" * size)
+    with open(store.meta_path(file_id), "w", encoding="utf-8") as f:
+        json.dump({"content_hash": f"h-{file_id}"}, f)
+    store.register(file_id, f"h-{file_id}")
+    os.utime(store.meta_path(file_id), (last_used, last_used))
+
+
+def test_upload_store_sweep(tmp_path):
+    import time
+    from backend.upload_store import UploadStore
+    store = UploadStore(str(tmp_path), max_bytes=300, ttl=3600, sweep_interval=0)
+    now = time.time()
+    _stored_dataset(store, "expired", 10, now - 7200)
+    _stored_dataset(store, "busy", 100, now - 7200)
+    _stored_dataset(store, "old", 100, now - 300)
+    _stored_dataset(store, "mid", 100, now - 200)
+    _stored_dataset(store, "new", 100, now - 100)
+    (tmp_path / "stale.part").write_bytes(b"x")
+    (tmp_path / "fresh.part").write_bytes(b"x")
+    # a long snapshot build of a leased dataset
+    (tmp_path / "busy.snapshot.tmp").mkdir()
+    for name in ("stale.part", "busy.snapshot.tmp"):
+        os.utime(tmp_path / name, (now - 7200, now - 7200))
+
+    remove = store.remove
+    removed = []
+
+    def unlocked_remove(file_id):
+        # the disk work runs without the lock, and the dataset is no longer handed out meanwhile
+        assert not store._lock.locked() and not store.available(file_id)
+        removed.append(file_id)
+        remove(file_id)
+
+    store.remove = unlocked_remove
+    lease = store.lease("busy")
+    store.sweep()
+    # expired goes by TTL, then the least recently used until the quota fits; the leased one stays
+    assert removed == ["expired", "old"]
+    assert sorted(f for _, _, f in store.datasets()) == ["busy", "mid", "new"]
+    assert store.find("h-expired") is None and store.find("h-old") is None
+    assert not (tmp_path / "stale.part").exists() and (tmp_path / "fresh.part").exists()
+    assert (tmp_path / "busy.snapshot.tmp").exists()
+    assert store.stats()["in_use"] == 1
+
+    # a dedup hit marks the dataset used, so the quota pass takes the other one
+    assert store.find("h-mid") == "mid"
+    assert store.dedup_hits == 1
+    lease.release()
+    lease.release()
+    assert not store.in_use("busy")
+    store.max_bytes = 250
+    store.sweep()
+    assert sorted(f for _, _, f in store.datasets()) == ["mid", "new"]
+    assert not (tmp_path / "busy.snapshot.tmp").exists()
+
+    # the newest dataset survives the quota on its own; oversized uploads are refused up front
+    store.max_bytes = 50
+    store.sweep()
+    assert [f for _, _, f in store.datasets()] == ["mid"]
+    assert store.fits(50) and not store.fits(51)
+
+
+def test_metrics_exposition_and_server_timing():
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    from backend.metrics import Metrics, ServerTimingMiddleware
+    registry = Metrics(prefix="t_")
+    app = FastAPI()
+    app.add_middleware(ServerTimingMiddleware, registry=registry)
+
+    @app.get("/work")
+    async def work():
+        for stage in ("read", "read", "tests"):
+            with registry.timed(stage):
+                pass
+        # timings measured in a worker process come back with the result
+        registry.record_timings({"r_plot": 0.002})
+        registry.inc("retries", 2, "Retries", kind="encoding")
+        return {}
+
+    registry.add_collector(lambda: [("queue_depth", "gauge", "Queued", 3)])
+    response = TestClient(app).get("/work")
+    header = response.headers["server-timing"]
+    assert re.fullmatch(r'read;dur=[\d.]+;desc="x2", tests;dur=[\d.]+, r_plot;dur=2\.0, total;dur=[\d.]+', header)
+
+    text = registry.exposition()
+    assert 't_stage_seconds_bucket{stage="r_plot",le="0.001"} 0' in text
+    assert 't_stage_seconds_bucket{stage="r_plot",le="0.005"} 1' in text
+    assert 't_stage_seconds_count{stage="read"} 2' in text
+    assert 't_request_seconds_count{handler="work",method="GET",status="200"} 1' in text
+    assert 't_retries_total{kind="encoding"} 2' in text
+    assert "# TYPE t_queue_depth gauge\nt_queue_depth 3\n" in text
+    # every sample line is "name{labels} value"
+    for line in text.splitlines():
+        if not line.startswith("#"):
+            assert re.fullmatch(r'[a-z_]+(\{[^}]*\})? [-+\w.e]+', line), line
+
+
+def test_r_pool_survives_crash_cancel_and_failed_spawns():
+    import asyncio
+    import threading
+    from backend.r_pool import RWorkerPool, RWorkerError
+
+    class StubProcess:
+        def __init__(self):
+            self.pid = 0
+            self.alive = True
+            self.killed = threading.Event()
+
+        def is_alive(self):
+            return self.alive
+
+        def terminate(self):
+            self.alive = False
+            self.killed.set()
+
+    class StubWorker:
+        def __init__(self):
+            self.process = StubProcess()
+            self.jobs = 0
+            self.rss_mb = 0.0
+
+        def call(self, fn_name, args, kwargs):
+            if not self.process.alive:
+                raise EOFError("worker process is not running")
+            if fn_name == "crash":
+                self.process.alive = False
+                raise EOFError("R segfault")
+            if fn_name == "hang":
+                self.process.killed.wait(10)
+                raise EOFError("terminated")
+            self.jobs += 1
+            return "ok", fn_name, ""
+
+        def stop(self):
+            self.process.alive = False
+
+    class StubPool(RWorkerPool):
+        failing_spawns = 0
+
+        def _spawn(self):
+            if self.failing_spawns:
+                self.failing_spawns -= 1
+                raise OSError("cannot fork")
+            return StubWorker()
+
+    async def scenario():
+        pool = StubPool(size=1, max_jobs=100, max_rss_mb=1024)
+        await pool.start()
+        # a crash whose replacement cannot be spawned: the caller sees RWorkerError, the slot stays
+        pool.failing_spawns = 1
+        with pytest.raises(RWorkerError):
+            await pool.run("crash")
+        assert pool.stats()["idle"] == 1
+        # the dead worker fails fast and the spawn is retried
+        with pytest.raises(RWorkerError):
+            await pool.run("analyze")
+        assert await pool.run("analyze") == "analyze"
+        assert pool.recycled == 1
+
+        # a cancelled job kills its worker; a failed respawn still gives the slot back
+        pool.failing_spawns = 1
+        task = asyncio.ensure_future(pool.run("hang"))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        for _ in range(50):
+            if pool.stats()["idle"] == 1:
+                break
+            await asyncio.sleep(0.02)
+        assert pool.stats()["idle"] == 1
+        with pytest.raises(RWorkerError):
+            await pool.run("analyze")
+        assert await pool.run("analyze") == "analyze"
+        assert pool.recycled == 2 and pool.stats()["idle"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_job_queue_capacity_and_retention():
+    import asyncio
+    from backend.job_queue import JobManager, QueueFull, CANCELLED
+
+    async def scenario():
+        held = JobManager(runners=0, queue_size=1, ttl=0, max_finished=10)
+        first = await held.submit("analyze", None)
+        with pytest.raises(QueueFull):
+            await held.submit("analyze", None)
+        # a cancelled job gives its place back before any runner dequeues it
+        assert held.cancel(first.id).status == CANCELLED
+        await held.submit("analyze", None)
+        assert held.stats()["queued"] == 1
+        await held.shutdown()
+
+        manager = JobManager(runners=1, queue_size=10, ttl=0, max_finished=2)
+
+        async def work(job):
+            await asyncio.get_running_loop().run_in_executor(None, manager.save_attachment, job, b"xlsx", {})
+            return {}
+
+        done = [await manager.submit("export", work) for _ in range(3)]
+        for _ in range(100):
+            if all(j.finished_at for j in done):
+                break
+            await asyncio.sleep(0.01)
+        paths = [j.attachment[0] for j in done]
+        # only the newest finished jobs stay; the files of forgotten ones are deleted
+        assert manager.get(done[0].id) is None and manager.get(done[2].id) is done[2]
+        assert [os.path.exists(p) for p in paths] == [False, True, True]
+        await manager.shutdown()
+        assert not any(os.path.exists(p) for p in paths)
+
+    asyncio.run(scenario())
+
+
+def test_server_boots_without_heavy_imports():
+    import subprocess
+    import sys
+    code = ("import sys, backend.main; "
+            "print(sorted(m for m in ('pandas', 'scipy', 'openpyxl', 'PIL') if m in sys.modules))")
+    env = dict(os.environ, R_POOL_SIZE="0")
+    out = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                         env=env, capture_output=True, text=True, timeout=120)
+    assert out.returncode == 0, out.stderr
+    # the startup warm-up imports them, not the import of the app
+    assert out.stdout.strip() == "[]"
+
+
+@pytest.fixture(scope="module")
+def r_engine():
+    pytest.importorskip("rpy2.robjects")
+    from backend import r_interface
+    try:
+        r_interface._ensure_r_loaded()
+    except Exception as e:
+        pytest.skip(f"R engine unavailable: {e}")
+    return r_interface
+
+
+@pytest.mark.parametrize("name", sorted(EXPECTED))
+def test_parity_with_r_engine(tmp_path, r_engine, name):
+    snap, manifest = _snapshot(tmp_path, name, _datasets()[name])
+    names = dataset_service.snapshot_headers(manifest)
+    proj = str(tmp_path / "proj.csv")
+    dataset_service.write_projected_csv(snap, manifest, names[:2], proj)
+
+    r_res = r_engine.run_analysis(proj, 1, 2, plots_dir=str(tmp_path / "plots"), encoding="utf-8", delimiter=",")
+    py_res = _run_python(snap, manifest)
+
+    assert py_res["recommended_test"] == r_res["recommended_test"]
+    r_stats, py_stats = r_res["stats"], py_res["stats"]
+    assert py_stats["method"].strip() == str(r_stats["method"]).strip()
+    for key in ("statistic", "p_value", "estimate"):
+        if key in r_stats:
+            assert _close(py_stats.get(key), r_stats[key], rel=1e-5), (key, py_stats.get(key), r_stats[key])
+
+
+@pytest.mark.parametrize("name", sorted(EXPECTED))
+def test_r_column_handoff_matches_csv(tmp_path, r_engine, name):
+    snap, manifest = _snapshot(tmp_path, name, _datasets()[name])
+    names = dataset_service.snapshot_headers(manifest)
+    proj = str(tmp_path / "proj.csv")
+    dataset_service.write_projected_csv(snap, manifest, names[:2], proj)
+
+    csv_res = r_engine.run_analysis(proj, 1, 2, plots_dir=str(tmp_path / "plots"), encoding="utf-8", delimiter=",")
+    mem_res = r_engine.run_analysis_columns(snap, names[0], names[1], plots_dir=str(tmp_path / "plots"))
+
+    assert mem_res["recommended_test"] == csv_res["recommended_test"]
+    for key in ("statistic", "p_value", "estimate"):
+        if key in csv_res["stats"]:
+            assert _close(mem_res["stats"].get(key), csv_res["stats"][key]), key
+    assert "r_input" in mem_res["timings"] and "r_read_csv" not in mem_res["timings"]
+
+
+@pytest.mark.parametrize("name", ["pearson_correlation", "t_student", "chi_square"])
+def test_r_projected_read_of_wide_csv(tmp_path, r_engine, name):
+    df = _datasets()[name]
+    wide = df.copy()
+    for i in range(50):
+        wide[f"extra_{i}"] = np.arange(len(df)) * i
+    wide = wide[[f"extra_{i}" for i in range(25)] + list(df.columns) + [f"extra_{i}" for i in range(25, 50)]]
+    wide_path, narrow_path = str(tmp_path / "wide.csv"), str(tmp_path / "narrow.csv")
+    wide.to_csv(wide_path, index=False)
+    df.to_csv(narrow_path, index=False)
+    x, y = df.columns[:2]
+
+    wide_res = r_engine.run_analysis(wide_path, x, y, plots_dir=str(tmp_path / "plots"), encoding="utf-8", delimiter=",")
+    narrow_res = r_engine.run_analysis(narrow_path, 1, 2, plots_dir=str(tmp_path / "plots"), encoding="utf-8", delimiter=",")
+
+    assert wide_res["recommended_test"] == narrow_res["recommended_test"]
+    for key in ("statistic", "p_value"):
+        assert _close(wide_res["stats"].get(key), narrow_res["stats"].get(key)), key
+
+
+def test_r_association_heatmap(tmp_path, r_engine):
+    from backend.services import matrix_service
+    snap, manifest = _snapshot(tmp_path, "heatmap", _datasets()["decimal_comma"].assign(v=np.arange(200) % 7))
+    res = matrix_service.compute(snap, manifest, dataset_service.snapshot_headers(manifest))
+    values, p_values, names = matrix_service.heatmap_input(res)
+    out = r_engine.render_association_matrix(values, p_values, names, str(tmp_path / "plots"))
+    with open(tmp_path / "plots" / out["plot_path"], "rb") as f:
+        assert f.read(8) == b"\x89PNG\r\n\x1a\n"